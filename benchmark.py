@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks, nothing here touches the network. Everything runs
+against synthetic data in a temporary db, and the results are written out
+as JSON so they can be compared from one change to the next.
+
+    Usage: ./benchmark.py [-r ROWS] [-o results.json]
+"""
+
+import csv
+import datetime
+import io
+import ipaddress
+import json
+import os
+import platform
+import random
+import re
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from config import settings
+import mac_db
+import mac_codec
+import org_matcher as mac_org
+import device_tracker as dev_track
+import ping_scanner as pinger
+import passive_scanner
+
+
+# The I/G and U/L bits of the first octet, which no IEEE assignment has set,
+# so lookups skip anything with either of them
+_NOT_ASSIGNABLE = 0x03 << 40
+
+
+def _assignable_prefix(n, prefix_bits):
+    """
+    returns the nth prefix of prefix_bits with neither of those bits set
+    """
+    low_bits = prefix_bits - 8
+    return n >> low_bits << (low_bits + 2) | n & ((1 << low_bits) - 1)
+
+
+def _use_db(db_fname):
+    """
+    Points org_matcher and device_tracker at db_fname
+    """
+    settings.MAC_DB_FNAME = db_fname
+    mac_org.invalidate_index()
+
+
+def write_synthetic_registry(fname, rows, assignment_class='mal', seed=0):
+    """
+    Writes an IEEE-style registry csv with unique random assignments
+    """
+    prefix_bits = 48 - mac_org.ASSIGNMENT_BLOCK_BITS[assignment_class]
+    hex_width = prefix_bits // 4
+    registry = {'mal': 'MA-L', 'mam': 'MA-M', 'mas': 'MA-S'}[assignment_class]
+    rand = random.Random(seed)
+    prefixes = [_assignable_prefix(n, prefix_bits)
+                for n in rand.sample(range(2**(prefix_bits - 2)), rows)]
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            'Registry', 'Assignment', 'Organization Name',
+            'Organization Address',
+        ])
+        for n, prefix in enumerate(prefixes):
+            writer.writerow([
+                registry,
+                '{:0{}X}'.format(prefix, hex_width),
+                'Organisation {}'.format(n % 20000),
+                '{} Some Street\nSome Town\nXX'.format(n % 20000),
+            ])
+
+
+def bench_extract(fname, assignment_class='mal'):
+    start = time.perf_counter()
+    rows = 0
+    for _ in mac_org.extract(assignment_class, fname):
+        rows += 1
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in mac_org.extract(assignment_class, fname):
+        pass
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'peak_bytes': peak_bytes,
+    }
+
+
+# What my_utils did before mac_codec, to compare against
+_LEGACY_HEX_CHARS = re.compile(r'[\Wg-zG-Z]')
+
+
+def _legacy_hex_str_to_int(hex_str):
+    return int(_LEGACY_HEX_CHARS.sub('', hex_str), 16)
+
+
+def _legacy_int_mac_to_hex_mac(int_mac):
+    padded_str = '{0:012x}'.format(int_mac)
+    return ':'.join([
+        '{}{}'.format(padded_str[pos], padded_str[pos+1])
+        for pos in range(0, len(padded_str), 2)
+    ])
+
+
+def _rate(func, items):
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def bench_mac_codec(count=100000, seed=0):
+    """
+    returns conversions per second of the old my_utils functions and
+    mac_codec, one at a time and in bulk
+    """
+    rand = random.Random(seed)
+    mac_ints = [rand.getrandbits(48) for _ in range(count)]
+    mac_strs = [mac_codec.format_mac(mac_int) for mac_int in mac_ints]
+    # A listing formats the same few devices over and over
+    repeated = [mac_ints[n % 100] for n in range(count)]
+    mac_codec.format_mac.cache_clear()
+
+    def bulk_rate(func, items):
+        start = time.perf_counter()
+        func(items)
+        return len(items) / (time.perf_counter() - start)
+
+    return {
+        'count': count,
+        'parse_legacy': _rate(_legacy_hex_str_to_int, mac_strs),
+        'parse': _rate(mac_codec.parse_mac, mac_strs),
+        'parse_lenient': _rate(mac_codec.parse_mac_lenient, mac_strs),
+        'parse_bulk': bulk_rate(mac_codec.parse_macs, mac_strs),
+        'format_legacy': _rate(_legacy_int_mac_to_hex_mac, mac_ints),
+        'format_uncached': _rate(mac_codec.format_mac.__wrapped__, mac_ints),
+        'format_cached': _rate(mac_codec.format_mac, repeated),
+        'format_bulk': bulk_rate(mac_codec.format_macs, mac_ints),
+    }
+
+
+def bench_import(fname, db_fname, assignment_class='mal'):
+    """
+    Times extract() feeding dump_into_db(), as an import does
+    """
+    _use_db(db_fname)
+    mac_org.init_tables(db_fname)
+    start = time.perf_counter()
+    mac_org.dump_into_db(mac_org.extract(assignment_class, fname), db_fname)
+    elapsed = time.perf_counter() - start
+    with mac_db.get_connection(db_fname) as conn:
+        rows = conn.execute('SELECT COUNT(*) FROM mac_addr_org').fetchone()[0]
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+    }
+
+
+def bench_lookups(fname, db_fname, count=100000, seed=0,
+                  assignment_class='mal'):
+    """
+    Times search_by_mac_address_int one at a time and
+    search_by_mac_addresses in bulk, against the db from bench_import(),
+    half of the macs being in an assigned block
+    """
+    _use_db(db_fname)
+    rand = random.Random(seed)
+    block_bits = mac_org.ASSIGNMENT_BLOCK_BITS[assignment_class]
+    starts = [entry[0] for entry in mac_org.extract(assignment_class, fname)]
+    mac_ints = [
+        rand.choice(starts) | rand.getrandbits(block_bits) if n % 2
+        else rand.getrandbits(48) & ~_NOT_ASSIGNABLE
+        for n in range(count)
+    ]
+
+    start = time.perf_counter()
+    mac_org.warm_index()
+    index_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = sum(1 for mac_int in mac_ints
+                if mac_org.search_by_mac_address_int(mac_int))
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in mac_org.search_by_mac_addresses(mac_ints):
+        pass
+    bulk_seconds = time.perf_counter() - start
+    return {
+        'lookups': count,
+        'found': found,
+        'index_load_seconds': index_seconds,
+        'single_per_second': count / single_seconds,
+        'bulk_per_second': count / bulk_seconds,
+    }
+
+
+def _synthetic_devices(count):
+    # Universally administered, a randomised mac would go through
+    # device_tracker's grouping by hostname instead
+    return [{
+        'mac_int': 0x00163e000000 | n,
+        'hostname': 'host-{}'.format(n),
+        'ip': '10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255),
+    } for n in range(count)]
+
+
+def bench_persistence(db_fname, devices=50, scans=100):
+    """
+    Times saving scans of devices one device at a time with
+    add_device/add_device_on_timeline, and all at once with record_scan
+    """
+    scan_devices = _synthetic_devices(devices)
+    start_time = datetime.datetime(2016, 1, 1)
+    results = {'devices': devices, 'scans': scans}
+    for method in ('add_device', 'record_scan'):
+        _use_db('{}.{}'.format(db_fname, method))
+        dev_track.init_tables()
+        start = time.perf_counter()
+        for n in range(scans):
+            timestamp = start_time + datetime.timedelta(minutes=5 * n)
+            if method == 'record_scan':
+                dev_track.record_scan(timestamp, scan_devices)
+                continue
+            dev_track.add_timestamp(timestamp)
+            for device in scan_devices:
+                dev_track.add_device(device)
+                dev_track.add_device_on_timeline(device, timestamp)
+        elapsed = time.perf_counter() - start
+        results[method] = {
+            'seconds': elapsed,
+            'devices_per_second': devices * scans / elapsed,
+        }
+    return results
+
+
+def bench_history(db_fname, sizes=(100, 1000, 10000), devices=20, seed=0):
+    """
+    Times _get_device_history_id and get_all_device_history as the number of
+    scans grows through sizes, each device coming and going at random
+    """
+    _use_db(db_fname)
+    dev_track.init_tables()
+    rand = random.Random(seed)
+    scan_devices = _synthetic_devices(devices)
+    start_time = datetime.datetime(2016, 1, 1)
+    device_ids = {}
+    scans = 0
+    results = []
+    for size in sizes:
+        for n in range(scans, size):
+            timestamp = start_time + datetime.timedelta(minutes=5 * n)
+            device_ids.update(dev_track.record_scan(timestamp, [
+                device for device in scan_devices if rand.random() < 0.8
+            ]))
+        scans = size
+        device_id = next(iter(device_ids.values()))
+
+        start = time.perf_counter()
+        history = dev_track._get_device_history_id(device_id)
+        one_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        all_history = dev_track.get_all_device_history()
+        all_seconds = time.perf_counter() - start
+        assert len(history) == size
+        assert len(all_history) == len(device_ids)
+        results.append({
+            'scans': size,
+            'devices': len(device_ids),
+            'one_device_seconds': one_seconds,
+            'all_devices_seconds': all_seconds,
+        })
+    return results
+
+
+def bench_ping_scan(ip_network='10.0.0.0/20', live=0.1, seed=0):
+    """
+    Times a ping_scan where every probe comes back straight away, so it's
+    all fan-out overhead
+    """
+    rand = random.Random(seed)
+    hosts = [str(ip) for ip in
+             ipaddress.ip_network(ip_network).hosts()]
+    prober = pinger.FakeProber(
+        live_ips=rand.sample(hosts, int(len(hosts) * live))
+    )
+    start = time.perf_counter()
+    found = pinger.ping_scan(ip_network, prober, timeout=0, retries=0)
+    elapsed = time.perf_counter() - start
+    assert len(found) == len(prober.live_ips)
+    return {
+        'hosts': len(hosts),
+        'live': len(found),
+        'probes': prober.probes,
+        'seconds': elapsed,
+        'hosts_per_second': len(hosts) / elapsed,
+    }
+
+
+def _synthetic_frame(rand, mac_bytes, kind):
+    """
+    An ethernet frame from mac_bytes, kind being 'arp', 'dhcp' or 'other'
+    (a TCP packet, like most of what a capture is)
+    """
+    ip = socket.inet_aton('10.0.{}.{}'.format(mac_bytes[4], mac_bytes[5]))
+    if kind == 'arp':
+        return (b'\xff' * 6 + mac_bytes + b'\x08\x06' +
+                struct.pack('!HHBBH', 1, 0x0800, 6, 4, 1) + mac_bytes + ip +
+                b'\0' * 6 + socket.inet_aton('10.0.0.1'))
+    if kind == 'dhcp':
+        hostname = 'host-{}'.format(mac_bytes.hex()).encode()
+        bootp = (bytes([1, 1, 6, 0]) + b'\0' * 24 + mac_bytes + b'\0' * 202 +
+                 struct.pack('!I', 0x63825363) +
+                 bytes([53, 1, 3, 12, len(hostname)]) + hostname + b'\xff')
+        payload = struct.pack('!HHHH', 68, 67, 8 + len(bootp), 0) + bootp
+        protocol = 17
+    else:
+        payload = bytes(rand.getrandbits(8) for _ in range(40))
+        protocol = 6
+    return (b'\xff' * 6 + mac_bytes + b'\x08\x00' +
+            struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0, 64,
+                        protocol, 0, ip, b'\xff' * 4) +
+            payload)
+
+
+def write_synthetic_capture(f, packets, devices=200, seed=0):
+    """
+    Writes a pcap of packets frames from devices macs into f, mostly TCP
+    with an ARP or DHCP request every so often
+    """
+    rand = random.Random(seed)
+    macs = [bytes([0]) + rand.getrandbits(40).to_bytes(5, 'big')
+            for _ in range(devices)]
+    # A few of each kind to pick from, making every frame up would take far
+    # longer than reading them back
+    frames = [_synthetic_frame(rand, mac_bytes, kind)
+              for mac_bytes in macs for kind in ('arp', 'dhcp', 'other')]
+    f.write(struct.pack('<IHHiIII', passive_scanner.PCAP_MAGIC, 2, 4, 0, 0,
+                        65535, passive_scanner.LINKTYPE_ETHERNET))
+    for n in range(packets):
+        if n % 10:
+            frame = frames[rand.randrange(devices) * 3 + 2]
+        else:
+            frame = frames[rand.randrange(len(frames))]
+        timestamp = 1000000000 + n // 1000
+        f.write(struct.pack('<IIII', timestamp, n % 1000 * 1000, len(frame),
+                            len(frame)))
+        f.write(frame)
+
+
+def bench_passive(packets=200000, devices=200, seed=0):
+    """
+    Times reading sightings and windows out of a synthetic pcap
+    """
+    capture = io.BytesIO()
+    write_synthetic_capture(capture, packets, devices, seed)
+    capture.seek(0)
+    start = time.perf_counter()
+    sightings = list(passive_scanner.iter_capture_sightings(capture))
+    parse_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    scans = list(passive_scanner.iter_scans(iter(sightings), 60))
+    window_seconds = time.perf_counter() - start
+    return {
+        'packets': packets,
+        'megabytes': len(capture.getvalue()) / 2**20,
+        'sightings': len(sightings),
+        'scans': len(scans),
+        'parse_seconds': parse_seconds,
+        'packets_per_second': packets / parse_seconds,
+        'window_seconds': window_seconds,
+    }
+
+
+def run_all(rows=1000000, lookups=100000, devices=50, scans=100,
+            history_sizes=(100, 1000, 10000), ip_network='10.0.0.0/20'):
+    results = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'rows': rows,
+        },
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        registry_fname = os.path.join(tmp_dir, 'mal.csv')
+        write_synthetic_registry(registry_fname, rows)
+        results['extract'] = bench_extract(registry_fname)
+        oui_db_fname = os.path.join(tmp_dir, 'oui.db')
+        results['import'] = bench_import(registry_fname, oui_db_fname)
+        results['lookup'] = bench_lookups(registry_fname, oui_db_fname,
+                                          lookups)
+        results['persistence'] = bench_persistence(
+            os.path.join(tmp_dir, 'persistence.db'), devices, scans
+        )
+        results['history'] = bench_history(
+            os.path.join(tmp_dir, 'history.db'), history_sizes
+        )
+        results['ping_scan'] = bench_ping_scan(ip_network)
+        results['passive'] = bench_passive()
+        results['mac_codec'] = bench_mac_codec()
+        mac_org.invalidate_index()
+        mac_db.close_connections()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-r', '--rows', type=int, default=1000000,
+        help='Number of rows in the synthetic registry'
+    )
+    parser.add_argument(
+        '-l', '--lookups', type=int, default=100000,
+        help='Number of mac addresses to look up'
+    )
+    parser.add_argument(
+        '-d', '--devices', type=int, default=50,
+        help='Number of devices in each persisted scan'
+    )
+    parser.add_argument(
+        '-s', '--scans', type=int, default=100,
+        help='Number of scans to persist'
+    )
+    parser.add_argument(
+        '--history-sizes', type=int, nargs='+', default=[100, 1000, 10000],
+        metavar='SCANS',
+        help='Numbers of scans to time history queries at'
+    )
+    parser.add_argument(
+        '-n', '--network', default='10.0.0.0/20',
+        help='Network for the ping_scan fan-out, in CIDR format'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='Write the results to this file rather than stdout'
+    )
+    args = parser.parse_args()
+
+    results = run_all(args.rows, args.lookups, args.devices, args.scans,
+                      args.history_sizes, args.network)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
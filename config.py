@@ -0,0 +1,231 @@
+"""
+Settings, and working out this machine's own ip and mac address, without
+either happening until something actually asks.
+
+    from config import settings
+
+works like import settings, except that settings.py is only imported the
+first time a setting is looked up, and a missing settings.py just means
+every setting is left at its default. Settings with a default, like
+MAC_DB_FNAME, get it from DEFAULT_SETTINGS, and should be read where
+they're used rather than when a module is imported, so importing doesn't
+load settings.py. The rest are looked up with hasattr() where they're used.
+
+own_ip_address() and own_mac_address() use OWN_IP_ADDRESS/OWN_MAC_ADDRESS
+if they're set, and otherwise find out from the kernel which interface
+leads to the network being scanned, once per process.
+"""
+
+import datetime
+import functools
+import importlib
+import types
+
+# socket, struct and ipaddress are only imported by the functions that need
+# them, as most runs never get that far
+
+ROUTE_TABLE_PATH = '/proc/net/route'
+SYS_CLASS_NET_PATH = '/sys/class/net'
+
+# Filled in on settings if settings.py doesn't set them
+DEFAULT_SETTINGS = {
+    'MAC_DB_FNAME': 'mac.db',
+    'GRAPH_CACHE_FNAME': 'graph_cache.pickle',
+    'PASSIVE_WINDOW': 60,
+    'PRESENCE_GAP_TOLERANCE': datetime.timedelta(0),
+    'QUERY_SERVER_HOST': '127.0.0.1',
+    'QUERY_SERVER_PORT': 8080,
+    'RAW_RETENTION': datetime.timedelta(days=7),
+    'ROLLUP_INTERVAL': datetime.timedelta(hours=1),
+    'ROLLUP_RETENTION': datetime.timedelta(days=365),
+}
+
+
+class _LazySettings:
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._module_name)
+            except ImportError:
+                self._module = types.ModuleType(self._module_name)
+            for name, value in DEFAULT_SETTINGS.items():
+                if not hasattr(self._module, name):
+                    setattr(self._module, name, value)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super().__setattr__(name, value)
+        else:
+            setattr(self._load(), name, value)
+
+
+settings = _LazySettings('settings')
+
+
+# ioctls for an interface's ipv4 address and netmask, from linux/sockios.h
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+
+def _interface_ioctl(sock, request, interface):
+    import fcntl
+    import socket
+    import struct
+    ifreq = fcntl.ioctl(sock.fileno(), request,
+                        struct.pack('256s', interface.encode()[:15]))
+    # struct ifreq is the name then a struct sockaddr_in
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def interface_network(interface):
+    """
+    returns the ipv4 network interface is on, e.g. 192.168.1.0/24
+    raises OSError if it doesn't have one
+    """
+    import ipaddress
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        address = _interface_ioctl(sock, SIOCGIFADDR, interface)
+        netmask = _interface_ioctl(sock, SIOCGIFNETMASK, interface)
+    return ipaddress.ip_network('{}/{}'.format(address, netmask),
+                                strict=False)
+
+
+def scan_networks(targets=None):
+    """
+    targets is a list of CIDR networks and/or interface names, or IP_NETWORK
+    (either of those, or a list of them) if None
+    returns the ipaddress networks they add up to
+    """
+    import ipaddress
+    if targets is None:
+        if hasattr(settings, 'IP_NETWORK'):
+            targets = settings.IP_NETWORK
+        else:
+            targets = '192.168.1.0/24'
+    if isinstance(targets, str):
+        targets = [targets]
+    networks = []
+    for target in targets:
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            network = interface_network(target)
+        if network not in networks:
+            networks.append(network)
+    return networks
+
+
+def parse_route_table(lines):
+    """
+    lines of /proc/net/route, returns [(interface, network)]
+    """
+    import ipaddress
+    import socket
+    import struct
+    routes = []
+    for line in lines:
+        fields = line.split()
+        # Iface, Destination, Gateway, Flags, RefCnt, Use, Metric, Mask, ...
+        if len(fields) < 8 or fields[0] == 'Iface':
+            continue
+        # Addresses are hex in the kernel's byte order
+        destination, mask = (
+            socket.inet_ntoa(struct.pack('=L', int(field, 16)))
+            for field in (fields[1], fields[7])
+        )
+        routes.append((fields[0], ipaddress.ip_network(
+            '{}/{}'.format(destination, mask), strict=False
+        )))
+    return routes
+
+
+def route_interface(ip_network, route_table_path=ROUTE_TABLE_PATH):
+    """
+    returns the name of the interface the kernel would send to ip_network
+    from, or None if there's no route at all
+    """
+    try:
+        with open(route_table_path) as f:
+            routes = parse_route_table(f)
+    except OSError:
+        return None
+    address = ip_network.network_address
+    matches = [(network.prefixlen, interface)
+               for interface, network in routes if address in network]
+    return max(matches)[1] if matches else None
+
+
+def interface_mac_address(interface, sys_class_net_path=SYS_CLASS_NET_PATH):
+    """
+    returns interface's mac address as a hex string, or None
+    """
+    try:
+        with open('{}/{}/address'.format(sys_class_net_path,
+                                         interface)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def own_ip_address(ip_network=None):
+    """
+    returns the address this machine uses on ip_network (the first of
+    scan_networks() if None), or None
+    """
+    import socket
+    if hasattr(settings, 'OWN_IP_ADDRESS'):
+        return settings.OWN_IP_ADDRESS
+    if ip_network is None:
+        ip_network = scan_networks()[0]
+    # Connecting a udp socket only asks the kernel for a route, nothing is
+    # sent
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((str(next(ip_network.hosts(), ip_network.network_address)),
+                   9))
+        return s.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        s.close()
+
+
+@functools.lru_cache(maxsize=None)
+def own_mac_address(ip_network=None):
+    """
+    returns the mac address of the interface this machine uses on
+    ip_network (the first of scan_networks() if None), or None
+    """
+    if hasattr(settings, 'OWN_MAC_ADDRESS'):
+        return settings.OWN_MAC_ADDRESS
+    if ip_network is None:
+        ip_network = scan_networks()[0]
+    interface = route_interface(ip_network)
+    if interface is None:
+        return None
+    return interface_mac_address(interface)
+
+
+def own_addresses(ip_networks):
+    """
+    returns {ip: mac} of this machine's own address on each of ip_networks
+    that it has one on
+    """
+    addresses = {}
+    for ip_network in ip_networks:
+        ip = own_ip_address(ip_network)
+        mac = own_mac_address(ip_network)
+        if ip and mac:
+            addresses[ip] = mac
+    return addresses
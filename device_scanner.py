@@ -1,95 +1,418 @@
-#!/usr/bin/env python3.5
+#!/usr/bin/env python3
 
 import org_matcher as mac_org
 import device_tracker as dev_track
 import my_utils as u
-import multiprocessing
-import subprocess
-import ipaddress
-import os
 import datetime
+import time
+import mac_db
+import metrics
 
+# asyncio, subprocess and the rest of what scanning needs are imported by
+# the functions that scan, so listing and history lookups start quickly
 
-def _pinger(job_q, results_q, ping_bin):
-    # Modified from:
-    # http://stackoverflow.com/questions/21225464/fast-ping-sweep-in-python
-    DEVNULL = open(os.devnull, 'w')
-    while True:
-        ip = job_q.get()
-        if not ip:
-            break
-        result = subprocess.call([ping_bin, '-c1', ip],
-                                 stdout=DEVNULL,
-                                 stderr=DEVNULL)
-        if result == 0:
-            results_q.put(ip)
-
-def ping_scan(ip_addr_network_string, ping_bin):
-    # Modified from:
-    # http://stackoverflow.com/questions/21225464/fast-ping-sweep-in-python
-    pool_size = 255
-    jobs = multiprocessing.Queue()
-    results = multiprocessing.Queue()
-    pool = [
-        multiprocessing.Process(target=_pinger,
-                                args=(jobs, results, ping_bin))
-        for i in range(pool_size)
-    ]
-    ip_addr_network = ipaddress.ip_network(ip_addr_network_string)
-    for p in pool:
-        p.start()
-    for ip in ip_addr_network.hosts():
-        jobs.put(str(ip))
-    for p in pool:
-        jobs.put(None)
-    for p in pool:
-        p.join()
-    pingable_ips = []
-    while not results.empty():
-        pingable_ips.append(results.get())
-    return pingable_ips
-
-def arp_ips(ip_list, arp_bin, own_mac_address, own_ip_address=None):
-    devices = []
-    for ip in ip_list:
-        if ip == own_ip_address:
-            device = {
-                'hostname': 'Yourself',
-                'ip': ip,
-                'mac_hex_str': own_mac_address,
-                'mac_int': u.hex_str_to_int(own_mac_address),
-            }
-            devices.append(device)
-        p = subprocess.Popen([arp_bin, '-e', ip],
-                             stdout=subprocess.PIPE)
-        output, err = p.communicate()
-        result = output.decode('utf-8').split('\n')
-        if 'no entry' in result[0]:
+NEIGHBOUR_TABLE_PATH = '/proc/net/arp'
+
+# Live ips waiting to be resolved and saved before discovery is held back
+SCAN_QUEUE_SIZE = 256
+
+_SCAN_DONE = object()
+
+# Seconds between scans in daemon mode, and how far either side of that each
+# scan can start
+DAEMON_INTERVAL = 300
+DAEMON_JITTER = 10
+
+
+@metrics.timed('ping_scan')
+def ping_scan(ip_addr_network_string, ping_bin, prober=None, **kwargs):
+    """
+    Returns a list of the ips that answered a ping, ip_addr_network_string
+    can also be a list of networks to sweep at once, see
+    ping_scanner.iter_live_hosts for the other arguments
+    """
+    import ping_scanner as pinger
+    if prober is None:
+        prober = pinger.default_prober(ping_bin)
+        try:
+            return pinger.ping_scan(ip_addr_network_string, prober, **kwargs)
+        finally:
+            prober.close()
+    return pinger.ping_scan(ip_addr_network_string, prober, **kwargs)
+
+def parse_proc_arp(lines):
+    """
+    lines of /proc/net/arp, returns {ip: mac_hex_str} of complete entries
+    """
+    neighbours = {}
+    for line in lines:
+        fields = line.split()
+        # IP address, HW type, Flags, HW address, Mask, Device
+        if len(fields) < 4 or fields[0] == 'IP':
+            continue
+        # ATF_COM (0x2) is set once the entry has been resolved
+        if not int(fields[2], 16) & 0x2:
+            continue
+        neighbours[fields[0]] = fields[3]
+    return neighbours
+
+def parse_ip_neigh(lines):
+    """
+    lines of `ip neigh` output, returns {ip: mac_hex_str} of entries that
+    have a link layer address
+    """
+    neighbours = {}
+    for line in lines:
+        fields = line.split()
+        if 'lladdr' not in fields or fields[-1] in ('FAILED', 'INCOMPLETE'):
             continue
-        device = {
+        neighbours[fields[0]] = fields[fields.index('lladdr') + 1]
+    return neighbours
+
+@metrics.timed('neighbour_table')
+def read_neighbour_table(path=NEIGHBOUR_TABLE_PATH):
+    """
+    Reads the kernel's neighbour table in one go, path is either
+    /proc/net/arp or a file of saved `ip neigh` output
+
+    returns {ip: mac_hex_str}
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    if lines and lines[0].startswith('IP address'):
+        return parse_proc_arp(lines)
+    return parse_ip_neigh(lines)
+
+def _hostname(ip):
+    # What arp -e would have shown, the name if it resolves otherwise the ip
+    import socket
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except OSError:
+        return ip
+
+@metrics.timed('arp_subprocess')
+def _arp_ip(ip, arp_bin):
+    import subprocess
+    p = subprocess.Popen([arp_bin, '-e', ip],
+                         stdout=subprocess.PIPE)
+    output, err = p.communicate()
+    result = output.decode('utf-8').split('\n')
+    if 'no entry' in result[0] or len(result) < 2:
+        return None
+    fields = result[1].split()
+    if len(fields) < 3:
+        return None
+    return {
+        'ip': ip,
+        'hostname': fields[0],
+        'mac_hex_str': fields[2],
+        'mac_int': u.hex_str_to_int(fields[2]),
+    }
+
+def _own_addresses(own_mac_address, own_ip_address, own_addresses=None):
+    addresses = dict(own_addresses or {})
+    if own_ip_address and own_mac_address:
+        addresses[own_ip_address] = own_mac_address
+    return addresses
+
+def _resolve_ip(ip, neighbours, arp_bin, own_addresses):
+    """
+    neighbours is from read_neighbour_table, or None to run arp_bin instead,
+    and own_addresses is {ip: mac} of this machine, which never turns up in
+    either
+    returns the device dict for ip, or None if it's not known
+    """
+    own_mac_address = own_addresses.get(ip)
+    if own_mac_address:
+        return {
+            'hostname': 'Yourself',
             'ip': ip,
-            'hostname': result[1].split()[0],
-            'mac_hex_str': result[1].split()[2],
-            'mac_int': u.hex_str_to_int(result[1].split()[2]),
+            'mac_hex_str': own_mac_address,
+            'mac_int': u.hex_str_to_int(own_mac_address),
         }
-        devices.append(device)
+    if neighbours is None:
+        return _arp_ip(ip, arp_bin)
+    mac_hex_str = neighbours.get(ip)
+    if not mac_hex_str:
+        return None
+    return {
+        'ip': ip,
+        'hostname': _hostname(ip),
+        'mac_hex_str': mac_hex_str,
+        'mac_int': u.hex_str_to_int(mac_hex_str),
+    }
+
+def _read_neighbour_table_or_none(neighbour_table_path):
+    try:
+        return read_neighbour_table(neighbour_table_path)
+    except OSError:
+        return None
+
+@metrics.timed('arp_ips')
+def arp_ips(ip_list, arp_bin, own_mac_address, own_ip_address=None,
+            neighbour_table_path=NEIGHBOUR_TABLE_PATH):
+    """
+    Looks up the mac of each ip in the neighbour table, only falling back to
+    running arp_bin for each ip if the table can't be read
+    """
+    neighbours = _read_neighbour_table_or_none(neighbour_table_path)
+    own_addresses = _own_addresses(own_mac_address, own_ip_address)
+    devices = []
+    for ip in ip_list:
+        device = _resolve_ip(ip, neighbours, arp_bin, own_addresses)
+        if device:
+            devices.append(device)
     return devices
 
 def scan_macs(ip_network, ping_bin, arp_bin, own_mac_address,
-              own_ip_address=None):
-    ips = ping_scan(ip_network, ping_bin)
-    devices = arp_ips(ips, arp_bin, own_ip_address)
+              own_ip_address=None, **ping_options):
+    ips = ping_scan(ip_network, ping_bin, **ping_options)
+    devices = arp_ips(ips, arp_bin, own_mac_address, own_ip_address)
     return devices
 
+def _discover(ip_network, prober, ip_queue, stop, ping_options):
+    """
+    Runs in its own thread, putting each live (network, ip) on ip_queue as
+    it answers and then _SCAN_DONE (or the exception that stopped it)
+    """
+    import asyncio
+    import queue
+    import ping_scanner as pinger
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ip_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    async def feed():
+        loop = asyncio.get_running_loop()
+        live_hosts = pinger.iter_tagged_live_hosts(ip_network, prober,
+                                                   **ping_options)
+        try:
+            async for network_ip in live_hosts:
+                # Waits in an executor so a full queue holds back this
+                # generator without stalling the replies already in flight
+                await loop.run_in_executor(None, put, network_ip)
+        finally:
+            await live_hosts.aclose()
+
+    async def discover():
+        feeder = asyncio.ensure_future(feed())
+        while not feeder.done():
+            await asyncio.wait([feeder], timeout=0.1)
+            if stop.is_set():
+                feeder.cancel()
+        try:
+            await feeder
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        with metrics.timer('ping_scan'):
+            asyncio.run(discover())
+        put(_SCAN_DONE)
+    except BaseException as e:
+        put(e)
+
 def scan_add_and_update_macs(ip_network, ping_bin, arp_bin, own_mac_address,
-                             own_ip_address=None):
-    devices = scan_macs(ip_network, ping_bin, arp_bin, own_ip_address)
-    return devices
+                             own_ip_address=None, prober=None, timings=None,
+                             neighbour_table_path=NEIGHBOUR_TABLE_PATH,
+                             queue_size=SCAN_QUEUE_SIZE, own_addresses=None,
+                             **ping_options):
+    """
+    Generator which scans ip_network (one CIDR network or a list of them,
+    all swept at once) and records every device it finds in the database as
+    soon as it answers, yielding each device once it's saved, with the
+    network it was found in as 'network' and the 'device_id' it was saved
+    under. Devices that answer while the last lot are being saved are saved
+    together in one transaction.
+
+    own_addresses is {ip: mac} of this machine on networks other than
+    own_ip_address's.
+
+    If the scan fails, or is closed before it's finished, whatever it had
+    saved is taken back out again with device_tracker.discard_scan().
+
+    Discovery runs in another thread and hands ips over through a queue of
+    queue_size, so it backs off if resolving and saving fall behind. If
+    timings is a dict it's filled in with the seconds spent in each stage,
+    the time to the first device and the total, and the scan's timestamp.
+    """
+    import queue
+    import threading
+    import ping_scanner as pinger
+    if timings is None:
+        timings = {}
+    timings.update({
+        'resolve': 0.0,
+        'persist': 0.0,
+        'discovery': 0.0,
+        'first_device': None,
+        'total': None,
+        'devices': 0,
+    })
+    start = time.perf_counter()
+    own_prober = prober is None
+    if own_prober:
+        prober = pinger.default_prober(ping_bin)
+
+    ip_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    discoverer = threading.Thread(
+        target=_discover,
+        args=(ip_network, prober, ip_queue, stop, ping_options),
+        daemon=True,
+    )
+
+    own_addresses = _own_addresses(own_mac_address, own_ip_address,
+                                   own_addresses)
+    timestamp = datetime.datetime.now()
+    timings['timestamp'] = timestamp
+    neighbours = _read_neighbour_table_or_none(neighbour_table_path)
+    scan_done = False
+    recorded = False
+    discoverer.start()
+    try:
+        while not scan_done:
+            stage_start = time.perf_counter()
+            batch = [ip_queue.get()]
+            # Anything else that's turned up meanwhile goes in the same batch
+            while len(batch) < queue_size:
+                try:
+                    batch.append(ip_queue.get_nowait())
+                except queue.Empty:
+                    break
+            timings['discovery'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            devices = []
+            for network_ip in batch:
+                if network_ip is _SCAN_DONE:
+                    # Recorded even if nobody answered, so the scan is on the
+                    # timeline, but only once it's finished
+                    dev_track.record_scan(timestamp, [])
+                    scan_done = True
+                    break
+                if isinstance(network_ip, BaseException):
+                    raise network_ip
+                network, ip = network_ip
+                if (neighbours is not None and ip not in neighbours and
+                        ip not in own_addresses):
+                    # Most likely only just got into the table from the ping
+                    neighbours = _read_neighbour_table_or_none(
+                        neighbour_table_path
+                    )
+                with metrics.timer('arp_ips'):
+                    device = _resolve_ip(ip, neighbours, arp_bin,
+                                         own_addresses)
+                if device:
+                    device['network'] = network
+                    devices.append(device)
+            timings['resolve'] += time.perf_counter() - stage_start
+            if not devices:
+                continue
+
+            stage_start = time.perf_counter()
+            device_ids = dev_track.record_scan(timestamp, devices)
+            for device in devices:
+                device['device_id'] = device_ids[device['mac_int']]
+            recorded = True
+            timings['persist'] += time.perf_counter() - stage_start
+
+            timings['devices'] += len(devices)
+            if timings['first_device'] is None:
+                timings['first_device'] = time.perf_counter() - start
+            yield from devices
+    finally:
+        stop.set()
+        discoverer.join()
+        if own_prober:
+            prober.close()
+        if recorded and not scan_done:
+            # Stopped or failed part way, everyone it didn't get to would
+            # look like they'd left
+            dev_track.discard_scan(timestamp)
+        timings['total'] = time.perf_counter() - start
+        for stage in ('discovery', 'resolve', 'persist', 'total'):
+            metrics.observe('scan.{}'.format(stage), timings[stage])
+        metrics.count('scan.devices', timings['devices'])
+
+def run_daemon(ip_network, ping_bin, arp_bin, own_mac_address,
+               own_ip_address=None, interval=DAEMON_INTERVAL,
+               jitter=DAEMON_JITTER, on_scan=None, prober=None,
+               **scan_options):
+    """
+    Runs an update scan every interval seconds, give or take up to jitter,
+    until SIGINT or SIGTERM. The prober, db connections and OUI index are
+    kept between scans. on_scan(devices, timings) is called after each one
+    that finishes.
+
+    Must be called from the main thread, for the signal handlers.
+    """
+    import random
+    import signal
+    import threading
+    import ping_scanner as pinger
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        stop.set()
+
+    previous_handlers = {
+        signum: signal.signal(signum, request_stop)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    own_prober = prober is None
+    if own_prober:
+        prober = pinger.default_prober(ping_bin)
+    dev_track.init_tables()
+    mac_org.warm_index()
+    next_scan = time.monotonic()
+    try:
+        while not stop.is_set():
+            timings = {}
+            devices = []
+            scan = scan_add_and_update_macs(ip_network, ping_bin, arp_bin,
+                                            own_mac_address, own_ip_address,
+                                            prober=prober, timings=timings,
+                                            **scan_options)
+            try:
+                for device in scan:
+                    devices.append(device)
+                    if stop.is_set():
+                        break
+                else:
+                    # Only a finished scan says who's gone, one stopped part
+                    # way is discarded by scan_add_and_update_macs
+                    if on_scan is not None:
+                        on_scan(devices, timings)
+            finally:
+                scan.close()
+
+            next_scan += interval
+            now = time.monotonic()
+            if next_scan < now:
+                # Scans are taking longer than the interval, don't try to
+                # catch up
+                next_scan = now
+            stop.wait(max(0, next_scan - now + random.uniform(-jitter, jitter)))
+    finally:
+        if own_prober:
+            prober.close()
+        mac_db.close_connections()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
 
 if __name__ == '__main__':
     import argparse
-    import settings
     import pprint
+    import sys
+    import config
+    from config import settings
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-c', '--show-current', action='store_true',
@@ -104,10 +427,72 @@ if __name__ == '__main__':
         '-u', '--update', action='store_true',
         help=('Update database of mac addresses and save time scanned')
     )
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help=('Keep running, scanning and updating the db every --interval')
+    )
+    parser.add_argument(
+        '--network', action='append', metavar='CIDR_OR_INTERFACE',
+        help=('Network to scan instead of IP_NETWORK, either in CIDR format '
+              'or the name of an interface to scan the network of, can be '
+              'given more than once to scan them all at once')
+    )
+    parser.add_argument(
+        '--pcap', action='append', metavar='FILE',
+        help=('Update the db passively from the ARP, DHCP and 802.11 probe '
+              "requests in a pcap or pcapng capture, '-' for stdin, can be "
+              'given more than once')
+    )
+    parser.add_argument(
+        '--sniff', nargs='?', const='', metavar='INTERFACE',
+        help=('Keep updating the db passively from ARP, DHCP and 802.11 '
+              'probe requests sniffed live on INTERFACE (all of them if not '
+              'given), needs root')
+    )
+    parser.add_argument(
+        '--window', type=float, metavar='SECONDS',
+        help=('Length of the scans that passively seen devices are grouped '
+              'into, PASSIVE_WINDOW by default')
+    )
+    parser.add_argument(
+        '--interval', type=float, metavar='SECONDS',
+        help=('Time between scans in daemon mode')
+    )
+    parser.add_argument(
+        '--jitter', type=float, metavar='SECONDS',
+        help=('Start each daemon scan up to this much early or late')
+    )
+    parser.add_argument(
+        '--events', metavar='DEST',
+        help=('Publish devices joining and leaving as JSON lines to DEST, '
+              "'-' for stdout, unix:PATH for a unix socket or a file name")
+    )
+    parser.add_argument(
+        '--timings', action='store_true',
+        help=('Print how long each stage of the update scan took')
+    )
+    parser.add_argument(
+        '--profile', nargs='?', const=True, metavar='PSTATS_FILE',
+        help=('Print how long was spent in each stage on the way out, and '
+              'save a cProfile of the whole run to PSTATS_FILE if given')
+    )
+    parser.add_argument(
+        '--metrics', metavar='FILE',
+        help=('Write stage timings and counts to FILE in Prometheus text '
+              'format after every scan')
+    )
     parser.add_argument(
         '-t', '--trash-database', action='store_true',
         help=('Drop the time series data tables')
     )
+    parser.add_argument(
+        '--prune', action='store_true',
+        help=('Thin out and delete old history as per the retention settings')
+    )
+    parser.add_argument(
+        '--migrate-timeline', action='store_true',
+        help=('Move history saved by older versions into presence runs')
+    )
     parser.add_argument(
         '-a', '--add-name', nargs=2, metavar=('MAC_ADDR', 'NEW_NAME'),
         help=('Add name to mac address')
@@ -124,13 +509,33 @@ if __name__ == '__main__':
         '-n', '--history-name', action='store',
         help=('Look up history of given name')
     )
+    parser.add_argument(
+        '--since', type=u.parse_datetime, metavar='WHEN',
+        help=('Only show history from WHEN, either a date/time like '
+              '"2016-05-01 18:00" or how long ago like 30m, 24h or 7d')
+    )
+    parser.add_argument(
+        '--until', type=u.parse_datetime, metavar='WHEN',
+        help=('Only show history up until WHEN, same formats as --since')
+    )
 
     args = parser.parse_args()
 
-    if hasattr(settings, 'IP_NETWORK'):
-        ip_network = settings.IP_NETWORK
-    else:
-        ip_network = '192.168.1.0/24'
+    if args.profile or args.metrics:
+        metrics.enable()
+    if args.profile:
+        import atexit
+        if args.profile is not True:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        def print_profile():
+            if args.profile is not True:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+            print(metrics.report(), file=sys.stderr)
+        atexit.register(print_profile)
 
     if hasattr(settings, 'ARP_BIN'):
         arp_bin = settings.ARP_BIN
@@ -142,48 +547,154 @@ if __name__ == '__main__':
     else:
         ping_bin = '/bin/ping'
 
-    if hasattr(settings, 'OWN_IP_ADDRESS'):
-        own_ip_address = settings.OWN_IP_ADDRESS
-    else:
-        own_ip_address = None
+    ping_options = {}
+    for setting, option in [('PING_TIMEOUT', 'timeout'),
+                            ('PING_RETRIES', 'retries'),
+                            ('PING_RATE', 'rate'),
+                            ('PING_CONCURRENCY', 'concurrency')]:
+        if hasattr(settings, setting):
+            ping_options[option] = getattr(settings, setting)
 
-    if hasattr(settings, 'OWN_MAC_ADDRESS'):
-        own_mac_address = settings.OWN_MAC_ADDRESS
-    else:
-        own_mac_address = None
+    if args.update or args.daemon:
+        # Only worked out when there's going to be a scan
+        ip_networks = config.scan_networks(args.network)
+        ip_network = [str(network) for network in ip_networks]
+        own_ip_address = config.own_ip_address(ip_networks[0])
+        own_mac_address = config.own_mac_address(ip_networks[0])
+        scan_options = dict(ping_options,
+                            own_addresses=config.own_addresses(ip_networks))
 
     if args.trash_database:
         dev_track.drop_tables()
-        dev_track.init_tables()
+    # Picks up any tables added since the db was made
+    dev_track.init_tables()
+
+    if args.migrate_timeline:
+        time_line_rows, presence_rows = dev_track.migrate_time_line()
+        print('Migrated {} time_line rows into {} presence runs'.format(
+            time_line_rows, presence_rows
+        ))
+
+    scan_callbacks = []
+    if args.timings:
+        def print_timings(devices, timings):
+            pprint.pprint(timings)
+        scan_callbacks.append(print_timings)
+
+    passive = args.pcap or args.sniff is not None
+    if args.events and (args.update or args.daemon or passive):
+        import presence_events
+        if hasattr(settings, 'EVENT_JOIN_AFTER'):
+            join_after = settings.EVENT_JOIN_AFTER
+        else:
+            join_after = 1
+        if hasattr(settings, 'EVENT_LEAVE_AFTER'):
+            leave_after = settings.EVENT_LEAVE_AFTER
+        else:
+            leave_after = 2
+        change_detector = presence_events.ChangeDetector.from_db(
+            join_after, leave_after
+        )
+        event_publisher = presence_events.JsonLinesPublisher(args.events)
+
+        def publish_events(devices, timings):
+            event_publisher.publish(
+                change_detector.update(devices, timings['timestamp'])
+            )
+        scan_callbacks.append(publish_events)
+
+    if args.metrics:
+        def write_metrics(devices, timings):
+            metrics.write_prometheus(args.metrics)
+        scan_callbacks.append(write_metrics)
+
+    def on_scan(devices, timings):
+        for scan_callback in scan_callbacks:
+            scan_callback(devices, timings)
 
     if args.update:
-        devices = scan_add_and_update_macs(ip_network, ping_bin, arp_bin,
-                                           own_mac_address, own_ip_address)
-        timestamp = datetime.datetime.now()
-        dev_track.add_timestamp(timestamp)
-        for device in devices:
-            dev_track.add_device(device)
-            dev_track.add_device_on_timeline(device, timestamp)
+        timings = {}
+        devices = list(scan_add_and_update_macs(ip_network, ping_bin, arp_bin,
+                                                own_mac_address,
+                                                own_ip_address,
+                                                timings=timings,
+                                                **scan_options))
+        on_scan(devices, timings)
+
+    if args.daemon:
+        if args.interval is not None:
+            interval = args.interval
+        elif hasattr(settings, 'DAEMON_INTERVAL'):
+            interval = settings.DAEMON_INTERVAL
+        else:
+            interval = DAEMON_INTERVAL
+
+        if args.jitter is not None:
+            jitter = args.jitter
+        elif hasattr(settings, 'DAEMON_JITTER'):
+            jitter = settings.DAEMON_JITTER
+        else:
+            jitter = DAEMON_JITTER
+
+        run_daemon(ip_network, ping_bin, arp_bin, own_mac_address,
+                   own_ip_address, interval, jitter, on_scan=on_scan,
+                   **scan_options)
+
+    if passive:
+        import passive_scanner
+        window = args.window
+        for fname in args.pcap or []:
+            if fname == '-':
+                passive_scanner.record_scans(
+                    passive_scanner.iter_capture_sightings(sys.stdin.buffer),
+                    window, on_scan
+                )
+            else:
+                with open(fname, 'rb') as f:
+                    passive_scanner.record_scans(
+                        passive_scanner.iter_capture_sightings(f),
+                        window, on_scan
+                    )
+        if args.sniff is not None:
+            try:
+                passive_scanner.record_scans(
+                    passive_scanner.iter_live_sightings(args.sniff or None),
+                    window, on_scan
+                )
+            except KeyboardInterrupt:
+                pass
+
+    if args.prune:
+        import retention
+        pprint.pprint(retention.prune())
 
     # TODO - make a better printer
+    history_range = (args.since, args.until)
+
     if args.history_mac:
-        history = dev_track.get_device_history_mac_string(args.history_mac)
+        history = dev_track.get_device_history_mac_string(args.history_mac,
+                                                          history_range)
         pprint.pprint(history)
 
     if args.history_name:
-        history = dev_track.get_device_history_mac_string(args.history_name)
+        history = dev_track.get_device_history_name(args.history_name,
+                                                    history_range)
         pprint.pprint(history)
 
     if args.add_name:
         dev_track.add_device_name_mac(*args.add_name)
 
     if args.list or args.add_name:
+        all_devices = dev_track.all_devices()
+        organisations = mac_org.search_by_mac_addresses(
+            device[1] for device in all_devices
+        )
         devices = []
-        for device in dev_track.all_devices():
+        for device, (mac_int, orgs) in zip(all_devices, organisations):
             devices.append({
-                'mac_address': u.int_mac_to_hex_mac(device[1]),
+                'mac_address': u.int_mac_to_hex_mac(mac_int),
                 'last_hostname': device[2],
                 'name': device[3],
-                'organisation': mac_org.search_by_mac_address_int(device[1]),
+                'organisation': orgs,
             })
         pprint.pprint(devices)
@@ -1,9 +1,13 @@
-import settings
-import sqlite3
+from config import settings
+import mac_codec
+import mac_db
+import metrics
+import datetime
+import itertools
 import my_utils as u
 
 def init_tables():
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         CREATE TABLE IF NOT EXISTS device (
@@ -14,6 +18,19 @@ def init_tables():
         UNIQUE (device_mac_addr) ON CONFLICT IGNORE
         );
         ''')
+        # Other macs a device has turned up with, for phones that pick a new
+        # randomised one every so often, see _alias_random_macs()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS device_alias (
+        alias_mac_addr   INTEGER  PRIMARY KEY  NOT NULL,
+        alias_device_id  INTEGER  NOT NULL,
+        FOREIGN KEY (alias_device_id) REFERENCES device(device_id)
+        );
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS device_last_hostname
+            ON device (device_last_hostname);
+        ''')
         c.execute('''
         CREATE TABLE IF NOT EXISTS time_line (
         time_line_id             INTEGER  PRIMARY KEY  NOT NULL,
@@ -30,23 +47,58 @@ def init_tables():
         UNIQUE (time_stamp_datetime) ON CONFLICT IGNORE
         );
         ''')
+        # time_stamp_datetime is already indexed by its UNIQUE constraint
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS time_line_device_time_stamp
+            ON time_line (time_line_device_id, time_line_time_stamp_id);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS time_line_time_stamp_device
+            ON time_line (time_line_time_stamp_id, time_line_device_id);
+        ''')
+        # Each row is a run of scans the device was seen in, see
+        # _extend_presence()
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS presence (
+        presence_id          INTEGER    PRIMARY KEY  NOT NULL,
+        presence_device_id   INTEGER    NOT NULL,
+        presence_first_seen  TIMESTAMP  NOT NULL,
+        presence_last_seen   TIMESTAMP  NOT NULL,
+        FOREIGN KEY (presence_device_id) REFERENCES device(device_id)
+        );
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS presence_device_last_seen
+            ON presence (presence_device_id, presence_last_seen);
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS presence_last_seen
+            ON presence (presence_last_seen);
+        ''')
 
 
 def drop_tables():
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         DROP TABLE IF EXISTS device;
         ''')
         c.execute('''
+        DROP TABLE IF EXISTS device_alias;
+        ''')
+        c.execute('''
         DROP TABLE IF EXISTS time_line;
         ''')
         c.execute('''
         DROP TABLE IF EXISTS time_stamp;
         ''')
+        c.execute('''
+        DROP TABLE IF EXISTS presence;
+        ''')
 
+@metrics.timed('device_tracker.add_device')
 def add_device(device):
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         INSERT INTO device (device_mac_addr) VALUES (?)
@@ -61,108 +113,645 @@ def add_device_name_mac(device_mac_str, dev_name):
     mac_int = u.hex_str_to_int(device_mac_str)
     add_device_name_int(mac_int, dev_name)
 
+@metrics.timed('device_tracker.add_device_name_int')
 def add_device_name_int(mac_addr, dev_name):
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
+        device_id = _device_id(c, mac_addr)
         c.execute('''
         UPDATE device
-        SET device_name = ? WHERE device_mac_addr = ?
-        ''', (dev_name, mac_addr))
+        SET device_name = ? WHERE device_id = ?
+        ''', (dev_name, device_id))
 
 def all_devices():
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         SELECT * FROM device
         ''')
         return c.fetchall()
 
+@metrics.timed('device_tracker.add_timestamp')
 def add_timestamp(time):
-    with sqlite3.connect(settings.MAC_DB_FNAME, detect_types=sqlite3.PARSE_DECLTYPES) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         INSERT INTO time_stamp (time_stamp_datetime) VALUES (?);
         ''', (time,))
 
+@metrics.timed('device_tracker.add_device_on_timeline')
 def add_device_on_timeline(device, timestamp):
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
+        device_id = _device_id(c, device['mac_int'])
+        _extend_presence(c, [device_id], timestamp)
+
+def _scans_either_side(c, timestamp):
+    """
+    returns the times of the scans just before and just after timestamp,
+    None where there isn't one
+    """
+    c.execute('''
+    SELECT time_stamp_datetime FROM time_stamp
+    WHERE time_stamp_datetime < ?
+    ORDER BY time_stamp_datetime DESC LIMIT 1
+    ''', (timestamp,))
+    previous_scan = c.fetchone()
+    c.execute('''
+    SELECT time_stamp_datetime FROM time_stamp
+    WHERE time_stamp_datetime > ?
+    ORDER BY time_stamp_datetime LIMIT 1
+    ''', (timestamp,))
+    next_scan = c.fetchone()
+    return (previous_scan[0] if previous_scan else None,
+            next_scan[0] if next_scan else None)
+
+def _join_runs(c, earlier_id, later_id, last_seen):
+    """
+    Stretches run earlier_id to last_seen, the end of later_id, which goes
+    """
+    c.execute('''
+    UPDATE presence SET presence_last_seen = ? WHERE presence_id = ?
+    ''', (last_seen, earlier_id))
+    c.execute('''
+    DELETE FROM presence WHERE presence_id = ?
+    ''', (later_id,))
+
+def _bridges(earlier, later, previous_scan=None):
+    """
+    True if a device seen at earlier and again at later was there the whole
+    time, previous_scan being the last scan before later, or they're within
+    PRESENCE_GAP_TOLERANCE of each other
+    """
+    return ((previous_scan is not None and earlier >= previous_scan) or
+            later - earlier <= settings.PRESENCE_GAP_TOLERANCE)
+
+def _split_runs_at(c, timestamp, previous_scan, next_scan):
+    """
+    A scan has been added at timestamp, in between two that were already
+    there, so runs spanning it have to be split at it: nobody has been seen
+    in it yet. The devices that were get joined back up by
+    _extend_presence().
+    """
+    if _bridges(previous_scan, next_scan):
+        return
+    c.execute('''
+    SELECT presence_id, presence_device_id, presence_last_seen FROM presence
+    WHERE presence_last_seen > ? AND presence_first_seen < ?
+    ''', (timestamp, timestamp))
+    runs = c.fetchall()
+    c.executemany('''
+    UPDATE presence SET presence_last_seen = ? WHERE presence_id = ?
+    ''', [(previous_scan, presence_id) for presence_id, _, _ in runs])
+    c.executemany('''
+    INSERT INTO presence
+        (presence_device_id, presence_first_seen, presence_last_seen)
+    VALUES (?, ?, ?)
+    ''', [(device_id, next_scan, last_seen)
+          for _, device_id, last_seen in runs])
+
+def _extend_past_presence(c, device_id, timestamp, previous_scan, next_scan):
+    """
+    _extend_presence() for a scan older than the latest one, which can join
+    the runs either side of it
+    """
+    c.execute('''
+    SELECT presence_id FROM presence
+    WHERE presence_device_id = ? AND presence_last_seen >= ? AND
+          presence_first_seen <= ?
+    ORDER BY presence_last_seen LIMIT 1
+    ''', (device_id, timestamp, timestamp))
+    if c.fetchone():
+        # Already recorded as seen in this scan
+        return
+    c.execute('''
+    SELECT presence_id, presence_last_seen FROM presence
+    WHERE presence_device_id = ? AND presence_last_seen < ?
+    ORDER BY presence_last_seen DESC LIMIT 1
+    ''', (device_id, timestamp))
+    before = c.fetchone()
+    c.execute('''
+    SELECT presence_id, presence_first_seen, presence_last_seen FROM presence
+    WHERE presence_device_id = ? AND presence_first_seen > ?
+    ORDER BY presence_first_seen LIMIT 1
+    ''', (device_id, timestamp))
+    after = c.fetchone()
+
+    joins_before = before and _bridges(before[1], timestamp, previous_scan)
+    joins_after = after and (after[1] <= next_scan or
+                             _bridges(timestamp, after[1]))
+    if joins_before and joins_after:
+        _join_runs(c, before[0], after[0], after[2])
+    elif joins_before:
         c.execute('''
-        INSERT INTO time_line
-            (time_line_device_id,
-             time_line_time_stamp_id)
-        VALUES (
-            (SELECT device_id FROM device WHERE device_mac_addr=?),
-            (SELECT time_stamp_id FROM time_stamp WHERE time_stamp_datetime=?)
-        );
-        ''', (device['mac_int'], timestamp,))
-        return c.lastrowid
+        UPDATE presence SET presence_last_seen = ? WHERE presence_id = ?
+        ''', (timestamp, before[0]))
+    elif joins_after:
+        c.execute('''
+        UPDATE presence SET presence_first_seen = ? WHERE presence_id = ?
+        ''', (timestamp, after[0]))
+    else:
+        c.execute('''
+        INSERT INTO presence
+            (presence_device_id, presence_first_seen, presence_last_seen)
+        VALUES (?, ?, ?)
+        ''', (device_id, timestamp, timestamp))
 
-def get_device_history_mac_string(device_mac_str, datetime_range=()):
-    mac_int = u.hex_str_to_int(device_mac_str)
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+def _extend_presence(c, device_ids, timestamp):
+    """
+    Marks device_ids as seen in the scan at timestamp. A device's latest
+    run of sightings is extended if it was seen in the scan before this one,
+    or within PRESENCE_GAP_TOLERANCE, otherwise a new run is started.
+
+    Scans older than the latest one (a capture read in after the fact, say)
+    go through _extend_past_presence() instead.
+    """
+    previous_scan, next_scan = _scans_either_side(c, timestamp)
+    if next_scan is not None:
+        for device_id in device_ids:
+            _extend_past_presence(c, device_id, timestamp, previous_scan,
+                                  next_scan)
+        return
+
+    device_ids = list(device_ids)
+    latest = {}
+    for device_id in device_ids:
+        # One index lookup each, rather than anything that has to look at
+        # every run the device has ever had
+        c.execute('''
+        SELECT presence_id, presence_last_seen FROM presence
+        WHERE presence_device_id = ?
+        ORDER BY presence_last_seen DESC LIMIT 1
+        ''', (device_id,))
+        row = c.fetchone()
+        if row:
+            latest[device_id] = row
+
+    extended = []
+    started = []
+    for device_id in device_ids:
+        if device_id not in latest:
+            started.append((device_id, timestamp, timestamp))
+            continue
+        presence_id, last_seen = latest[device_id]
+        if last_seen >= timestamp:
+            # Already recorded as seen in this scan
+            continue
+        if _bridges(last_seen, timestamp, previous_scan):
+            extended.append((timestamp, presence_id))
+        else:
+            started.append((device_id, timestamp, timestamp))
+    c.executemany('''
+    UPDATE presence SET presence_last_seen = ? WHERE presence_id = ?
+    ''', extended)
+    c.executemany('''
+    INSERT INTO presence
+        (presence_device_id, presence_first_seen, presence_last_seen)
+    VALUES (?, ?, ?)
+    ''', started)
+
+@metrics.timed('device_tracker.migrate_time_line')
+def migrate_time_line():
+    """
+    Turns the old one row per device per scan time_line into presence runs,
+    emptying time_line as it goes
+
+    returns (time_line rows, presence rows made from them)
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
-        SELECT device_id FROM device WHERE device_mac_addr=?
-        ''', (mac_int,))
-        device_id = c.fetchone()
-    try:
-        device_id = device_id[0]
-    except TypeError:
+        SELECT time_stamp_id FROM time_stamp ORDER BY time_stamp_datetime
+        ''')
+        scan_numbers = {
+            time_stamp_id: scan_number
+            for scan_number, (time_stamp_id,) in enumerate(c.fetchall())
+        }
+        c.execute('''
+        SELECT DISTINCT time_line_device_id, time_stamp_id,
+               time_stamp_datetime
+        FROM time_line JOIN time_stamp
+            ON time_line_time_stamp_id = time_stamp_id
+        ORDER BY time_line_device_id, time_stamp_datetime
+        ''')
+        tolerance = settings.PRESENCE_GAP_TOLERANCE
+        runs = []
+        time_line_rows = 0
+        for device_id, rows in itertools.groupby(c.fetchall(),
+                                                 key=lambda row: row[0]):
+            run = None
+            for _, time_stamp_id, time_stamp in rows:
+                time_line_rows += 1
+                scan_number = scan_numbers[time_stamp_id]
+                if run and (scan_number == run[3] + 1 or
+                            time_stamp - run[2] <= tolerance):
+                    run[2:] = [time_stamp, scan_number]
+                else:
+                    run = [device_id, time_stamp, time_stamp, scan_number]
+                    runs.append(run)
+        c.executemany('''
+        INSERT INTO presence
+            (presence_device_id, presence_first_seen, presence_last_seen)
+        VALUES (?, ?, ?)
+        ''', [run[:3] for run in runs])
+        c.execute('''
+        DELETE FROM time_line
+        ''')
+    return time_line_rows, len(runs)
+
+def _device_id(c, mac_int):
+    """
+    returns the id of the device with mac_int as its mac or one of its
+    aliases, or None
+    """
+    c.execute('''
+    SELECT device_id FROM device WHERE device_mac_addr = ?
+    UNION ALL
+    SELECT alias_device_id FROM device_alias WHERE alias_mac_addr = ?
+    ''', (mac_int, mac_int))
+    device_id = c.fetchone()
+    return device_id[0] if device_id else None
+
+def _device_ids(c, mac_ints):
+    """
+    returns {mac_int: device_id} of the known ones of mac_ints, like
+    _device_id()
+    """
+    device_ids = {}
+    # Stay under sqlite's default limit of 999 variables, each chunk is
+    # used twice
+    for pos in range(0, len(mac_ints), 450):
+        chunk = mac_ints[pos:pos+450]
+        c.execute('''
+        SELECT device_mac_addr, device_id FROM device
+            WHERE device_mac_addr IN ({0})
+        UNION ALL
+        SELECT alias_mac_addr, alias_device_id FROM device_alias
+            WHERE alias_mac_addr IN ({0})
+        '''.format(','.join('?' * len(chunk))), chunk + chunk)
+        device_ids.update(c.fetchall())
+    return device_ids
+
+def _alias_hostname(device):
+    """
+    returns the hostname a randomised mac can be tied to the device's other
+    macs by, or None if it hasn't got a real one
+    """
+    hostname = device.get('hostname')
+    # arp's '?', or the ip when the name didn't resolve, could be anyone
+    if not hostname or hostname in ('?', device.get('ip')):
+        return None
+    return hostname
+
+def _alias_random_macs(c, devices, device_ids):
+    """
+    Phones pick a new randomised (locally administered) mac every so often,
+    so rather than each one becoming a new device, a new randomised mac is
+    made an alias of whichever device last had the same hostname on a
+    randomised mac. Adds them to device_ids.
+    """
+    owners = {}
+    for device in devices:
+        mac_int = device['mac_int']
+        if (mac_int in device_ids or
+                not mac_codec.is_locally_administered(mac_int)):
+            continue
+        hostname = _alias_hostname(device)
+        if hostname is None:
+            continue
+        if hostname not in owners:
+            # Bit 41 is the locally administered bit of the first octet
+            c.execute('''
+            SELECT device_id FROM device
+                WHERE device_last_hostname = ? AND device_mac_addr >> 41 & 1
+            ORDER BY device_id DESC LIMIT 1
+            ''', (hostname,))
+            owner = c.fetchone()
+            owners[hostname] = owner[0] if owner else None
+        if owners[hostname] is None:
+            # First time the name's been seen on a randomised mac, so this
+            # one becomes the device any others are aliases of
+            c.execute('''
+            INSERT INTO device (device_mac_addr) VALUES (?)
+            ''', (mac_int,))
+            owners[hostname] = c.lastrowid
+        else:
+            c.execute('''
+            INSERT INTO device_alias (alias_mac_addr, alias_device_id)
+            VALUES (?, ?)
+            ''', (mac_int, owners[hostname]))
+        device_ids[mac_int] = owners[hostname]
+
+@metrics.timed('device_tracker.record_scan')
+def record_scan(timestamp, devices):
+    """
+    Saves a whole scan's worth of devices seen at timestamp in one
+    transaction, devices being dicts with 'mac_int' and 'hostname'. A
+    hostname of None leaves the one saved before alone. New randomised macs
+    are grouped with the device's earlier ones by hostname, see
+    _alias_random_macs().
+
+    Can be called again with the same timestamp to add more devices to it,
+    and timestamp can be older than the latest scan.
+    returns {mac_int: device_id}
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.execute('''
+        INSERT INTO time_stamp (time_stamp_datetime) VALUES (?);
+        ''', (timestamp,))
+        if c.rowcount:
+            previous_scan, next_scan = _scans_either_side(c, timestamp)
+            if previous_scan is not None and next_scan is not None:
+                _split_runs_at(c, timestamp, previous_scan, next_scan)
+        if not devices:
+            return {}
+
+        mac_ints = list({device['mac_int'] for device in devices})
+        device_ids = _device_ids(c, mac_ints)
+        if len(device_ids) < len(mac_ints):
+            _alias_random_macs(c, devices, device_ids)
+            new_mac_ints = [mac_int for mac_int in mac_ints
+                            if mac_int not in device_ids]
+            c.executemany('''
+            INSERT INTO device (device_mac_addr) VALUES (?)
+            ''', [(mac_int,) for mac_int in new_mac_ints])
+            device_ids.update(_device_ids(c, new_mac_ints))
+
+        c.executemany('''
+        UPDATE device
+        SET device_last_hostname = COALESCE(?, device_last_hostname)
+            WHERE device_id = ?
+        ''', [(device['hostname'], device_ids[device['mac_int']])
+              for device in devices])
+
+        _extend_presence(c, set(device_ids.values()), timestamp)
+    return device_ids
+
+def discard_scan(timestamp):
+    """
+    Takes the scan at timestamp back out, for one that was stopped part way
+    through. Runs that started or ended with it are cut back to the scans
+    either side of it, and runs that only ended because of it are joined
+    back up.
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.execute('''
+        DELETE FROM time_stamp WHERE time_stamp_datetime = ?
+        ''', (timestamp,))
+        previous_scan, next_scan = _scans_either_side(c, timestamp)
+        c.execute('''
+        DELETE FROM presence
+        WHERE presence_first_seen = ? AND presence_last_seen = ?
+        ''', (timestamp, timestamp))
+        c.execute('''
+        UPDATE presence SET presence_first_seen = ?
+        WHERE presence_first_seen = ?
+        ''', (next_scan, timestamp))
+        c.execute('''
+        UPDATE presence SET presence_last_seen = ?
+        WHERE presence_last_seen = ?
+        ''', (previous_scan, timestamp))
+        if previous_scan is None or next_scan is None:
+            return
+        # With nothing between them any more, a device seen in both of the
+        # scans either side was there the whole time
+        c.execute('''
+        SELECT earlier.presence_id, later.presence_id, later.presence_last_seen
+        FROM presence AS earlier
+        INNER JOIN presence AS later
+        ON later.presence_device_id = earlier.presence_device_id
+        WHERE earlier.presence_last_seen = ? AND later.presence_first_seen = ?
+        ''', (previous_scan, next_scan))
+        for earlier_id, later_id, last_seen in c.fetchall():
+            _join_runs(c, earlier_id, later_id, last_seen)
+
+def get_last_scan_time():
+    """
+    returns the timestamp of the latest scan, or None if there aren't any
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT time_stamp_datetime FROM time_stamp
+        ORDER BY time_stamp_datetime DESC LIMIT 1
+        ''')
+        last_scan = c.fetchone()
+    return last_scan[0] if last_scan else None
+
+def get_recent_sightings(scans):
+    """
+    Devices seen in any of the last `scans` scans
+
+    returns [(device, scans_since_seen, run_scans)] where scans_since_seen
+    is how many of those scans came after it was last seen, and run_scans
+    how many scans its latest run of sightings covers
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT time_stamp_datetime FROM time_stamp
+        ORDER BY time_stamp_datetime DESC LIMIT ?
+        ''', (scans,))
+        recent_scans = [time_stamp for time_stamp, in c.fetchall()]
+        if not recent_scans:
+            return []
+        c.execute('''
+        SELECT device.*, presence_first_seen, presence_last_seen
+        FROM presence JOIN device ON presence_device_id = device_id
+        WHERE presence_last_seen >= ?
+        ORDER BY presence_last_seen
+        ''', (recent_scans[-1],))
+        # Ordered so each device ends up with its latest run
+        latest_runs = {row[0]: row for row in c.fetchall()}
+
+        sightings = []
+        for row in latest_runs.values():
+            first_seen, last_seen = row[-2:]
+            c.execute('''
+            SELECT COUNT(*) FROM time_stamp
+            WHERE time_stamp_datetime >= ? AND time_stamp_datetime <= ?
+            ''', (first_seen, last_seen))
+            run_scans = c.fetchone()[0]
+            scans_since_seen = sum(
+                1 for time_stamp in recent_scans if time_stamp > last_seen
+            )
+            sightings.append((row[:-2], scans_since_seen, run_scans))
+    return sightings
+
+def get_device_id(mac_int):
+    """
+    returns the id of the device with mac_int as its mac or one of its
+    aliases, or None if it's never been seen
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        return _device_id(c, mac_int)
+
+def get_device_ids(mac_ints):
+    """
+    returns {mac_int: device id} of those of mac_ints that have been seen,
+    like get_device_id()
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        return _device_ids(c, list(mac_ints))
+
+def get_device_history_mac_string(device_mac_str, datetime_range=()):
+    device_id = get_device_id(u.hex_str_to_int(device_mac_str))
+    if device_id is None:
         # Device mac not found probably
         return []
     return _get_device_history_id(device_id, datetime_range)
 
 def get_device_history_name(device_name, datetime_range=()):
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
         SELECT device_id FROM device WHERE device_name=?
         ''', (device_name,))
         device_id = c.fetchone()
-    return _get_device_history_id(device_id, datetime_date)
+    if device_id is None:
+        return []
+    return _get_device_history_id(device_id[0], datetime_range)
+
+def _datetime_range_clause(datetime_range):
+    """
+    datetime_range is (since, until), either of which can be None for no
+    limit, or empty for all time
+
+    returns (sql condition on time_stamp_datetime, parameters)
+    """
+    since, until = tuple(datetime_range) + (None,) * (2 - len(datetime_range))
+    conditions = ['1']
+    params = []
+    if since is not None:
+        conditions.append('time_stamp_datetime >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('time_stamp_datetime <= ?')
+        params.append(until)
+    return ' AND '.join(conditions), params
 
 def get_all_device_history(datetime_range=()):
-    with sqlite3.connect(settings.MAC_DB_FNAME) as conn:
+    return list(iter_all_device_history(datetime_range))
+
+def _presence_timeline(time_stamps, runs):
+    """
+    time_stamps and runs of (first_seen, last_seen) both oldest first
+    returns [(timestamp, present)]
+    """
+    timeline = []
+    runs = iter(runs)
+    run = next(runs, None)
+    for time_stamp in time_stamps:
+        while run is not None and run[1] < time_stamp:
+            run = next(runs, None)
+        timeline.append(
+            (time_stamp, run is not None and run[0] <= time_stamp)
+        )
+    return timeline
+
+def _runs_range_clause(datetime_range):
+    # Runs that overlap the range at all
+    since, until = tuple(datetime_range) + (None,) * (2 - len(datetime_range))
+    conditions = ['1']
+    params = []
+    if since is not None:
+        conditions.append('presence_last_seen >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('presence_first_seen <= ?')
+        params.append(until)
+    return ' AND '.join(conditions), params
+
+def _scan_times(c, datetime_range):
+    range_clause, range_params = _datetime_range_clause(datetime_range)
+    c.execute('''
+    SELECT time_stamp_datetime FROM time_stamp
+    WHERE {}
+    ORDER BY time_stamp_datetime
+    '''.format(range_clause), range_params)
+    return [time_stamp for time_stamp, in c.fetchall()]
+
+def get_device_runs(device_id, datetime_range=()):
+    """
+    returns [(first_seen, last_seen)] of the runs of scans device_id was seen
+    in that overlap datetime_range, oldest first
+    """
+    range_clause, range_params = _runs_range_clause(datetime_range)
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
         c.execute('''
-        SELECT * FROM device
-        ''')
-        all_devices =  c.fetchall()
-    return [
-        (device, _get_device_history_id(device[0]))
-        for device in all_devices
-    ]
+        SELECT presence_first_seen, presence_last_seen FROM presence
+        WHERE presence_device_id = ? AND {}
+        ORDER BY presence_last_seen
+        '''.format(range_clause), [device_id] + range_params)
+        return c.fetchall()
 
-def _get_device_history_id(device_id, datetime_range=()):
-    with sqlite3.connect(settings.MAC_DB_FNAME, detect_types=sqlite3.PARSE_DECLTYPES) as conn:
+def iter_all_device_runs(datetime_range=()):
+    """
+    Generator of (device, runs) for every device, runs being as from
+    get_device_runs
+    """
+    range_clause, range_params = _runs_range_clause(datetime_range)
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
         c = conn.cursor()
-        if datetime_range:
-            # TODO - Actually implement a date range - currently just going
-            #        to return all dates even if a datetime range is set
-            return []
-        else:
-            c.execute('''
-            SELECT time_stamp_datetime FROM time_stamp
-            ''')
-            time_stamps = c.fetchall()
+        c.execute('''
+        SELECT * FROM device ORDER BY device_id
+        ''')
+        all_devices = c.fetchall()
+        c.execute('''
+        SELECT presence_device_id, presence_first_seen, presence_last_seen
+        FROM presence
+        WHERE {}
+        ORDER BY presence_device_id, presence_last_seen
+        '''.format(range_clause), range_params)
+        runs_by_device = itertools.groupby(c, key=lambda row: row[0])
+        device_id, rows = next(runs_by_device, (None, ()))
+        for device in all_devices:
+            # Both are in device_id order, so just walk along them together
+            while device_id is not None and device_id < device[0]:
+                device_id, rows = next(runs_by_device, (None, ()))
+            if device_id == device[0]:
+                yield device, [row[1:] for row in rows]
+            else:
+                yield device, []
 
-            c.execute('''
-            SELECT time_stamp_datetime FROM
-                time_line JOIN time_stamp
-                ON (time_line.time_line_time_stamp_id = time_stamp.time_stamp_id)
-                WHERE (time_line.time_line_device_id=?)
-            ''', (device_id,))
-            device_present_timestamps = c.fetchall()
+def get_presence_changes(datetime_range=()):
+    """
+    returns {device_id: (latest last_seen, number of runs)} of the runs that
+    overlap datetime_range, which changes whenever any of them do. last_seen
+    is as stored, sqlite doesn't convert aggregates.
+    """
+    range_clause, range_params = _runs_range_clause(datetime_range)
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT presence_device_id, MAX(presence_last_seen), COUNT(*)
+        FROM presence
+        WHERE {}
+        GROUP BY presence_device_id
+        '''.format(range_clause), range_params)
+        return {row[0]: row[1:] for row in c.fetchall()}
 
+def iter_all_device_history(datetime_range=()):
+    """
+    Generator of (device, history) for every device, the scan times are only
+    read once for all of them
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        time_stamps = _scan_times(conn.cursor(), datetime_range)
+    for device, runs in iter_all_device_runs(datetime_range):
+        yield device, _presence_timeline(time_stamps, runs)
 
-    # TODO - Do this part with the database too - it's probably horifically
-    #        inefficient
-    device_timeline = []
-    for time_stamp in time_stamps:
-        if time_stamp in device_present_timestamps:
-            device_timeline.append((time_stamp[0], True))
-        else:
-            device_timeline.append((time_stamp[0], False))
-    device_timeline.sort(key=lambda x: x[0])
-    return device_timeline
+def _get_device_history_id(device_id, datetime_range=()):
+    """
+    returns [(timestamp, present)] for every scan in datetime_range,
+    oldest first
+    """
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        time_stamps = _scan_times(conn.cursor(), datetime_range)
+    return _presence_timeline(time_stamps,
+                              get_device_runs(device_id, datetime_range))
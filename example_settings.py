@@ -3,32 +3,53 @@ ARP_BIN = '/usr/sbin/arp'
 
 MAC_DB_FNAME = 'mac.db'
 
-IP_NETWORK = '192.168.1.0/24'  # In CIDR format
-
-PING_BIN = '/bin/ping'
-
-# Beacuse arp will often not find you in the arp cache, we need a helping hand
-#  pickup out ourselves
-import socket
-import fcntl
-import struct
-
-def get_own_ip_address_hostname():
-    # Often just returns '127.0.0.1', depending on how /etc/hosts is set up
-    return socket.gethostbyname(socket.gethostname())
-
-def get_own_ip_address_connect():
-    # Will only work if device has internet connection
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('8.8.8.8', 80))
-    ip_addr = s.getsockname()[0]
-    s.close()
-    return ip_addr
-
-def get_mac_address(ifname):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    info = fcntl.ioctl(s.fileno(), 0x8927,  struct.pack('256s', ifname[:15]))
-    return ''.join(['%02x:' % ord(char) for char in info[18:24]])[:-1]
-
-OWN_IP_ADDRESS = get_own_ip_address_connect()
-OWN_MAC_ADDRESS = get_mac_address(OWN_IP_ADDRESS)
+# In CIDR format, or an interface name to scan whatever network it's on.
+# Can also be a list of them, which are all scanned at once.
+IP_NETWORK = '192.168.1.0/24'
+
+DAEMON_INTERVAL = 300  # Seconds between scans with --daemon
+
+DAEMON_JITTER = 10  # Seconds either side of that each scan can start
+
+# With --events, scans in a row a device has to be seen in before it joins,
+# and missing from before it leaves
+EVENT_JOIN_AFTER = 1
+EVENT_LEAVE_AFTER = 2
+
+PING_BIN = '/bin/ping'  # Only used if ICMP sockets aren't allowed
+
+PING_TIMEOUT = 1.0  # Seconds to wait for each reply
+
+PING_RETRIES = 1  # Extra tries for hosts that didn't answer
+
+PING_RATE = None  # Max pings sent per second, None for no limit
+
+PING_CONCURRENCY = None  # Max pings in flight, None for the prober's max
+
+# Seconds of passively sniffed traffic (--pcap/--sniff) saved as each scan
+PASSIVE_WINDOW = 60
+
+QUERY_SERVER_HOST = '127.0.0.1'  # Where query_server.py listens
+
+QUERY_SERVER_PORT = 8080
+
+GRAPH_CACHE_FNAME = 'graph_cache.pickle'  # Strips kept by graph_drawing.py
+
+# How long a device can go missing from scans and still count as having been
+# there the whole time, at least the time between active scans if passive
+# scanning is running too
+import datetime
+PRESENCE_GAP_TOLERANCE = datetime.timedelta(0)
+
+# What --prune keeps: every scan for RAW_RETENTION, then one scan per
+# ROLLUP_INTERVAL until ROLLUP_RETENTION, and nothing older
+RAW_RETENTION = datetime.timedelta(days=7)
+ROLLUP_INTERVAL = datetime.timedelta(hours=1)
+ROLLUP_RETENTION = datetime.timedelta(days=365)
+
+# Because arp will often not find you in the arp cache, the scanner needs to
+# know your own ip and mac address. They're worked out from whichever
+# interface leads to IP_NETWORK, only when a scan is run (see config.py), so
+# these are only needed to override that.
+# OWN_IP_ADDRESS = '192.168.1.2'
+# OWN_MAC_ADDRESS = 'aa:bb:cc:dd:ee:ff'
@@ -1,30 +1,318 @@
-import matplotlib.pyplot as plt
+#!/usr/bin/env python3
+"""
+Draws when each device was around as one strip per device, time along the
+bottom.
+
+Each strip is a row of pixel columns, one per fixed bucket of time, worked
+out from the device's presence runs. Strips are cached between runs along
+with what the device's runs looked like when they were made, so redrawing
+every minute only recomputes the devices that were seen since last time,
+and doesn't redraw at all if none were and the window hasn't moved on by a
+bucket.
+
+The labels and the time axis (in hours before the end, so it still fits
+once the window has moved on) are drawn with matplotlib and cached too, and
+only drawn again when the devices or the size change. Otherwise the strips
+are painted straight into that and written out, which takes milliseconds.
+"""
+
+import argparse
+import datetime
+import os
+import pickle
+import struct
+import zlib
+
+import numpy as np
+
+from config import settings
+import mac_codec
 import device_tracker as dev_track
 import my_utils as u
 
-if __name__ == '__main__':
-    # We'll just plot the lot of them to begin with
-    device_histories = dev_track.get_all_device_history()
-    f, axarr = plt.subplots(len(device_histories), sharex=True)
-
-    for n, (device, device_history) in enumerate(device_histories):
-        timeline, present = zip(*device_history)
-        if device[3]:
-            # Device name is present
-            axarr[n].set_title('{}'.format(device[3]))
+# Pixel columns across the plot, each one a bucket of time
+GRAPH_WIDTH = 1000
+
+# Inches per device strip
+STRIP_HEIGHT = 0.3
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _seconds(when):
+    return int((when - _EPOCH).total_seconds())
+
+
+def _device_label(device):
+    if device[3]:
+        # Device name is present
+        return device[3]
+    # Using device mac
+    return u.int_mac_to_hex_mac(device[1])
+
+
+def _strip(runs, bucket_seconds, first_bucket, last_bucket):
+    """
+    runs is [(first_seen, last_seen)] oldest first, which never overlap
+    returns a bool array of whether the device was around at any time in each
+    bucket from first_bucket up to last_bucket
+    """
+    lefts = np.arange(first_bucket, last_bucket, dtype=np.int64)
+    lefts *= bucket_seconds
+    if not runs:
+        return np.zeros(len(lefts), dtype=bool)
+    seen = np.array(runs, dtype='datetime64[s]').astype(np.int64)
+    firsts, lasts = seen[:, 0], seen[:, 1]
+    # Runs are in order and don't overlap, so the last one to start before a
+    # bucket ends is the only one that can still be going in it
+    latest = np.searchsorted(firsts, lefts + bucket_seconds) - 1
+    return (latest >= 0) & (lasts[np.maximum(latest, 0)] >= lefts)
+
+
+def _new_cache():
+    return {'strips': {}, 'image': None, 'frame': None}
+
+
+def _load_cache(cache_fname):
+    try:
+        with open(cache_fname, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return _new_cache()
+    # Caches from before the frame was kept
+    cache.setdefault('frame', None)
+    return cache
+
+
+def _save_cache(cache, cache_fname):
+    tmp_fname = cache_fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, cache_fname)
+
+
+def _select_devices(devices, device_filter):
+    """
+    device_filter is names and/or mac addresses, or empty for all of them
+    """
+    if not device_filter:
+        return devices
+    names = set(device_filter)
+    macs = set()
+    for device in device_filter:
+        if mac_codec.is_valid_mac(device):
+            macs.add(mac_codec.parse_mac(device))
+    return [device for device in devices
+            if device[3] in names or device[1] in macs]
+
+
+def presence_strips(since, until, devices=(), width=GRAPH_WIDTH,
+                    cache=None):
+    """
+    returns (bucket_seconds, first_bucket, [(device, strip)]) for the devices
+    seen between since and until, strips being from _strip()
+
+    Strips are reused from cache for devices whose runs haven't changed, and
+    cache is updated with any that had to be made.
+    """
+    if cache is None:
+        cache = _new_cache()
+    bucket_seconds = max(1, (_seconds(until) - _seconds(since)) // width)
+    # Buckets are lined up on the epoch rather than since, so they're the
+    # same buckets from one run to the next
+    first_bucket = _seconds(since) // bucket_seconds
+    last_bucket = _seconds(until) // bucket_seconds + 1
+
+    datetime_range = (since, until)
+    changes = dev_track.get_presence_changes(datetime_range)
+    # Don't keep strips for devices that have dropped out of the window
+    for device_id in set(cache['strips']) - set(changes):
+        del cache['strips'][device_id]
+    selected = _select_devices(dev_track.all_devices(), devices)
+    strips = []
+    for device in selected:
+        device_id = device[0]
+        if device_id not in changes:
+            continue
+        key = (bucket_seconds, changes[device_id])
+        cached = cache['strips'].get(device_id)
+        if (cached is not None and cached[0] == key and
+                cached[1] <= first_bucket):
+            _, cached_first, cached_strip = cached
+            strip = cached_strip[first_bucket - cached_first:
+                                 last_bucket - cached_first]
+            # Nothing's changed since it was made, so the device can't have
+            # been seen in any buckets after it
+            strip = np.pad(strip, (0, last_bucket - first_bucket - len(strip)))
         else:
-            # Using device mac
-            axarr[n].set_title('{}'.format(u.int_mac_to_hex_mac(device[1])))
-        axarr[n].plot(timeline, present, drawstyle='steps-mid')
-        axarr[n].fill_between(timeline, 0, present, step='mid')
-        axarr[n].tick_params(axis='both', which='both', bottom='off',
-                             top='off', left='off', right='off')
-    # Remove all Y axis lables
-    plt.setp([a.get_yticklabels() for a in f.axes], visible=False)
-
-    # Set X axis to angled
-    #plt.setp([a.get_xticklabels() for a in f.axes], rotation=45)
-    f.autofmt_xdate()
-
-    plt.tight_layout(pad=0.4)
-    plt.savefig('foo.png')
+            runs = dev_track.get_device_runs(device_id, datetime_range)
+            strip = _strip(runs, bucket_seconds, first_bucket, last_bucket)
+        cache['strips'][device_id] = (key, first_bucket, strip)
+        strips.append((device, strip))
+    return bucket_seconds, first_bucket, strips
+
+
+def _draw_frame(labels, window_seconds):
+    """
+    Draws everything but the strips: labels down the side and hours before
+    the end along the bottom
+    returns (rgb array of the image, (top, bottom, left, right) pixels of
+    where the strips go)
+    """
+    # Only imported when the frame has to be drawn again, it's most of the
+    # startup time otherwise. pyplot isn't needed at all.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import FuncFormatter
+
+    f = Figure(figsize=(10, 1 + STRIP_HEIGHT * max(len(labels), 1)))
+    canvas = FigureCanvasAgg(f)
+    ax = f.add_subplot()
+    ax.set_xlim(-window_seconds / 3600, 0)
+    ax.set_ylim(max(len(labels), 1) - 0.5, -0.5)
+    ax.xaxis.set_major_formatter(FuncFormatter(
+        lambda hours, pos: '{:g}h'.format(-hours) if hours else 'now'
+    ))
+    ax.set_yticks(range(len(labels)))
+    ax.set_yticklabels(labels)
+    ax.tick_params(axis='both', which='both', length=0)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    f.tight_layout(pad=0.4)
+    canvas.draw()
+    rgb = np.array(canvas.buffer_rgba())[:, :, :3]
+    # Display coordinates go up from the bottom, rows go down from the top
+    left, bottom, right, top = ax.get_window_extent().extents
+    height = rgb.shape[0]
+    box = (int(round(height - top)), int(round(height - bottom)),
+           int(round(left)), int(round(right)))
+    return rgb, box
+
+
+def _paint_strips(frame, box, strips):
+    """
+    returns a copy of frame with strips (each a row of buckets) stretched
+    over box, present black and absent white
+    """
+    rgb = frame.copy()
+    top, bottom, left, right = box
+    if not strips or bottom <= top or right <= left:
+        return rgb
+    shades = np.where(np.vstack(strips), 0, 255).astype(np.uint8)
+    rows = np.arange(bottom - top) * shades.shape[0] // (bottom - top)
+    columns = np.arange(right - left) * shades.shape[1] // (right - left)
+    rgb[top:bottom, left:right] = shades[rows][:, columns, np.newaxis]
+    return rgb
+
+
+def _write_png(f, rgb):
+    """
+    Writes rgb (height x width x 3 uint8) to the binary file f as a png
+    """
+    def chunk(chunk_type, data):
+        return b''.join([
+            struct.pack('!I', len(data)), chunk_type, data,
+            struct.pack('!I', zlib.crc32(chunk_type + data)),
+        ])
+
+    height, width, _ = rgb.shape
+    # Each row starts with its filter type, 0 being none
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, -1)
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(chunk(b'IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0,
+                                       0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)))
+    f.write(chunk(b'IEND', b''))
+
+
+def _save_image(fname, rgb):
+    if not fname.lower().endswith('.png'):
+        # Anything else is left to matplotlib to work out from the name
+        import matplotlib.image
+        matplotlib.image.imsave(fname, rgb)
+        return
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        _write_png(f, rgb)
+    os.replace(tmp_fname, fname)
+
+
+def draw_presence(fname, since, until, devices=(), width=GRAPH_WIDTH,
+                  cache_fname=None, use_cache=True):
+    """
+    Draws the presence of devices (all of them if empty) between since and
+    until into fname, keeping what it can for next time in cache_fname
+    (GRAPH_CACHE_FNAME if None) unless use_cache is False
+
+    returns False if nothing had changed so fname was left alone
+    """
+    if cache_fname is None:
+        cache_fname = settings.GRAPH_CACHE_FNAME
+    cache = _load_cache(cache_fname) if use_cache else None
+    bucket_seconds, first_bucket, strips = presence_strips(
+        since, until, devices, width, cache
+    )
+    image_key = (
+        fname, bucket_seconds, first_bucket, width,
+        [(device, cache['strips'][device[0]][0]) for device, _ in strips]
+        if cache else None,
+    )
+    if (cache is not None and cache['image'] == image_key and
+            os.path.exists(fname)):
+        return False
+
+    labels = [_device_label(device) for device, _ in strips]
+    # The strips can be a bucket longer or shorter from one run to the next
+    # depending on how since and until line up with the buckets, which isn't
+    # worth drawing the frame again for
+    window_seconds = bucket_seconds * width
+    frame_key = (labels, window_seconds)
+    frame = cache['frame'] if cache is not None else None
+    if frame is None or frame[0] != frame_key:
+        frame = (frame_key,) + _draw_frame(labels, window_seconds)
+    _, frame_rgb, box = frame
+    _save_image(fname, _paint_strips(frame_rgb, box,
+                                     [strip for _, strip in strips]))
+
+    if cache is not None:
+        cache['image'] = image_key
+        cache['frame'] = frame
+        _save_cache(cache, cache_fname)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Draw when each device was around'
+    )
+    parser.add_argument(
+        '-o', '--output', default='foo.png',
+        help=('Image file to draw into')
+    )
+    parser.add_argument(
+        '-d', '--device', action='append', default=[], metavar='MAC_OR_NAME',
+        help=('Only draw this device, can be given more than once')
+    )
+    parser.add_argument(
+        '--since', type=u.parse_datetime, default='24h', metavar='WHEN',
+        help=('Start of the plot, either a date/time like "2016-05-01 18:00" '
+              'or how long ago like 30m, 24h or 7d, defaults to 24h')
+    )
+    parser.add_argument(
+        '--until', type=u.parse_datetime, metavar='WHEN',
+        help=('End of the plot, same formats as --since, defaults to now')
+    )
+    parser.add_argument(
+        '-w', '--width', type=int, default=GRAPH_WIDTH,
+        help=('Number of time buckets across the plot')
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help=('Redraw everything without reading or writing the cache')
+    )
+    args = parser.parse_args()
+
+    until = args.until or datetime.datetime.now()
+    draw_presence(args.output, args.since, until, args.device, args.width,
+                  use_cache=not args.no_cache)
@@ -0,0 +1,158 @@
+"""
+Turning mac addresses into ints and back again.
+
+parse_mac() takes any of the usual ways of writing one:
+
+    aa:bb:cc:dd:ee:ff   colon
+    aa-bb-cc-dd-ee-ff   dash
+    aabb.ccdd.eeff      Cisco dotted
+    aabbccddeeff        bare
+
+and format_mac() writes them back out, in whichever of those is wanted.
+"""
+
+import functools
+import re
+
+# Anything that isn't a hex digit, for parse_mac_lenient()
+_NOT_HEX = re.compile(r'[\Wg-zG-Z_]')
+
+FORMAT_CACHE_SIZE = 4096
+
+
+def _digits(mac_str):
+    """
+    returns the hex digits of mac_str, or None if it isn't laid out like one
+    of the formats above. Working from the length is a lot quicker than
+    str.translate() or a regex.
+    """
+    length = len(mac_str)
+    if length == 17:
+        separator = mac_str[2]
+        if separator in ':-' and mac_str[2::3] == separator * 5:
+            return mac_str.replace(separator, '')
+    elif length == 14:
+        if mac_str[4::5] == '..':
+            return mac_str.replace('.', '')
+    elif length == 12:
+        return mac_str
+    return None
+
+
+def parse_mac(mac_str):
+    """
+    returns mac_str as an int, raising ValueError if it isn't one of the
+    formats above
+    """
+    digits = _digits(mac_str)
+    if digits is not None and len(digits) == 12:
+        try:
+            mac_bytes = bytes.fromhex(digits)
+        except ValueError:
+            pass
+        else:
+            # fromhex skips whitespace, so there might be fewer than 6
+            if len(mac_bytes) == 6:
+                return int.from_bytes(mac_bytes, 'big')
+    raise ValueError('Not a mac address: {!r}'.format(mac_str))
+
+
+def is_valid_mac(mac_str):
+    try:
+        parse_mac(mac_str)
+    except ValueError:
+        return False
+    return True
+
+
+def is_multicast(mac_int):
+    """
+    True for group addresses (the I/G bit), broadcast included, which are
+    never a single device's own address
+    """
+    return bool(mac_int >> 40 & 0x01)
+
+
+def is_locally_administered(mac_int):
+    """
+    True if the U/L bit is set, as it is for the randomised addresses phones
+    use, meaning it wasn't handed out by the IEEE so no OUI covers it
+    """
+    return bool(mac_int >> 40 & 0x02)
+
+
+def parse_mac_lenient(mac_str):
+    """
+    Like parse_mac(), but also takes what's left of anything that isn't
+    quite a mac address, like the single digit octets some arp's print
+    (0:1c:b3:9:85:15), rather than raise
+    """
+    try:
+        return parse_mac(mac_str)
+    except ValueError:
+        pass
+    octets = mac_str.split(':')
+    if len(octets) == 6 and all(0 < len(octet) <= 2 for octet in octets):
+        try:
+            return int.from_bytes(
+                bytes.fromhex(''.join(octet.zfill(2) for octet in octets)),
+                'big'
+            )
+        except ValueError:
+            pass
+    return int(_NOT_HEX.sub('', mac_str), 16)
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def format_mac(mac_int, separator=':', group=1):
+    """
+    Writes mac_int out with separator between every group bytes, so
+    separator='.', group=2 is Cisco style
+    """
+    mac_bytes = mac_int.to_bytes(6, 'big')
+    if not separator:
+        return mac_bytes.hex()
+    return mac_bytes.hex(separator, group)
+
+
+def normalise_mac(mac_str, separator=':', group=1):
+    """
+    returns mac_str written the standard way, lower case colon separated by
+    default, raising ValueError if it isn't a mac address
+    """
+    return format_mac(parse_mac(mac_str), separator, group)
+
+
+def parse_macs(mac_strs):
+    """
+    returns a list of ints of all of mac_strs, which have to all be valid
+    (ValueError if not), converted in one go
+    """
+    mac_strs = list(mac_strs)
+    digits = [_digits(mac_str) for mac_str in mac_strs]
+    for mac_str, mac_digits in zip(mac_strs, digits):
+        if mac_digits is None or len(mac_digits) != 12:
+            raise ValueError('Not a mac address: {!r}'.format(mac_str))
+    try:
+        mac_bytes = bytes.fromhex(''.join(digits))
+    except ValueError:
+        # Find out which one it was
+        for mac_str in mac_strs:
+            parse_mac(mac_str)
+        raise
+    if len(mac_bytes) != 6 * len(mac_strs):
+        raise ValueError('Not all mac addresses')
+    from_bytes = int.from_bytes
+    return [from_bytes(mac_bytes[pos:pos+6], 'big')
+            for pos in range(0, len(mac_bytes), 6)]
+
+
+def format_macs(mac_ints, separator=':', group=1):
+    """
+    returns a list of all of mac_ints written out like format_mac(), without
+    going through its cache, which would only churn on a big batch
+    """
+    if not separator:
+        return [mac_int.to_bytes(6, 'big').hex() for mac_int in mac_ints]
+    return [mac_int.to_bytes(6, 'big').hex(separator, group)
+            for mac_int in mac_ints]
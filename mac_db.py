@@ -0,0 +1,71 @@
+"""
+Shared sqlite connections to the mac db, used by both org_matcher and
+device_tracker.
+
+    with mac_db.get_connection(db_fname) as conn:
+        ...
+
+commits (or rolls back) on the way out of the with like a fresh
+sqlite3.connect() would, but leaves the connection open for next time.
+"""
+
+import os
+import sqlite3
+import threading
+
+# Negative so sqlite takes it as KiB rather than pages
+CACHE_SIZE_KIB = 8192
+
+CACHED_STATEMENTS = 256
+
+# Milliseconds to wait on another process's write lock before giving up
+BUSY_TIMEOUT = 5000
+
+_local = threading.local()
+
+
+def _connections():
+    # sqlite connections mustn't be shared between threads, or carried over
+    # into a forked child
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def _connect(db_fname):
+    conn = sqlite3.connect(
+        db_fname,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    # Only takes effect on a brand new db, see retention.incremental_vacuum
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers carry on while a scan or an import is writing
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-{}'.format(CACHE_SIZE_KIB))
+    conn.execute('PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT))
+    return conn
+
+
+def get_connection(db_fname):
+    """
+    Returns this thread's connection to db_fname, opening it if need be
+    """
+    connections = _connections()
+    key = db_fname if db_fname == ':memory:' else os.path.abspath(db_fname)
+    conn = connections.get(key)
+    if conn is None:
+        conn = connections[key] = _connect(db_fname)
+    return conn
+
+
+def close_connections():
+    """
+    Closes all of this thread's connections
+    """
+    connections = _connections()
+    while connections:
+        _, conn = connections.popitem()
+        conn.close()
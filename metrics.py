@@ -0,0 +1,199 @@
+"""
+Timers and counters for seeing where a scan or an import spends its time.
+
+Nothing is recorded until enable() is called, and until then the hooks
+below cost no more than checking a flag, so they can be left on the hot
+paths:
+
+    @metrics.timed('device_tracker.record_scan')
+    def record_scan(...):
+
+    with metrics.timer('import.swap'):
+        ...
+
+    metrics.count('ping.probes')
+
+report() gives a table of the lot, and prometheus_text() the same in
+Prometheus' text format for scraping, see write_prometheus().
+"""
+
+import functools
+import os
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'mac_scanner'
+
+_enabled = False
+_lock = threading.Lock()
+
+# name: [calls, total seconds, longest]
+_timers = {}
+_counters = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def observe(name, seconds):
+    """
+    Records a call to name that took seconds
+    """
+    if not _enabled:
+        return
+    with _lock:
+        timer_stats = _timers.get(name)
+        if timer_stats is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer_stats[0] += 1
+            timer_stats[1] += seconds
+            if seconds > timer_stats[2]:
+                timer_stats[2] = seconds
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Timer:
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """
+    Context manager timing its block as a call to name
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call to the function as name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    returns ({name: (calls, total seconds, longest)}, {name: count})
+    """
+    with _lock:
+        return ({name: tuple(timer_stats)
+                 for name, timer_stats in _timers.items()},
+                dict(_counters))
+
+
+def report():
+    """
+    returns a table of every timer, most total time first, then the counters
+    """
+    timers, counters = snapshot()
+    lines = ['{:<40} {:>8} {:>10} {:>10} {:>10}'.format(
+        'stage', 'calls', 'total s', 'mean ms', 'max ms'
+    )]
+    for name, (calls, total, longest) in sorted(
+            timers.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append('{:<40} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, calls, total, total / calls * 1000, longest * 1000
+        ))
+    for name, value in sorted(counters.items()):
+        lines.append('{:<40} {:>8}'.format(name, value))
+    return '\n'.join(lines)
+
+
+def prometheus_text():
+    """
+    returns everything in the Prometheus text exposition format
+    """
+    timers, counters = snapshot()
+    lines = []
+    if timers:
+        metric = '{}_stage_seconds'.format(PROMETHEUS_PREFIX)
+        lines.append('# HELP {} Time spent in each stage.'.format(metric))
+        lines.append('# TYPE {} summary'.format(metric))
+        for name, (calls, total, _) in sorted(timers.items()):
+            lines.append('{}_count{{stage="{}"}} {}'.format(metric, name,
+                                                           calls))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(metric, name,
+                                                           total))
+        metric = '{}_stage_max_seconds'.format(PROMETHEUS_PREFIX)
+        lines.append('# HELP {} Longest single call of each stage.'
+                     .format(metric))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for name, (_, _, longest) in sorted(timers.items()):
+            lines.append('{}{{stage="{}"}} {!r}'.format(metric, name, longest))
+    if counters:
+        metric = '{}_events_total'.format(PROMETHEUS_PREFIX)
+        lines.append('# HELP {} Things counted along the way.'.format(metric))
+        lines.append('# TYPE {} counter'.format(metric))
+        for name, value in sorted(counters.items()):
+            lines.append('{}{{name="{}"}} {}'.format(metric, name, value))
+    return ''.join(line + '\n' for line in lines)
+
+
+def write_prometheus(fname):
+    """
+    Writes prometheus_text() to fname without a reader ever seeing half of
+    it, e.g. for node_exporter's textfile collector
+    """
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_fname, fname)
@@ -1,14 +1,38 @@
-import re
+import datetime
+import mac_codec
 
-HEX_CHARS = re.compile(r'[\Wg-zG-Z]')
+# Both are on the path of every lookup, import and listing, see mac_codec
+hex_str_to_int = mac_codec.parse_mac_lenient
 
-def hex_str_to_int(hex_str):
-    return int(HEX_CHARS.sub('', hex_str), 16)
+int_mac_to_hex_mac = mac_codec.format_mac
 
-def int_mac_to_hex_mac(int_mac, separator=':'):
-    padded_str = '{0:012x}'.format(int_mac)
-    split_string = ':'.join([
-        '{}{}'.format(padded_str[pos], padded_str[pos+1])
-        for pos in range(0, len(padded_str), 2)
-    ])
-    return split_string
+_DURATION_UNITS = {
+    's': 'seconds',
+    'm': 'minutes',
+    'h': 'hours',
+    'd': 'days',
+    'w': 'weeks',
+}
+
+_DATETIME_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d',
+]
+
+def parse_datetime(when):
+    """
+    when is either a date/time or a duration like 24h to go back from now
+    """
+    unit = _DURATION_UNITS.get(when[-1:])
+    if unit and when[:-1].isdigit():
+        return (datetime.datetime.now() -
+                datetime.timedelta(**{unit: int(when[:-1])}))
+    for datetime_format in _DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(when, datetime_format)
+        except ValueError:
+            continue
+    raise ValueError('Not a date/time or duration: {}'.format(when))
@@ -1,27 +1,55 @@
 #!/usr/bin/env python3
 
-import sqlite3
-import urllib.request
+import mac_db
+import metrics
 import os
-import csv
+import itertools
 import my_utils as u
+from config import settings
 
-try:
-    from settings import MAC_DB_FNAME
-except ImportError:
-    MAC_DB_FNAME = 'mac.db'
+# csv, hashlib, urllib and concurrent.futures are only imported by what
+# reads and downloads the registries, lookups don't need them
+
+# Loaded lazily by _get_index(), thrown away whenever the db is rewritten
+_oui_index = None
+
+# Number of low bits left over by each assignment class's prefix
+ASSIGNMENT_BLOCK_BITS = {
+    'mal': 24,  # MA-L, 24 bit prefix
+    'mam': 20,  # MA-M, 28 bit prefix
+    'mas': 12,  # MA-S, 36 bit prefix
+}
+# Addresses that agree above this many bits always have the same owners
+SMALLEST_BLOCK_BITS = min(ASSIGNMENT_BLOCK_BITS.values())
+
+# Smallest blocks search_by_mac_addresses() remembers the owners of at once
+RESOLVED_CACHE_SIZE = 4096
+
+IEEE_URL_PREFIX = 'http://standards.ieee.org/develop/regauth/'
+
+# (url suffix, assignment class) for each registry IEEE publishes
+ASSIGNMENT_URL_SUFFIXES = [
+    ('oui/oui.csv', 'mal'),
+    ('oui28/mam.csv', 'mam'),
+    ('oui36/oui36.csv', 'mas'),
+]
+
+# Assignments are written this many at a time so an import never holds a
+# whole registry in memory
+IMPORT_CHUNK_SIZE = 5000
 
 
 def init_db(recreate=False):
     if recreate:
-        drop_tables(MAC_DB_FNAME)
-    init_tables(MAC_DB_FNAME)
+        drop_tables(settings.MAC_DB_FNAME)
+    init_tables(settings.MAC_DB_FNAME)
+    invalidate_index()
 
 """
 Database-y stuff first
 """
 def drop_tables(db_fname):
-    with sqlite3.connect(db_fname) as conn:
+    with mac_db.get_connection(db_fname) as conn:
         c = conn.cursor()
         c.execute('''
         DROP TABLE IF EXISTS organisation;
@@ -29,195 +57,470 @@ def drop_tables(db_fname):
         c.execute('''
         DROP TABLE IF EXISTS mac_addr_org;
         ''')
+        c.execute('''
+        DROP TABLE IF EXISTS registry_file;
+        ''')
+
+def _create_tables(c, org_table='organisation', mac_table='mac_addr_org'):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS {org_table} (
+    org_id      INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    org_name    TEXT NOT NULL,
+    org_addr    TEXT,
+    UNIQUE (org_name, org_addr)
+        ON CONFLICT IGNORE
+    );
+    '''.format(org_table=org_table))
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS {mac_table} (
+    mac_addr_start INTEGER  NOT NULL,
+    mac_addr_end   INTEGER  NOT NULL,
+    mac_addr_org   INTEGER  NOT NULL,
+    FOREIGN KEY(mac_addr_org) REFERENCES {org_table}(org_id),
+    UNIQUE (mac_addr_start, mac_addr_end, mac_addr_org)
+        ON CONFLICT IGNORE
+    );
+    '''.format(org_table=org_table, mac_table=mac_table))
 
 def init_tables(db_fname):
-    with sqlite3.connect(db_fname) as conn:
+    with mac_db.get_connection(db_fname) as conn:
         c = conn.cursor()
+        _create_tables(c)
         c.execute('''
-        CREATE TABLE IF NOT EXISTS organisation (
-        org_id      INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
-        org_name    TEXT NOT NULL,
-        org_addr    TEXT,
-        UNIQUE (org_name, org_addr)
-            ON CONFLICT IGNORE
+        CREATE TABLE IF NOT EXISTS registry_file (
+        registry_fname          TEXT  NOT NULL  PRIMARY KEY,
+        registry_etag           TEXT,
+        registry_last_modified  TEXT,
+        registry_sha256         TEXT
         );
         ''')
+
+def _get_registry_files(db_fname):
+    """
+    returns {fname: (etag, last_modified, sha256 of the last import)}
+    """
+    with mac_db.get_connection(db_fname) as conn:
+        c = conn.cursor()
         c.execute('''
-        CREATE TABLE IF NOT EXISTS mac_addr_org (
-        mac_addr_start INTEGER  NOT NULL,
-        mac_addr_end   INTEGER  NOT NULL,
-        mac_addr_org   INTEGER  NOT NULL,
-        FOREIGN KEY(mac_addr_org) REFERENCES organisation(org_id),
-        UNIQUE (mac_addr_start, mac_addr_end, mac_addr_org)
-            ON CONFLICT IGNORE
-        );
+        SELECT registry_fname, registry_etag, registry_last_modified,
+               registry_sha256
+        FROM registry_file
         ''')
+        return {row[0]: row[1:] for row in c.fetchall()}
+
+def _set_registry_files(registry_files, db_fname):
+    with mac_db.get_connection(db_fname) as conn:
+        c = conn.cursor()
+        c.executemany('''
+        INSERT OR REPLACE INTO registry_file
+        (registry_fname, registry_etag, registry_last_modified,
+         registry_sha256)
+        VALUES (?, ?, ?, ?)
+        ''', [
+            (fname,) + registry_file
+            for fname, registry_file in registry_files.items()
+        ])
 
-def dump_into_db(mac_entry_list, db_fname):
+def _dump_entries(c, mac_entries, org_ids,
+                  org_table='organisation', mac_table='mac_addr_org'):
     """
-    There's probably a way to even make this quicker, but its
-    fast enough for the moment
+    mac_entries is an iterable of
+    (mac_addr_start, mac_addr_end, org_name, org_addr) tuples, as made by
+    extract(), and is written IMPORT_CHUNK_SIZE entries at a time.
+
+    org_ids maps (org_name, org_addr) to the org_id already in org_table,
+    and is added to as new organisations turn up, so neither table ever
+    has to be searched while inserting
     """
-    with sqlite3.connect(db_fname) as conn:
+    mac_entries = iter(mac_entries)
+    next_org_id = max(org_ids.values(), default=0) + 1
+    while True:
+        chunk = list(itertools.islice(mac_entries, IMPORT_CHUNK_SIZE))
+        if not chunk:
+            break
+        new_orgs = []
+        mac_rows = []
+        for mac_addr_start, mac_addr_end, org_name, org_addr in chunk:
+            org_key = (org_name, org_addr)
+            org_id = org_ids.get(org_key)
+            if org_id is None:
+                org_id = next_org_id
+                next_org_id += 1
+                org_ids[org_key] = org_id
+                new_orgs.append((org_id, org_name, org_addr))
+            mac_rows.append((mac_addr_start, mac_addr_end, org_id))
+        c.executemany('''
+        INSERT INTO {} (org_id, org_name, org_addr)
+        VALUES (?, ?, ?);
+        '''.format(org_table), new_orgs)
+        c.executemany('''
+        INSERT INTO {} (mac_addr_start, mac_addr_end, mac_addr_org)
+        VALUES (?, ?, ?);
+        '''.format(mac_table), mac_rows)
+
+def _org_ids(c, org_table='organisation'):
+    c.execute('''
+    SELECT org_name, org_addr, org_id FROM {}
+    '''.format(org_table))
+    return {
+        (org_name, org_addr): org_id
+        for org_name, org_addr, org_id in c.fetchall()
+    }
+
+@metrics.timed('import.dump_into_db')
+def dump_into_db(mac_entries, db_fname):
+    """
+    Adds entries to the live tables in a single transaction
+    """
+    with mac_db.get_connection(db_fname) as conn:
         c = conn.cursor()
-        for entry in mac_entry_list:
-            if not entry:
-                continue
-            c.execute('''
-            INSERT INTO organisation (org_name, org_addr)
-            VALUES (?, ?);
-            ''', (entry['org_name'], entry['org_addr'],))
-
-    with sqlite3.connect(db_fname) as conn:
+        _dump_entries(c, mac_entries, _org_ids(c))
+
+def _count_missing_assignments(c, from_tables, in_tables):
+    # Assignments are compared by value as org_ids aren't stable between
+    # imports
+    c.execute('''
+    SELECT COUNT(*) FROM (
+        SELECT mac_addr_start, mac_addr_end, org_name, org_addr
+            FROM {0[1]} JOIN {0[0]} ON {0[1]}.mac_addr_org = {0[0]}.org_id
+        EXCEPT
+        SELECT mac_addr_start, mac_addr_end, org_name, org_addr
+            FROM {1[1]} JOIN {1[0]} ON {1[1]}.mac_addr_org = {1[0]}.org_id
+    );
+    '''.format(from_tables, in_tables))
+    return c.fetchone()[0]
+
+def import_assignment_files(assignment_files, db_fname):
+    """
+    assignment_files is a list of (assignment_class, fname)
+
+    Loads every file into staging tables and then swaps them in for the live
+    tables, all in one transaction, so records IEEE has dropped disappear and
+    anyone reading the db only ever sees the old or the new set.
+
+    returns (added, removed) counts of assignments
+    """
+    live_tables = ('organisation', 'mac_addr_org')
+    staging_tables = ('organisation_staging', 'mac_addr_org_staging')
+    with mac_db.get_connection(db_fname) as conn:
         c = conn.cursor()
-        for entry in mac_entry_list:
-            if not entry:
-                continue
-            c.execute('''
-            INSERT INTO mac_addr_org
-            (mac_addr_start, mac_addr_end, mac_addr_org)
-            VALUES (?, ?,
-                (SELECT org_id FROM organisation
-                 WHERE org_name=? and org_addr=?));
-            ''', (
-                entry['mac_addr_start'],
-                entry['mac_addr_end'],
-                entry['org_name'],
-                entry['org_addr'],)
-            )
-
-def _query_mac_address(mac_address, db_fname):
-    with sqlite3.connect(db_fname) as conn:
+        c.execute('BEGIN IMMEDIATE')
+        _create_tables(c, *live_tables)
+        for table in reversed(staging_tables):
+            c.execute('DROP TABLE IF EXISTS {}'.format(table))
+        _create_tables(c, *staging_tables)
+
+        org_ids = {}
+        for assignment_class, fname in assignment_files:
+            with metrics.timer('import.stage.{}'.format(assignment_class)):
+                _dump_entries(c, extract(assignment_class, fname), org_ids,
+                              *staging_tables)
+
+        with metrics.timer('import.compare'):
+            added = _count_missing_assignments(c, staging_tables,
+                                               live_tables)
+            removed = _count_missing_assignments(c, live_tables,
+                                                 staging_tables)
+
+        with metrics.timer('import.swap'):
+            for table in reversed(live_tables):
+                c.execute('DROP TABLE {}'.format(table))
+            for staging_table, live_table in zip(staging_tables, live_tables):
+                c.execute('ALTER TABLE {} RENAME TO {}'.format(
+                    staging_table, live_table
+                ))
+        with metrics.timer('import.commit'):
+            conn.commit()
+    metrics.count('import.added', added)
+    metrics.count('import.removed', removed)
+    return added, removed
+
+@metrics.timed('oui.load_index')
+def _load_index(db_fname):
+    """
+    Pulls the whole of the assignment tables into memory in one go.
+
+    Returns (blocks, organisations) where blocks is a list of
+    (prefix_bits, {prefix: (org_id, ...)}) ordered from the smallest block
+    (MA-S) to the largest (MA-L), so the first hit is the longest prefix
+    match.
+    """
+    with mac_db.get_connection(db_fname) as conn:
         c = conn.cursor()
         c.execute('''
-        SELECT * FROM organisation
-        INNER JOIN mac_addr_org
-        ON mac_addr_org.mac_addr_org = organisation.org_id
-        WHERE ? >= mac_addr_org.mac_addr_start AND
-              ? <= mac_addr_org.mac_addr_end;
-        ''', (mac_address, mac_address, ))
-        return c.fetchmany()
+        SELECT org_id, org_name, org_addr FROM organisation
+        ''')
+        organisations = {
+            org_id: (org_name, org_addr)
+            for org_id, org_name, org_addr in c.fetchall()
+        }
+        c.execute('''
+        SELECT mac_addr_start, mac_addr_end, mac_addr_org FROM mac_addr_org
+        ''')
+        by_bits = {}
+        for start, end, org_id in c:
+            # Every assignment is an aligned power-of-two sized block, so the
+            # size of the range tells us how many low bits the prefix leaves
+            bits = (end - start).bit_length()
+            prefixes = by_bits.setdefault(bits, {})
+            prefixes[start >> bits] = prefixes.get(start >> bits, ()) + (org_id,)
+    blocks = sorted(by_bits.items())
+    return blocks, organisations
+
+def _get_index():
+    global _oui_index
+    if _oui_index is None:
+        _oui_index = _load_index(settings.MAC_DB_FNAME)
+    return _oui_index
+
+def warm_index():
+    """
+    Loads the index now rather than on the first lookup
+    """
+    init_tables(settings.MAC_DB_FNAME)
+    _get_index()
+
+def invalidate_index():
+    global _oui_index
+    _oui_index = None
+
+@metrics.timed('oui.lookup')
+def _lookup_mac_address(mac_address):
+    # Randomised and multicast addresses can't be in any assignment, so
+    # they don't need the index, or even the db. This is
+    # mac_codec.is_locally_administered() or is_multicast(), inlined as it's
+    # run for every lookup.
+    if mac_address >> 40 & 0x03:
+        return []
+    blocks, organisations = _get_index()
+    for bits, prefixes in blocks:
+        org_ids = prefixes.get(mac_address >> bits)
+        if org_ids:
+            return [organisations[org_id] for org_id in org_ids]
+    return []
 
 def add_assignment_file_to_db(assignment_class, fname):
     assignments = extract(assignment_class, fname)
-    dump_into_db(assignments, MAC_DB_FNAME)
+    dump_into_db(assignments, settings.MAC_DB_FNAME)
+    invalidate_index()
 
 """
 Non-db functions
 """
 
 def extract(assignment_class, fname):
+    """
+    Generator of (mac_addr_start, mac_addr_end, org_name, org_addr) tuples,
+    the file is only read as far as it's been iterated
+    """
     extractors = {
         'mal': extract_mal_assignments,
         'mam': extract_mam_assignments,
         'mas': extract_mas_assignments,
     }
+    import csv
     with open(fname, 'r') as f:
         reader = csv.reader(f)
         next(reader, None)  # Skip headers
-        assignments = extractors[assignment_class](reader)
-    return assignments
+        yield from extractors[assignment_class](reader)
 
 
+def _extract_assignments(reader, block_bits):
+    block_mask = (1 << block_bits) - 1
+    for row in reader:
+        if not row:
+            continue
+        mac_addr_start = int(row[1], 16) << block_bits
+        yield (mac_addr_start, mac_addr_start | block_mask, row[2], row[3])
+
 def extract_mal_assignments(reader):
-    assignments = [
-        {
-            'mac_addr_start': int(row[1], 16) * (2**24),
-            'mac_addr_end': int(row[1], 16) * (2**24) + int('FFFFFF', 16),
-            'org_name': row[2],
-            'org_addr': row[3],
-        }
-        for row in reader
-    ]
-    return assignments
+    return _extract_assignments(reader, ASSIGNMENT_BLOCK_BITS['mal'])
 
 def extract_mam_assignments(reader):
-    assignments = [
-        {
-            'mac_addr_start': int(row[1], 16) * (2**20),
-            'mac_addr_end': int(row[1], 16) * (2**20) + int('FFFFF', 16),
-            'org_name': row[2],
-            'org_addr': row[3],
-        }
-        for row in reader
-    ]
-    return assignments
+    return _extract_assignments(reader, ASSIGNMENT_BLOCK_BITS['mam'])
 
 def extract_mas_assignments(reader):
-    assignments = [
-        {
-            'mac_addr_start': int(row[1], 16) * (2**16),
-            'mac_addr_end': int(row[1], 16) * (2**16) + int('FFF', 16),
-            'org_name': row[2],
-            'org_addr': row[3],
-        }
-        for row in reader
-    ]
-    return assignments
+    return _extract_assignments(reader, ASSIGNMENT_BLOCK_BITS['mas'])
 
-def download_mac_file(suffix, assignment_group):
-    web_addr_prefix = 'http://standards.ieee.org/develop/regauth/'
-    url = ''.join([web_addr_prefix, suffix])
+@metrics.timed('update.hash')
+def _file_sha256(fname):
+    import hashlib
+    sha256 = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2**16), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+@metrics.timed('update.download')
+def download_mac_file(suffix, assignment_group, etag=None, last_modified=None,
+                      url_prefix=IEEE_URL_PREFIX):
+    """
+    Only fetches the file if it's missing or the server says it has changed
+    since etag/last_modified, and never leaves a half written file behind
+
+    returns (filename, etag, last_modified) where the last two are from
+    the server's response, or the ones given if it wasn't modified
+    """
+    import tempfile
+    import urllib.error
+    import urllib.request
+    url = ''.join([url_prefix, suffix])
     filename = ''.join([assignment_group, '.csv'])
-    urllib.request.urlretrieve(url, filename)
-
-def update_db():
-    assignment_url_suffixes = [
-        ('oui/oui.csv', 'mal'),
-        ('oui28/mam.csv','mam'),
-        ('oui36/oui36.csv', 'mas')
-    ]
-    for suffix, assignment_group in assignment_url_suffixes:
-        download_mac_file(suffix, assignment_group)
-        filename = ''.join([assignment_group, '.csv'])
-        add_assignment_file_to_db(
-            assignment_group,
-            filename,
+    request = urllib.request.Request(url)
+    if os.path.exists(filename):
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return filename, etag, last_modified
+        raise
+    with response:
+        tmp_file = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix=filename, suffix='.part', delete=False
         )
+        try:
+            with tmp_file:
+                for block in iter(lambda: response.read(2**16), b''):
+                    tmp_file.write(block)
+            os.replace(tmp_file.name, filename)
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+        return (filename, response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+
+def update_db(url_prefix=IEEE_URL_PREFIX):
+    """
+    Downloads all of the registries at once and imports them, skipping the
+    import if none of them have changed since the last one
+
+    returns (added, removed) counts of assignments
+    """
+    import concurrent.futures
+    init_tables(settings.MAC_DB_FNAME)
+    registry_files = _get_registry_files(settings.MAC_DB_FNAME)
+    with concurrent.futures.ThreadPoolExecutor(
+            len(ASSIGNMENT_URL_SUFFIXES)) as executor:
+        downloads = []
+        for suffix, assignment_group in ASSIGNMENT_URL_SUFFIXES:
+            filename = ''.join([assignment_group, '.csv'])
+            etag, last_modified, _ = registry_files.get(filename, (None,) * 3)
+            downloads.append(executor.submit(
+                download_mac_file, suffix, assignment_group,
+                etag, last_modified, url_prefix
+            ))
+        downloaded = [download.result() for download in downloads]
+
+    assignment_files = []
+    new_registry_files = {}
+    for (_, assignment_group), (filename, etag, last_modified) in zip(
+            ASSIGNMENT_URL_SUFFIXES, downloaded):
+        assignment_files.append((assignment_group, filename))
+        new_registry_files[filename] = (
+            etag, last_modified, _file_sha256(filename)
+        )
+    if all(
+        registry_files.get(filename, (None,) * 3)[2] == registry_file[2]
+        for filename, registry_file in new_registry_files.items()
+    ):
+        _set_registry_files(new_registry_files, settings.MAC_DB_FNAME)
+        return 0, 0
+
+    added, removed = import_assignment_files(assignment_files,
+                                             settings.MAC_DB_FNAME)
+    _set_registry_files(new_registry_files, settings.MAC_DB_FNAME)
+    invalidate_index()
+    return added, removed
 
 def search_by_mac_address_int(mac_address):
     """
     mac_address must be int
-    returns organisation and address of mac address owner
+    returns organisation and address of mac address owner, using the most
+    specific (MA-S, then MA-M, then MA-L) assignment that covers it
     """
     if type(mac_address) != int:
         raise TypeError
     formatted_organisations = []
-    for org in _query_mac_address(mac_address, MAC_DB_FNAME):
+    for org_name, org_addr in _lookup_mac_address(mac_address):
         organ_dict = {}
-        organ_dict['org_name'] = org[1]
-        organ_dict['org_addr'] = org[2]
+        organ_dict['org_name'] = org_name
+        organ_dict['org_addr'] = org_addr
         formatted_organisations.append(organ_dict)
     return formatted_organisations
 
 def search_by_mac_address_str(hex_mac_address):
     return search_by_mac_address_int(u.hex_str_to_int(hex_mac_address))
 
+def search_by_mac_addresses(mac_addresses):
+    """
+    mac_addresses is any iterable of ints and/or hex strings
+    yields (mac_address, organisations) pairs in the order given, where
+    organisations is the same as from search_by_mac_address_int
+
+    Addresses sharing the top 36 bits (the smallest assignment block) are
+    always owned by the same organisations, so each of those is only
+    resolved once, up to RESOLVED_CACHE_SIZE of them at a time. Randomised
+    and multicast addresses never match anything.
+    """
+    resolved = {}
+    for mac_address in mac_addresses:
+        if type(mac_address) == int:
+            mac_int = mac_address
+        else:
+            mac_int = u.hex_str_to_int(mac_address)
+        prefix = mac_int >> SMALLEST_BLOCK_BITS
+        organisations = resolved.get(prefix)
+        if organisations is None:
+            if len(resolved) >= RESOLVED_CACHE_SIZE:
+                # Starting again is much cheaper than keeping track of
+                # which were used last, and the busy ones soon come back
+                resolved.clear()
+            organisations = search_by_mac_address_int(mac_int)
+            resolved[prefix] = organisations
+        yield mac_address, organisations
+
 __all__ = [
     'search_by_mac_address_int',
     'search_by_mac_address_str',
+    'search_by_mac_addresses',
     'init_db',
     'update_db',
+    'invalidate_index',
+    'warm_index',
 ]
 
 if __name__ == '__main__':
     import sys
 
+    if '--profile' in sys.argv:
+        # Prints where an update spent its time, see metrics
+        sys.argv.remove('--profile')
+        metrics.enable()
+        import atexit
+        atexit.register(lambda: print(metrics.report(), file=sys.stderr))
+
     if len(sys.argv) < 2 or len(sys.argv) > 4:
-        print('Usage: {} [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
+        print('Usage: {} [--profile] [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
         sys.exit(1)
 
     if sys.argv[1][0] in 'rRuUtT':
-        init_db(recreate=True)
-        update_db()
+        # Upgrading swaps the new records in, so only drop for the others
+        init_db(recreate=sys.argv[1][0] not in 'uU')
+        added, removed = update_db()
+        print('Added {} and removed {} assignments'.format(added, removed))
     elif sys.argv[1][0] in 'hH':
         if len(sys.argv) != 3:
-            print('Usage: {} [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
+            print('Usage: {} [--profile] [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
             sys.exit(2)
         print(u.hex_str_to_int(sys.argv[2]))
     else:
         if len(sys.argv) != 2:
-            print('Usage: {} [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
+            print('Usage: {} [--profile] [rewrite|upgrade|trash|hex_to_string] [MAC]'.format(sys.argv[0]))
             sys.exit(3)
         org_infos = search_by_mac_address_str(sys.argv[1])
         if org_infos:
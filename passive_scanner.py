@@ -0,0 +1,509 @@
+"""
+Passive discovery, picking devices out of traffic they send anyway rather
+than pinging them: ARP, DHCP requests and 802.11 probe requests.
+
+Captures are read as a stream from pcap or pcapng (a file, or a pipe from
+tcpdump -w -), a chunk at a time, and packets are parsed where they lie in
+the chunk with struct.unpack_from, so nothing is copied per packet and
+captures of any size only ever need a chunk of memory.
+
+Sightings are grouped into windows of PASSIVE_WINDOW seconds and each
+window is saved as a scan, the same as an active one:
+
+    with open('capture.pcap', 'rb') as f:
+        record_scans(iter_capture_sightings(f))
+
+A sighting is (timestamp, mac_int, ip, hostname), ip and hostname being
+None when the packet didn't give them away.
+
+Phones send probe requests from a new randomised mac every few minutes, and
+with no hostname there's nothing to tie one to the last, so a randomised mac
+that hasn't been seen before is only saved once it's given a hostname.
+
+Passive scans go in with the active ones, and a device that was in an
+active scan but happened not to send anything during a window in between is
+absent from that window's scan, which ends its run there. With both
+running, PRESENCE_GAP_TOLERANCE should be at least the time between active
+scans so their runs stay in one piece.
+"""
+
+import datetime
+import socket
+import struct
+import time
+
+from config import settings
+import device_tracker as dev_track
+import mac_codec
+import metrics
+import my_utils as u
+
+# Bytes read from a capture at a time
+CHUNK_SIZE = 1024 * 1024
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_PACKET = 2  # Obsolete, but still turns up
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IEEE802_11_RADIOTAP = 127
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_ARP = 0x0806
+_VLAN_ETHERTYPES = (0x8100, 0x88a8)
+
+DHCP_SERVER_PORT = 67
+DHCP_CLIENT_PORT = 68
+DHCP_MAGIC_COOKIE = 0x63825363
+DHCP_OPTION_HOSTNAME = 12
+DHCP_OPTION_REQUESTED_IP = 50
+
+# First byte of an 802.11 frame control field for a probe request, version 0
+# type 0 (management) subtype 4
+PROBE_REQUEST = 0x40
+
+# For live sniffing, from linux/if_ether.h and linux/if_arp.h
+ETH_P_ALL = 0x0003
+_ARPHRD_LINKTYPES = {
+    1: LINKTYPE_ETHERNET,  # ARPHRD_ETHER
+    772: LINKTYPE_ETHERNET,  # ARPHRD_LOOPBACK
+    801: LINKTYPE_IEEE802_11,  # ARPHRD_IEEE80211
+    803: LINKTYPE_IEEE802_11_RADIOTAP,  # ARPHRD_IEEE80211_RADIOTAP
+}
+
+_UINT16 = struct.Struct('!H')
+_MAC = struct.Struct('!HI')
+_ARP = struct.Struct('!HHBB')
+_UDP_PORTS = struct.Struct('!HH')
+_RADIOTAP_LENGTH = struct.Struct('<H')
+
+
+def _mac_at(buf, pos):
+    high, low = _MAC.unpack_from(buf, pos)
+    return high << 32 | low
+
+
+def _parse_arp(buf, pos, end):
+    if end - pos < 28:
+        return None
+    htype, ptype, hlen, plen = _ARP.unpack_from(buf, pos)
+    if htype != 1 or ptype != ETHERTYPE_IPV4 or hlen != 6 or plen != 4:
+        return None
+    # Sender's hardware and protocol addresses, which are 0.0.0.0 for an
+    # address probe
+    ip = bytes(buf[pos+14:pos+18])
+    return (_mac_at(buf, pos + 8),
+            socket.inet_ntoa(ip) if ip != b'\0\0\0\0' else None, None)
+
+
+def _parse_dhcp_options(buf, pos, end):
+    """
+    returns (hostname, requested ip) from the options at pos
+    """
+    hostname = requested_ip = None
+    while pos < end:
+        code = buf[pos]
+        if code == 255:
+            break
+        if code == 0:
+            pos += 1
+            continue
+        if pos + 2 > end:
+            break
+        length = buf[pos+1]
+        value = bytes(buf[pos+2:min(pos+2+length, end)])
+        if code == DHCP_OPTION_HOSTNAME and value:
+            hostname = value.decode('ascii', 'replace')
+        elif code == DHCP_OPTION_REQUESTED_IP and len(value) == 4:
+            requested_ip = socket.inet_ntoa(value)
+        pos += 2 + length
+    return hostname, requested_ip
+
+
+def _parse_dhcp(buf, pos, end):
+    """
+    Picks the client out of DHCP requests, the IPv4 packet being at pos
+    """
+    if end - pos < 20 or buf[pos+9] != 17 or buf[pos] >> 4 != 4:
+        # Not UDP
+        return None
+    if _UINT16.unpack_from(buf, pos + 6)[0] & 0x1fff:
+        # Not the first fragment
+        return None
+    udp = pos + (buf[pos] & 0xf) * 4
+    bootp = udp + 8
+    if end - bootp < 240:
+        return None
+    if _UDP_PORTS.unpack_from(buf, udp) != (DHCP_CLIENT_PORT,
+                                             DHCP_SERVER_PORT):
+        return None
+    # BOOTREQUEST from an ethernet address
+    if buf[bootp] != 1 or buf[bootp+1] != 1 or buf[bootp+2] != 6:
+        return None
+    if struct.unpack_from('!I', buf, bootp + 236)[0] != DHCP_MAGIC_COOKIE:
+        return None
+    hostname, requested_ip = _parse_dhcp_options(buf, bootp + 240, end)
+    ciaddr = bytes(buf[bootp+12:bootp+16])
+    ip = socket.inet_ntoa(ciaddr) if ciaddr != b'\0\0\0\0' else requested_ip
+    return _mac_at(buf, bootp + 28), ip, hostname
+
+
+def _parse_ethertype(ethertype, buf, pos, end):
+    if ethertype == ETHERTYPE_ARP:
+        return _parse_arp(buf, pos, end)
+    if ethertype == ETHERTYPE_IPV4:
+        return _parse_dhcp(buf, pos, end)
+    return None
+
+
+def _parse_ethernet(buf, pos, end):
+    if end - pos < 14:
+        return None
+    ethertype, = _UINT16.unpack_from(buf, pos + 12)
+    pos += 14
+    while ethertype in _VLAN_ETHERTYPES:
+        if end - pos < 4:
+            return None
+        ethertype, = _UINT16.unpack_from(buf, pos + 2)
+        pos += 4
+    return _parse_ethertype(ethertype, buf, pos, end)
+
+
+def _parse_linux_sll(buf, pos, end):
+    # tcpdump -i any
+    if end - pos < 16:
+        return None
+    ethertype, = _UINT16.unpack_from(buf, pos + 14)
+    return _parse_ethertype(ethertype, buf, pos + 16, end)
+
+
+def _parse_ieee802_11(buf, pos, end):
+    if end - pos < 16 or buf[pos] != PROBE_REQUEST:
+        return None
+    # addr2 is the transmitter
+    return _mac_at(buf, pos + 10), None, None
+
+
+def _parse_radiotap(buf, pos, end):
+    if end - pos < 4:
+        return None
+    length, = _RADIOTAP_LENGTH.unpack_from(buf, pos + 2)
+    return _parse_ieee802_11(buf, pos + length, end)
+
+
+_LINKTYPE_PARSERS = {
+    LINKTYPE_ETHERNET: _parse_ethernet,
+    LINKTYPE_IEEE802_11: _parse_ieee802_11,
+    LINKTYPE_LINUX_SLL: _parse_linux_sll,
+    LINKTYPE_IEEE802_11_RADIOTAP: _parse_radiotap,
+}
+
+
+def parse_packet(linktype, buf, pos, end):
+    """
+    Looks at the packet in buf[pos:end] without copying it
+    returns (mac_int, ip, hostname) if it gives a device away, else None
+    """
+    parse = _LINKTYPE_PARSERS.get(linktype)
+    if parse is None:
+        return None
+    sighting = parse(buf, pos, end)
+    # Broadcast, multicast and all zeros aren't devices
+    if sighting is None or not sighting[0] or sighting[0] >> 40 & 1:
+        return None
+    return sighting
+
+
+class _ChunkReader:
+    """
+    Reads f a chunk at a time, buf[pos:] being what's not been used yet
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        # read1 so a pipe hands over whatever it has rather than waiting
+        # for a whole chunk
+        self._read = getattr(f, 'read1', f.read)
+        self._chunk_size = chunk_size
+        self.buf = b''
+        self.pos = 0
+
+    def ensure(self, n):
+        """
+        Reads more if there are fewer than n bytes left in buf
+        returns False if the capture ends first
+        """
+        if len(self.buf) - self.pos >= n:
+            return True
+        parts = [self.buf[self.pos:]]
+        have = len(parts[0])
+        while have < n:
+            data = self._read(max(self._chunk_size, n - have))
+            if not data:
+                break
+            parts.append(data)
+            have += len(data)
+        self.buf = b''.join(parts)
+        self.pos = 0
+        return have >= n
+
+
+def _iter_pcap(reader):
+    """
+    Generator of (timestamp, linktype, buf, start, end) for each packet
+    """
+    magic = reader.buf[reader.pos:reader.pos+4]
+    for byte_order in '<>':
+        magic_int, = struct.unpack(byte_order + 'I', magic)
+        if magic_int in (PCAP_MAGIC, PCAP_MAGIC_NANOSECONDS):
+            break
+    else:
+        raise ValueError('Not a pcap or pcapng capture')
+    divisor = 1e9 if magic_int == PCAP_MAGIC_NANOSECONDS else 1e6
+    if not reader.ensure(24):
+        return
+    linktype, = struct.unpack_from(byte_order + 'I', reader.buf,
+                                   reader.pos + 20)
+    reader.pos += 24
+
+    record = struct.Struct(byte_order + 'IIII')
+    while reader.ensure(16):
+        ts_sec, ts_frac, caplen, _ = record.unpack_from(reader.buf,
+                                                        reader.pos)
+        if not reader.ensure(16 + caplen):
+            # Cut off part way through a packet
+            return
+        start = reader.pos + 16
+        reader.pos = start + caplen
+        yield (ts_sec + ts_frac / divisor, linktype, reader.buf, start,
+               start + caplen)
+
+
+def _timestamp_divisor(buf, pos, end, byte_order):
+    """
+    returns the if_tsresol of the interface description block options at pos
+    as ticks per second
+    """
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(byte_order + 'HH', buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            tsresol = buf[pos+4]
+            if tsresol & 0x80:
+                return 2 ** (tsresol & 0x7f)
+            return 10 ** tsresol
+        pos += 4 + (length + 3) // 4 * 4
+    return 10 ** 6
+
+
+def _iter_pcapng(reader):
+    """
+    Generator of (timestamp, linktype, buf, start, end) for each packet
+    """
+    byte_order = '<'
+    # [(linktype, ticks per second)] of the current section
+    interfaces = []
+    timestamp = 0.0
+    while reader.ensure(12):
+        buf, pos = reader.buf, reader.pos
+        # The section header's type reads the same either way round, and
+        # says which way round the rest of the section is
+        block_type, = struct.unpack_from(byte_order + 'I', buf, pos)
+        if block_type == PCAPNG_SECTION_HEADER:
+            bom, = struct.unpack_from('<I', buf, pos + 8)
+            byte_order = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            interfaces = []
+            header = struct.Struct(byte_order + 'II')
+            enhanced_packet = struct.Struct(byte_order + 'IIIII')
+            packet = struct.Struct(byte_order + 'HHIIII')
+        block_type, block_length = header.unpack_from(buf, pos)
+        if block_length < 12:
+            raise ValueError('Bad pcapng block length {}'.format(block_length))
+        if not reader.ensure(block_length):
+            return
+        buf, pos = reader.buf, reader.pos
+        reader.pos = pos + block_length
+        body = pos + 8
+
+        if block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, caplen, _ = enhanced_packet.unpack_from(
+                buf, body
+            )
+            linktype, divisor = interfaces[interface]
+            timestamp = (high << 32 | low) / divisor
+            yield timestamp, linktype, buf, body + 20, body + 20 + caplen
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # No timestamp, so it goes down as when the last packet was
+            caplen = min(struct.unpack_from(byte_order + 'I', buf, body)[0],
+                         block_length - 16)
+            yield (timestamp, interfaces[0][0], buf, body + 4,
+                   body + 4 + caplen)
+        elif block_type == PCAPNG_PACKET:
+            interface, _, high, low, caplen, _ = packet.unpack_from(buf, body)
+            linktype, divisor = interfaces[interface]
+            timestamp = (high << 32 | low) / divisor
+            yield timestamp, linktype, buf, body + 20, body + 20 + caplen
+        elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype, = struct.unpack_from(byte_order + 'H', buf, body)
+            interfaces.append((linktype, _timestamp_divisor(
+                buf, body + 8, pos + block_length - 4, byte_order
+            )))
+
+
+def iter_capture_sightings(f):
+    """
+    Generator of sightings from the pcap or pcapng capture in binary file f,
+    read as it goes so f can be a pipe
+    """
+    reader = _ChunkReader(f)
+    if not reader.ensure(4):
+        return
+    if struct.unpack_from('<I', reader.buf)[0] == PCAPNG_SECTION_HEADER:
+        packets = _iter_pcapng(reader)
+    else:
+        packets = _iter_pcap(reader)
+    count = 0
+    try:
+        for timestamp, linktype, buf, start, end in packets:
+            count += 1
+            sighting = parse_packet(linktype, buf, start, end)
+            if sighting is not None:
+                yield (timestamp,) + sighting
+    finally:
+        metrics.count('passive.packets', count)
+
+
+def iter_live_sightings(interface=None, tick=1.0):
+    """
+    Generator of sightings from sniffing interface (all of them if None) as
+    they happen, plus a (now, None, None, None) every tick seconds so that
+    windows still get closed when it's quiet. Linux only, and needs root or
+    CAP_NET_RAW.
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(ETH_P_ALL))
+    try:
+        if interface:
+            sock.bind((interface, 0))
+        sock.settimeout(tick)
+        buf = bytearray(65536)
+        next_tick = time.time() + tick
+        while True:
+            try:
+                length, address = sock.recvfrom_into(buf)
+            except socket.timeout:
+                length = 0
+            now = time.time()
+            if length:
+                metrics.count('passive.packets')
+                # address is (interface, protocol, packet type, ARPHRD type,
+                # hardware address)
+                sighting = parse_packet(_ARPHRD_LINKTYPES.get(address[3]),
+                                        buf, 0, length)
+                if sighting is not None:
+                    yield (now,) + sighting
+            if now >= next_tick:
+                yield now, None, None, None
+                next_tick = now + tick
+    finally:
+        sock.close()
+
+
+def iter_scans(sightings, window=None):
+    """
+    Groups sightings into windows of window seconds (PASSIVE_WINDOW if
+    None), lined up on the epoch
+    generator of (timestamp, devices) for each window anything was seen in,
+    timestamp being the start of the window and devices being one dict per
+    mac like the active scan's
+
+    Sightings from before the current window (captures aren't always quite
+    in order) are counted in the current window.
+    """
+    if window is None:
+        window = settings.PASSIVE_WINDOW
+    current = None
+    devices = {}
+    for timestamp, mac_int, ip, hostname in sightings:
+        bucket = int(timestamp // window)
+        if current is None or bucket > current:
+            if devices:
+                yield (datetime.datetime.fromtimestamp(current * window),
+                       list(devices.values()))
+                devices = {}
+            current = bucket
+        if mac_int is None:
+            continue
+        device = devices.get(mac_int)
+        if device is None:
+            devices[mac_int] = {
+                'ip': ip,
+                'hostname': hostname,
+                'mac_hex_str': u.int_mac_to_hex_mac(mac_int),
+                'mac_int': mac_int,
+            }
+        else:
+            if ip:
+                device['ip'] = ip
+            if hostname:
+                device['hostname'] = hostname
+    if devices:
+        yield (datetime.datetime.fromtimestamp(current * window),
+               list(devices.values()))
+
+
+def _drop_unknown_random(devices):
+    """
+    returns devices without the randomised macs that have neither a
+    hostname nor been seen before, as each of those would be a new device
+    """
+    random = [device['mac_int'] for device in devices
+              if not device['hostname'] and
+              mac_codec.is_locally_administered(device['mac_int'])]
+    if not random:
+        return devices
+    known = dev_track.get_device_ids(random)
+    metrics.count('passive.skipped_random', len(random) - len(known))
+    return [device for device in devices
+            if device['mac_int'] in known or
+            device['hostname'] or
+            not mac_codec.is_locally_administered(device['mac_int'])]
+
+
+def record_scans(sightings, window=None, on_scan=None):
+    """
+    Saves every window of sightings as a scan, calling
+    on_scan(devices, timings) after each one like the active scan does,
+    each device having the 'device_id' it was saved under
+    returns how many scans were saved
+
+    Unknown randomised macs without a hostname are left out, and a window
+    with nothing else in it isn't saved at all.
+    """
+    scans = 0
+    for timestamp, devices in iter_scans(sightings, window):
+        stage_start = time.perf_counter()
+        devices = _drop_unknown_random(devices)
+        if not devices:
+            continue
+        device_ids = dev_track.record_scan(timestamp, devices)
+        for device in devices:
+            device['device_id'] = device_ids[device['mac_int']]
+        persist = time.perf_counter() - stage_start
+        metrics.observe('passive.persist', persist)
+        metrics.count('passive.devices', len(devices))
+        scans += 1
+        if on_scan is not None:
+            on_scan(devices, {
+                'timestamp': timestamp,
+                'devices': len(devices),
+                'persist': persist,
+            })
+    return scans
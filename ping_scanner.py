@@ -0,0 +1,323 @@
+"""
+asyncio ping sweeping
+
+A prober has a coroutine probe(ip, timeout) which returns True if the host
+answered, and a max_concurrency that the sweep won't go over.
+"""
+
+import asyncio
+import ipaddress
+import math
+import os
+import resource
+import socket
+import struct
+
+import metrics
+
+# File descriptors left for everything other than probes
+RESERVED_FDS = 64
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def _icmp_checksum(packet):
+    if len(packet) % 2:
+        packet += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(packet) // 2), packet))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpSocketProber:
+    """
+    Pings with an unprivileged ICMP datagram socket, which Linux allows when
+    the user's group is in net.ipv4.ping_group_range. Every probe goes out of
+    the one socket and replies are matched back up by address and sequence
+    number.
+
+    Raises PermissionError if the socket isn't allowed.
+    """
+    max_concurrency = 1024
+    # Every probe shares the one socket and costs next to no cpu
+    fds_per_probe = 0
+    probes_per_cpu = None
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                   socket.IPPROTO_ICMP)
+        self._sock.setblocking(False)
+        self._loop = None
+        self._waiting = {}
+        self._seq = 0
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, (ip, _) = self._sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Queued ICMP errors for earlier probes, nothing to match
+                continue
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, _, seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != ICMP_ECHO_REPLY:
+                continue
+            future = self._waiting.pop((ip, seq), None)
+            if future is not None and not future.done():
+                future.set_result(True)
+
+    def _attach(self, loop):
+        if self._loop is loop:
+            return
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._sock.fileno())
+        loop.add_reader(self._sock.fileno(), self._on_readable)
+        self._loop = loop
+        self._waiting = {}
+
+    async def probe(self, ip, timeout):
+        loop = asyncio.get_running_loop()
+        self._attach(loop)
+        self._seq = (self._seq + 1) & 0xFFFF
+        seq = self._seq
+        # The kernel swaps in its own identifier and fixes up the checksum
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, seq)
+        payload = b'pymacs'
+        checksum = _icmp_checksum(header + payload)
+        packet = header[:2] + struct.pack('!H', checksum) + header[4:] + payload
+
+        future = loop.create_future()
+        self._waiting[(ip, seq)] = future
+        try:
+            while True:
+                try:
+                    self._sock.sendto(packet, (ip, 0))
+                    break
+                except (BlockingIOError, InterruptedError):
+                    await asyncio.sleep(0.001)
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
+            return False
+        finally:
+            self._waiting.pop((ip, seq), None)
+
+    def close(self):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._sock.fileno())
+        self._loop = None
+        self._sock.close()
+
+
+class SubprocessProber:
+    """
+    Runs ping_bin once per probe, for when ICMP sockets aren't allowed
+    """
+    max_concurrency = 1024
+    # A pidfd and a pipe or two for each ping process
+    fds_per_probe = 3
+    probes_per_cpu = 32
+
+    def __init__(self, ping_bin='/bin/ping'):
+        self.ping_bin = ping_bin
+
+    async def probe(self, ip, timeout):
+        proc = await asyncio.create_subprocess_exec(
+            self.ping_bin, '-c1', '-W', str(max(1, math.ceil(timeout))), ip,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            # ping's own timeout should kick in first, this is just in case
+            return await asyncio.wait_for(proc.wait(), timeout + 1) == 0
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return False
+
+    def close(self):
+        pass
+
+
+class FakeProber:
+    """
+    Answers for live_ips after latency seconds, without any network, for
+    testing and benchmarking
+    """
+    max_concurrency = 4096
+    fds_per_probe = 0
+    probes_per_cpu = None
+
+    def __init__(self, live_ips=(), latency=0.0):
+        self.live_ips = set(live_ips)
+        self.latency = latency
+        self.probes = 0
+
+    async def probe(self, ip, timeout):
+        self.probes += 1
+        if ip in self.live_ips:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return True
+        await asyncio.sleep(min(timeout, self.latency))
+        return False
+
+    def close(self):
+        pass
+
+
+def default_prober(ping_bin='/bin/ping'):
+    try:
+        return IcmpSocketProber()
+    except OSError:
+        return SubprocessProber(ping_bin)
+
+
+class _RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_send = 0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        send_at = max(now, self.next_send)
+        self.next_send = send_at + self.interval
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
+def concurrency_budget(prober):
+    """
+    returns how many probes prober can have in flight at once on this
+    machine: its own max_concurrency, cut down to what the open file limit
+    leaves room for and, for probers that start processes, to
+    probes_per_cpu for each cpu
+    """
+    budget = prober.max_concurrency
+    if prober.fds_per_probe:
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit != resource.RLIM_INFINITY:
+            budget = min(budget, (soft_limit - RESERVED_FDS) //
+                         prober.fds_per_probe)
+    if prober.probes_per_cpu:
+        budget = min(budget, (os.cpu_count() or 1) * prober.probes_per_cpu)
+    return max(1, budget)
+
+
+def _as_networks(ip_networks):
+    """
+    ip_networks is a CIDR string or ipaddress network, or a list of them
+    """
+    if isinstance(ip_networks, (str, ipaddress.IPv4Network,
+                                ipaddress.IPv6Network)):
+        ip_networks = [ip_networks]
+    return [ipaddress.ip_network(ip_network, strict=False)
+            for ip_network in ip_networks]
+
+
+def _interleave_hosts(ip_networks):
+    """
+    Generator of (network, ip string) taking a host from each network in
+    turn, so every network is swept at the same time. Hosts in more than one
+    of the networks are only given once.
+    """
+    host_iters = [(str(ip_network), ip_network.hosts())
+                  for ip_network in ip_networks]
+    seen = set() if len(host_iters) > 1 else None
+    while host_iters:
+        for host_iter in list(host_iters):
+            network, hosts = host_iter
+            ip = next(hosts, None)
+            if ip is None:
+                host_iters.remove(host_iter)
+                continue
+            if seen is not None:
+                if ip in seen:
+                    continue
+                seen.add(ip)
+            yield network, str(ip)
+
+
+async def iter_tagged_live_hosts(ip_networks, prober, concurrency=None,
+                                 rate=None, timeout=1.0, retries=1):
+    """
+    Async generator of (network, ip) for the hosts in ip_networks (see
+    _as_networks) that answer, as soon as they answer, network being the
+    CIDR string of the one the ip was found in
+
+    All of the networks share the one pool of probes. concurrency caps
+    probes in flight (and is capped by concurrency_budget()), rate caps
+    probes sent per second, and hosts that don't answer are tried again up
+    to retries times
+    """
+    ip_networks = _as_networks(ip_networks)
+    budget = concurrency_budget(prober)
+    if concurrency is None:
+        concurrency = budget
+    concurrency = max(1, min(concurrency, budget, sum(
+        ip_network.num_addresses for ip_network in ip_networks
+    )))
+    limiter = _RateLimiter(rate) if rate else None
+    hosts = _interleave_hosts(ip_networks)
+    results = asyncio.Queue()
+    done = object()
+
+    async def worker():
+        for network, ip in hosts:
+            for _ in range(retries + 1):
+                if limiter is not None:
+                    await limiter.wait()
+                metrics.count('ping.probes')
+                if await prober.probe(ip, timeout):
+                    metrics.count('ping.live')
+                    await results.put((network, ip))
+                    break
+
+    async def run_workers():
+        try:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        finally:
+            await results.put(done)
+
+    runner = asyncio.ensure_future(run_workers())
+    try:
+        while True:
+            result = await results.get()
+            if result is done:
+                break
+            yield result
+        await runner
+    finally:
+        if not runner.done():
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+
+
+async def iter_live_hosts(ip_networks, prober, **kwargs):
+    """
+    Async generator of just the ips from iter_tagged_live_hosts
+    """
+    tagged_hosts = iter_tagged_live_hosts(ip_networks, prober, **kwargs)
+    try:
+        async for _, ip in tagged_hosts:
+            yield ip
+    finally:
+        await tagged_hosts.aclose()
+
+
+async def _collect_live_hosts(ip_network, prober, **kwargs):
+    return [ip async for ip in iter_live_hosts(ip_network, prober, **kwargs)]
+
+
+def ping_scan(ip_network, prober, **kwargs):
+    """
+    Blocking version of iter_live_hosts, returns a list of live ip strings
+    """
+    return asyncio.run(_collect_live_hosts(ip_network, prober, **kwargs))
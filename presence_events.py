@@ -0,0 +1,148 @@
+"""
+Turns scans into join/leave events, so whatever is listening only has to
+deal with who arrived or left rather than diffing whole timelines.
+
+Events are published as JSON lines like:
+
+    {"event": "join", "mac_address": "aa:bb:cc:dd:ee:ff", "hostname": "...",
+     "name": "...", "ip": "...", "timestamp": "2016-05-01T18:00:00"}
+"""
+
+import json
+import socket
+import sys
+
+import device_tracker as dev_track
+import my_utils as u
+
+
+class ChangeDetector:
+    """
+    Keeps track of who's present between scans, by device id so a device
+    whose randomised mac has been grouped with its old one by
+    device_tracker stays the same device. A device only joins once
+    it's been seen in join_after scans in a row, and only leaves once it's
+    been missing from leave_after scans in a row, so flapping devices don't
+    flood the stream.
+    """
+
+    def __init__(self, present=(), join_after=1, leave_after=1):
+        """
+        present is the device dicts (with at least 'device_id' and
+        'mac_int') counted as present to start with
+        """
+        self.join_after = join_after
+        self.leave_after = leave_after
+        self.devices = {device['device_id']: device for device in present}
+        self.present = set(self.devices)
+        self._missed = {}
+        self._pending = {}
+
+    @classmethod
+    def from_db(cls, join_after=1, leave_after=1):
+        """
+        Picks up where the last scan in the db left off
+        """
+        detector = cls(join_after=join_after, leave_after=leave_after)
+        sightings = dev_track.get_recent_sightings(
+            max(join_after, leave_after)
+        )
+        for device, scans_since_seen, run_scans in sightings:
+            device_id = device[0]
+            if run_scans >= join_after:
+                if scans_since_seen >= leave_after:
+                    continue
+                detector.present.add(device_id)
+                if scans_since_seen:
+                    detector._missed[device_id] = scans_since_seen
+            elif not scans_since_seen:
+                detector._pending[device_id] = run_scans
+            detector.devices[device_id] = {
+                'device_id': device_id,
+                'mac_int': device[1],
+                'hostname': device[2],
+                'name': device[3],
+            }
+        return detector
+
+    def _event(self, event, device_id, timestamp):
+        # The mac is whichever the device was last seen with
+        device = self.devices[device_id]
+        return {
+            'event': event,
+            'mac_address': u.int_mac_to_hex_mac(device['mac_int']),
+            'hostname': device.get('hostname'),
+            'name': device.get('name'),
+            'ip': device.get('ip'),
+            'timestamp': timestamp.isoformat(),
+        }
+
+    def update(self, devices, timestamp):
+        """
+        devices is everything seen in the scan at timestamp, each with the
+        'device_id' that device_tracker.record_scan() gave its mac
+        returns the list of events it caused
+        """
+        events = []
+        seen = set()
+        for device in devices:
+            device_id = device['device_id']
+            if device_id in seen:
+                continue
+            seen.add(device_id)
+            self.devices[device_id] = dict(self.devices.get(device_id, {}),
+                                           **device)
+            if device_id in self.present:
+                self._missed.pop(device_id, None)
+                continue
+            pending = self._pending.get(device_id, 0) + 1
+            if pending >= self.join_after:
+                self._pending.pop(device_id, None)
+                self.present.add(device_id)
+                events.append(self._event('join', device_id, timestamp))
+            else:
+                self._pending[device_id] = pending
+
+        for device_id in list(self._pending):
+            if device_id not in seen:
+                del self._pending[device_id]
+
+        for device_id in self.present - seen:
+            missed = self._missed.get(device_id, 0) + 1
+            if missed >= self.leave_after:
+                self._missed.pop(device_id, None)
+                self.present.discard(device_id)
+                events.append(self._event('leave', device_id, timestamp))
+            else:
+                self._missed[device_id] = missed
+        return events
+
+
+class JsonLinesPublisher:
+    """
+    Writes events to dest, which is '-' for stdout, unix:PATH to connect to
+    a unix socket, or a file name to append to
+    """
+
+    def __init__(self, dest):
+        self._sock = None
+        if dest == '-':
+            self._file = sys.stdout
+        elif dest.startswith('unix:'):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(dest[len('unix:'):])
+            self._file = self._sock.makefile('w')
+        else:
+            self._file = open(dest, 'a')
+
+    def publish(self, events):
+        for event in events:
+            self._file.write(json.dumps(event))
+            self._file.write('\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+        if self._sock is not None:
+            self._sock.close()
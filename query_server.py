@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+A small HTTP server for the device and organisation lookups, so things that
+poll them don't have to start a fresh process for every query.
+
+    GET  /devices                    every device, with its organisations
+    GET  /devices/<mac>/history      [{"timestamp": ..., "present": ...}],
+                                     takes ?since=WHEN&until=WHEN
+    GET  /oui/<mac>                  organisations owning mac
+    POST /oui                        body is a JSON list of macs, returns
+                                     [{"mac_address": ..., "organisation": ...}]
+
+GET responses carry an ETag that only changes when the db does, so polling
+with If-None-Match gets a 304 until the next scan.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import urllib.parse
+
+from config import settings
+import mac_db
+import mac_codec
+import org_matcher as mac_org
+import device_tracker as dev_track
+import my_utils as u
+
+# Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1024 * 1024
+
+# Items written per chunk of a streamed response
+STREAM_CHUNK_ITEMS = 500
+
+# Cached history responses kept per ETag
+HISTORY_CACHE_SIZE = 256
+
+_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message=None):
+        super().__init__(message or _REASONS[status])
+        self.status = status
+
+
+def _parse_mac(mac_str):
+    try:
+        return mac_codec.parse_mac(mac_str)
+    except ValueError as e:
+        raise HttpError(400, str(e))
+
+
+class QueryCache:
+    """
+    Everything the server reads from the db goes through here. All of it is
+    run on a single worker thread, so there's only ever the one connection
+    and PRAGMA data_version on it notices every write from other processes.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._data_version = None
+        self._registry_files = None
+        self.etag = None
+        self._devices = None
+        self._history = {}
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def refresh(self):
+        """
+        Throws away anything cached from before the db last changed
+        returns the current ETag
+        """
+        conn = mac_db.get_connection(settings.MAC_DB_FNAME)
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return self.etag
+        self._data_version = data_version
+        self._devices = None
+        self._history = {}
+
+        # Only rebuild the OUI index when the registries were re-imported,
+        # not for every scan
+        registry_files = mac_org._get_registry_files(settings.MAC_DB_FNAME)
+        if registry_files != self._registry_files:
+            self._registry_files = registry_files
+            mac_org.invalidate_index()
+            mac_org.warm_index()
+
+        last_scan = dev_track.get_last_scan_time()
+        self.etag = '"{}-{}"'.format(
+            last_scan.isoformat() if last_scan else 'none', data_version
+        )
+        return self.etag
+
+    def devices(self):
+        """
+        returns {mac_int: device dict}
+        """
+        if self._devices is None:
+            all_devices = dev_track.all_devices()
+            organisations = mac_org.search_by_mac_addresses(
+                device[1] for device in all_devices
+            )
+            self._devices = {}
+            for device, (mac_int, orgs) in zip(all_devices, organisations):
+                self._devices[mac_int] = {
+                    'mac_address': u.int_mac_to_hex_mac(mac_int),
+                    'last_hostname': device[2],
+                    'name': device[3],
+                    'organisation': orgs,
+                }
+        return self._devices
+
+    def history(self, mac_int, since, until):
+        key = (mac_int, since, until)
+        if key not in self._history:
+            if len(self._history) >= HISTORY_CACHE_SIZE:
+                self._history.pop(next(iter(self._history)))
+            self._history[key] = [
+                {'timestamp': time_stamp.isoformat(), 'present': present}
+                for time_stamp, present in
+                dev_track.get_device_history_mac_string(
+                    u.int_mac_to_hex_mac(mac_int), (since, until)
+                )
+            ]
+        return self._history[key]
+
+    def organisations(self, mac_addresses):
+        return [
+            {'mac_address': mac_address, 'organisation': orgs}
+            for mac_address, orgs in
+            mac_org.search_by_mac_addresses(mac_addresses)
+        ]
+
+
+class Request:
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+async def _read_request(reader):
+    """
+    returns the next Request on the connection, or None once it's closed
+    """
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(400)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = b''
+    if method == 'POST':
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            raise HttpError(411)
+        if length > MAX_BODY_SIZE:
+            raise HttpError(413)
+        body = await reader.readexactly(length)
+
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    path = [urllib.parse.unquote(part)
+            for part in url.path.strip('/').split('/') if part]
+    return Request(method, path, query, headers, body)
+
+
+class Response:
+
+    def __init__(self, writer, keep_alive):
+        self._writer = writer
+        self.keep_alive = keep_alive
+
+    def _head(self, status, headers):
+        lines = ['HTTP/1.1 {} {}'.format(status, _REASONS[status])]
+        headers = dict(headers)
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        lines.extend('{}: {}'.format(*header) for header in headers.items())
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send(self, status, obj=None, headers=()):
+        body = b'' if obj is None else json.dumps(obj).encode()
+        headers = dict(headers)
+        headers['Content-Length'] = len(body)
+        if obj is not None:
+            headers['Content-Type'] = 'application/json'
+        self._head(status, headers)
+        self._writer.write(body)
+        await self._writer.drain()
+
+    async def stream(self, items, headers=()):
+        """
+        Sends items as a JSON list, a few at a time, so a big response
+        doesn't have to be encoded in one go before any of it goes out
+        """
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        headers['Transfer-Encoding'] = 'chunked'
+        self._head(200, headers)
+        separator = '['
+        for pos in range(0, len(items), STREAM_CHUNK_ITEMS):
+            chunk = separator + ','.join(
+                json.dumps(item) for item in items[pos:pos+STREAM_CHUNK_ITEMS]
+            )
+            separator = ','
+            self._write_chunk(chunk.encode())
+            await self._writer.drain()
+        self._write_chunk(b']' if items else b'[]')
+        self._writer.write(b'0\r\n\r\n')
+        await self._writer.drain()
+
+    def _write_chunk(self, data):
+        self._writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+
+async def _get_devices(cache, request, response, etag):
+    devices = await cache.run(cache.devices)
+    await response.stream(list(devices.values()), {'ETag': etag})
+
+
+async def _get_device_history(cache, request, response, etag):
+    mac_int = _parse_mac(request.path[1])
+    try:
+        since, until = (
+            u.parse_datetime(request.query[key])
+            if request.query.get(key) else None
+            for key in ('since', 'until')
+        )
+    except ValueError as e:
+        raise HttpError(400, str(e))
+    # Randomised macs aliased onto a device aren't in cache.devices()
+    if await cache.run(dev_track.get_device_id, mac_int) is None:
+        raise HttpError(404, 'Unknown device: {}'.format(request.path[1]))
+    history = await cache.run(cache.history, mac_int, since, until)
+    headers = {'ETag': etag}
+    if any(key in request.query for key in ('since', 'until')):
+        # Relative times mean something different every time they're asked
+        headers = {'Cache-Control': 'no-cache'}
+    await response.stream(history, headers)
+
+
+async def _get_oui(cache, request, response, etag):
+    mac_int = _parse_mac(request.path[1])
+    orgs = await cache.run(mac_org.search_by_mac_address_int, mac_int)
+    await response.send(200, orgs, {'ETag': etag})
+
+
+async def _post_oui(cache, request, response):
+    try:
+        mac_addresses = json.loads(request.body.decode())
+    except ValueError:
+        raise HttpError(400, 'Body must be a JSON list of mac addresses')
+    if (not isinstance(mac_addresses, list) or
+            not all(isinstance(mac, str) for mac in mac_addresses)):
+        raise HttpError(400, 'Body must be a JSON list of mac addresses')
+    for mac_address in mac_addresses:
+        _parse_mac(mac_address)
+    organisations = await cache.run(cache.organisations, mac_addresses)
+    await response.stream(organisations)
+
+
+async def _route(cache, request, response):
+    path = request.path
+    if path[:1] == ['oui'] and len(path) == 1:
+        if request.method != 'POST':
+            raise HttpError(405)
+        await _post_oui(cache, request, response)
+        return
+
+    if path == ['devices']:
+        handler = _get_devices
+    elif len(path) == 3 and path[0] == 'devices' and path[2] == 'history':
+        handler = _get_device_history
+    elif len(path) == 2 and path[0] == 'oui':
+        handler = _get_oui
+    else:
+        raise HttpError(404)
+    if request.method != 'GET':
+        raise HttpError(405)
+
+    etag = await cache.run(cache.refresh)
+    if (request.headers.get('if-none-match') == etag and
+            not set(request.query) & {'since', 'until'}):
+        await response.send(304, headers={'ETag': etag})
+        return
+    await handler(cache, request, response, etag)
+
+
+async def _handle_connection(cache, reader, writer):
+    try:
+        while True:
+            response = Response(writer, keep_alive=False)
+            try:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                response.keep_alive = (
+                    request.headers.get('connection', '').lower() != 'close'
+                )
+                await _route(cache, request, response)
+            except HttpError as e:
+                await response.send(e.status, {'error': str(e)})
+            if not response.keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=None, port=None):
+    """
+    Serves queries on host:port (QUERY_SERVER_HOST/QUERY_SERVER_PORT if
+    None) until cancelled
+    """
+    if host is None:
+        host = settings.QUERY_SERVER_HOST
+    if port is None:
+        port = settings.QUERY_SERVER_PORT
+    cache = QueryCache()
+    # Get the tables and the OUI index ready before the first request
+    await cache.run(dev_track.init_tables)
+    await cache.run(cache.refresh)
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_connection(cache, reader, writer),
+        host, port,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve device history and mac lookups over HTTP'
+    )
+    parser.add_argument(
+        '-H', '--host',
+        help=('Address to listen on, QUERY_SERVER_HOST by default')
+    )
+    parser.add_argument(
+        '-p', '--port', type=int,
+        help=('Port to listen on, QUERY_SERVER_PORT by default')
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,210 @@
+"""
+Keeps the tracking tables from growing forever.
+
+Scans from the last RAW_RETENTION are kept as they are. Older than that,
+only the first scan in each ROLLUP_INTERVAL is kept, with every device seen
+at any point in the interval marked as seen in it, and anything older than
+ROLLUP_RETENTION is deleted along with the presence runs that ended before
+it. Everything is deleted PRUNE_BATCH_SIZE rows per transaction so a scan
+running at the same time is never held up for long.
+"""
+
+import datetime
+from config import settings
+import mac_db
+
+PRUNE_BATCH_SIZE = 1000
+
+# Pages handed back to the filesystem per incremental vacuum step
+VACUUM_PAGES = 256
+
+
+def _delete_time_stamps(db_fname, time_stamp_ids, batch_size):
+    for pos in range(0, len(time_stamp_ids), batch_size):
+        batch = [(time_stamp_id,) for time_stamp_id
+                 in time_stamp_ids[pos:pos+batch_size]]
+        with mac_db.get_connection(db_fname) as conn:
+            c = conn.cursor()
+            # Anything left over from before presence runs
+            c.executemany('''
+            DELETE FROM time_line WHERE time_line_time_stamp_id = ?
+            ''', batch)
+            c.executemany('''
+            DELETE FROM time_stamp WHERE time_stamp_id = ?
+            ''', batch)
+
+
+def _rollup_time_stamp_ids(db_fname, since, until):
+    """
+    returns (ids of all but the first scan in each ROLLUP_INTERVAL between
+    since and until, {time of each of those: time of the first})
+    """
+    interval = settings.ROLLUP_INTERVAL.total_seconds()
+    with mac_db.get_connection(db_fname) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT time_stamp_id, time_stamp_datetime FROM time_stamp
+        WHERE time_stamp_datetime >= ? AND time_stamp_datetime < ?
+        ORDER BY time_stamp_datetime
+        ''', (since, until))
+        time_stamp_ids = []
+        kept = {}
+        last_bucket = None
+        for time_stamp_id, time_stamp in c:
+            bucket = (time_stamp - since).total_seconds() // interval
+            if bucket == last_bucket:
+                time_stamp_ids.append(time_stamp_id)
+                kept[time_stamp] = kept_time_stamp
+            else:
+                kept_time_stamp = time_stamp
+            last_bucket = bucket
+    return time_stamp_ids, kept
+
+
+def _rolled_up_runs(runs, kept):
+    """
+    runs is [(presence_id, device_id, first_seen, last_seen)] ordered by
+    device and first_seen
+    returns ([(first_seen, last_seen, presence_id)] to update,
+    [(presence_id,)] to delete)
+    """
+    joined = []
+    deleted = []
+    for presence_id, device_id, first_seen, last_seen in runs:
+        run = [presence_id, device_id, kept.get(first_seen, first_seen),
+               kept.get(last_seen, last_seen), (first_seen, last_seen)]
+        if joined and joined[-1][1] == device_id and run[2] <= joined[-1][3]:
+            deleted.append((presence_id,))
+            joined[-1][3] = max(joined[-1][3], run[3])
+        else:
+            joined.append(run)
+    updated = [(first_seen, last_seen, presence_id)
+               for presence_id, _, first_seen, last_seen, was in joined
+               if (first_seen, last_seen) != was]
+    return updated, deleted
+
+
+def _rollup_presence(db_fname, since, until, kept, batch_size):
+    """
+    Moves the ends of presence runs between since and until from scans
+    that are being rolled up to the scan kept in their place (see
+    _rollup_time_stamp_ids), so a visit that fell between two kept scans
+    still shows up in the one before it. Runs that end up overlapping are
+    joined.
+
+    batch_size devices' runs are read and rewritten at a time, in one write
+    transaction, so a scan extending one of them meanwhile either goes
+    first or waits rather than being undone.
+    """
+    with mac_db.get_connection(db_fname) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT DISTINCT presence_device_id FROM presence
+        WHERE presence_last_seen >= ? AND presence_first_seen < ?
+        ORDER BY presence_device_id
+        ''', (since, until))
+        device_ids = [device_id for device_id, in c.fetchall()]
+
+    for pos in range(0, len(device_ids), batch_size):
+        batch = device_ids[pos:pos+batch_size]
+        with mac_db.get_connection(db_fname) as conn:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            c.execute('''
+            SELECT presence_id, presence_device_id, presence_first_seen,
+                   presence_last_seen
+            FROM presence
+            WHERE presence_device_id >= ? AND presence_device_id <= ? AND
+                  presence_last_seen >= ? AND presence_first_seen < ?
+            ORDER BY presence_device_id, presence_first_seen
+            ''', (batch[0], batch[-1], since, until))
+            updated, deleted = _rolled_up_runs(c.fetchall(), kept)
+            c.executemany('''
+            UPDATE presence SET presence_first_seen = ?, presence_last_seen = ?
+            WHERE presence_id = ?
+            ''', updated)
+            c.executemany('''
+            DELETE FROM presence WHERE presence_id = ?
+            ''', deleted)
+
+
+def _expired_time_stamp_ids(db_fname, before):
+    with mac_db.get_connection(db_fname) as conn:
+        c = conn.cursor()
+        c.execute('''
+        SELECT time_stamp_id FROM time_stamp WHERE time_stamp_datetime < ?
+        ''', (before,))
+        return [time_stamp_id for time_stamp_id, in c.fetchall()]
+
+
+def _delete_expired_presence(db_fname, before, batch_size):
+    deleted = 0
+    while True:
+        with mac_db.get_connection(db_fname) as conn:
+            c = conn.cursor()
+            c.execute('''
+            DELETE FROM presence WHERE presence_id IN (
+                SELECT presence_id FROM presence
+                WHERE presence_last_seen < ?
+                LIMIT ?
+            )
+            ''', (before, batch_size))
+            deleted += c.rowcount
+            if c.rowcount < batch_size:
+                return deleted
+
+
+def incremental_vacuum(db_fname=None, pages=VACUUM_PAGES):
+    """
+    Hands free pages back to the filesystem a few at a time, if the db was
+    created with auto_vacuum=INCREMENTAL (see enable_incremental_vacuum)
+    """
+    if db_fname is None:
+        db_fname = settings.MAC_DB_FNAME
+    conn = mac_db.get_connection(db_fname)
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return
+    while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        conn.execute('PRAGMA incremental_vacuum({})'.format(pages)).fetchall()
+
+
+def enable_incremental_vacuum(db_fname=None):
+    """
+    Switches a db made before auto_vacuum was set over to it. This needs a
+    full VACUUM, which locks the db for a while, so only has to be done once.
+    """
+    if db_fname is None:
+        db_fname = settings.MAC_DB_FNAME
+    conn = mac_db.get_connection(db_fname)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+def prune(now=None, batch_size=PRUNE_BATCH_SIZE, db_fname=None):
+    """
+    Applies the retention policy as of now
+
+    returns the number of scans rolled up, scans expired and presence runs
+    expired
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    if db_fname is None:
+        db_fname = settings.MAC_DB_FNAME
+    raw_cutoff = now - settings.RAW_RETENTION
+    rollup_cutoff = now - settings.ROLLUP_RETENTION
+
+    rolled_up, kept = _rollup_time_stamp_ids(db_fname, rollup_cutoff,
+                                             raw_cutoff)
+    _rollup_presence(db_fname, rollup_cutoff, raw_cutoff, kept, batch_size)
+    _delete_time_stamps(db_fname, rolled_up, batch_size)
+    expired = _expired_time_stamp_ids(db_fname, rollup_cutoff)
+    _delete_time_stamps(db_fname, expired, batch_size)
+    expired_presence = _delete_expired_presence(db_fname, rollup_cutoff,
+                                                batch_size)
+    incremental_vacuum(db_fname)
+    return {
+        'rolled_up': len(rolled_up),
+        'expired': len(expired),
+        'expired_presence': expired_presence,
+    }
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+# The modules live at the top of the repo rather than in a package
+sys.path.insert(0, os.path.dirname(TESTS))
+
+FIXTURES = os.path.join(TESTS, 'fixtures')
+
+
+def fixture_path(fname):
+    return os.path.join(FIXTURES, fname)
+
+
+@pytest.fixture
+def tracker_db(tmp_path, monkeypatch):
+    """
+    An empty device db of its own for the test
+    """
+    from config import settings
+    import device_tracker
+    monkeypatch.setattr(settings, 'MAC_DB_FNAME', str(tmp_path / 'mac.db'))
+    device_tracker.init_tables()
+    return settings.MAC_DB_FNAME
@@ -0,0 +1,111 @@
+import pytest
+
+from conftest import fixture_path
+import device_scanner
+import device_tracker
+import ping_scanner
+
+
+def test_parse_proc_arp():
+    with open(fixture_path('proc_net_arp.txt')) as f:
+        assert device_scanner.parse_proc_arp(f) == {
+            '192.168.1.1': '00:11:22:33:44:01',
+            '192.168.1.10': '00:11:22:33:44:55',
+            '192.168.1.12': '00:11:22:33:44:0c',
+        }
+
+
+def test_parse_ip_neigh():
+    with open(fixture_path('ip_neigh.txt')) as f:
+        assert device_scanner.parse_ip_neigh(f) == {
+            '192.168.1.1': '00:11:22:33:44:01',
+            '192.168.1.10': '00:11:22:33:44:55',
+            'fe80::1': '00:11:22:33:44:01',
+        }
+
+
+def test_read_neighbour_table_either_format():
+    proc_arp = device_scanner.read_neighbour_table(
+        fixture_path('proc_net_arp.txt')
+    )
+    ip_neigh = device_scanner.read_neighbour_table(
+        fixture_path('ip_neigh.txt')
+    )
+    assert proc_arp['192.168.1.10'] == ip_neigh['192.168.1.10']
+    assert '192.168.1.12' in proc_arp
+    assert '192.168.1.12' not in ip_neigh
+
+
+def test_arp_ips_from_neighbour_table(monkeypatch):
+    # No reverse lookups from the tests
+    monkeypatch.setattr(device_scanner, '_hostname', lambda ip: ip)
+    devices = device_scanner.arp_ips(
+        ['192.168.1.10', '192.168.1.11', '192.168.1.2'], '/bin/false',
+        '00:11:22:33:44:02', '192.168.1.2',
+        neighbour_table_path=fixture_path('proc_net_arp.txt'),
+    )
+    assert [(device['ip'], device['mac_int']) for device in devices] == [
+        ('192.168.1.10', 0x001122334455),
+        ('192.168.1.2', 0x001122334402),
+    ]
+    assert devices[1]['hostname'] == 'Yourself'
+
+
+class FailingProber(ping_scanner.FakeProber):
+
+    async def probe(self, ip, timeout):
+        if ip == '192.168.1.5':
+            raise FileNotFoundError('/bin/ping')
+        return await super().probe(ip, timeout)
+
+
+def scan(prober, stop_after=None, timings=None):
+    devices = []
+    scanner = device_scanner.scan_add_and_update_macs(
+        '192.168.1.0/28', '/bin/false', '/bin/false', None, prober=prober,
+        neighbour_table_path=fixture_path('ip_neigh.txt'), timings=timings,
+        timeout=0,
+    )
+    try:
+        for device in scanner:
+            devices.append(device)
+            if stop_after and len(devices) >= stop_after:
+                break
+    finally:
+        scanner.close()
+    return devices
+
+
+def test_scan_add_and_update_macs(tracker_db, monkeypatch):
+    monkeypatch.setattr(device_scanner, '_hostname', lambda ip: ip)
+    timings = {}
+    devices = scan(ping_scanner.FakeProber(['192.168.1.1', '192.168.1.10',
+                                            '192.168.1.11']), timings=timings)
+    # 192.168.1.11 answered but FAILED in the neighbour table
+    assert sorted(device['ip'] for device in devices) == [
+        '192.168.1.1', '192.168.1.10',
+    ]
+    assert all(device['network'] == '192.168.1.0/28' for device in devices)
+    saved = {device[1]: device[0] for device in device_tracker.all_devices()}
+    assert {device['mac_int']: device['device_id'] for device in devices} == \
+        saved
+    assert timings['devices'] == 2
+    assert timings['first_device'] <= timings['total']
+    assert device_tracker.get_last_scan_time() == timings['timestamp']
+
+
+def test_unfinished_scans_are_discarded(tracker_db, monkeypatch):
+    monkeypatch.setattr(device_scanner, '_hostname', lambda ip: ip)
+    live = ['192.168.1.1', '192.168.1.10']
+    scan(ping_scanner.FakeProber(live))
+    first_scan = device_tracker.get_last_scan_time()
+
+    # Stopped part way, and failed part way
+    assert len(scan(ping_scanner.FakeProber(live), stop_after=1)) == 1
+    with pytest.raises(FileNotFoundError):
+        scan(FailingProber(live))
+    assert device_tracker.get_last_scan_time() == first_scan
+
+    scan(ping_scanner.FakeProber(live))
+    for _, history in device_tracker.get_all_device_history():
+        assert [present for _, present in history] == [True, True]
@@ -0,0 +1,195 @@
+"""
+Presence runs checked against the obvious model: a device is in a run from
+one scan it was seen in to the next as long as it was seen in every scan in
+between, or the gap between sightings is within PRESENCE_GAP_TOLERANCE.
+"""
+
+import datetime
+import random
+
+import pytest
+
+import device_tracker
+import mac_db
+from config import settings
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+MACS = [0x001122000001, 0x001122000002, 0x001122000003]
+
+
+def at(minutes):
+    return T0 + datetime.timedelta(minutes=minutes)
+
+
+def device(mac_int):
+    return {'mac_int': mac_int, 'hostname': None}
+
+
+def runs():
+    """
+    returns {mac_int: [(first_seen, last_seen)]}
+    """
+    c = mac_db.get_connection(settings.MAC_DB_FNAME).cursor()
+    c.execute('''
+    SELECT device_mac_addr, presence_first_seen, presence_last_seen
+    FROM presence JOIN device ON presence_device_id = device_id
+    ORDER BY 1, 2
+    ''')
+    found = {}
+    for mac_int, first_seen, last_seen in c.fetchall():
+        found.setdefault(mac_int, []).append((first_seen, last_seen))
+    return found
+
+
+def model_runs(scans, tolerance):
+    """
+    scans is {timestamp: set of mac_ints seen}
+    """
+    times = sorted(scans)
+    expected = {}
+    for mac_int in MACS:
+        mac_runs = []
+        previous_scan = None
+        for timestamp in times:
+            if mac_int in scans[timestamp]:
+                if mac_runs and (mac_runs[-1][1] == previous_scan or
+                                 timestamp - mac_runs[-1][1] <= tolerance):
+                    mac_runs[-1] = (mac_runs[-1][0], timestamp)
+                else:
+                    mac_runs.append((timestamp, timestamp))
+            previous_scan = timestamp
+        if mac_runs:
+            expected[mac_int] = mac_runs
+    return expected
+
+
+@pytest.fixture
+def tolerance(monkeypatch, request):
+    tolerance = getattr(request, 'param', datetime.timedelta(0))
+    monkeypatch.setattr(settings, 'PRESENCE_GAP_TOLERANCE', tolerance)
+    return tolerance
+
+
+def test_runs_extend_and_close(tracker_db, tolerance):
+    device_tracker.record_scan(at(0), [device(MACS[0])])
+    device_tracker.record_scan(at(1), [device(MACS[0]), device(MACS[1])])
+    device_tracker.record_scan(at(2), [device(MACS[1])])
+    device_tracker.record_scan(at(3), [device(MACS[0])])
+    assert runs() == {
+        MACS[0]: [(at(0), at(1)), (at(3), at(3))],
+        MACS[1]: [(at(1), at(2))],
+    }
+
+
+@pytest.mark.parametrize('tolerance', [datetime.timedelta(minutes=2)],
+                         indirect=True)
+def test_gap_tolerance(tracker_db, tolerance):
+    for minute, seen in [(0, True), (1, False), (2, True), (3, False),
+                         (4, False), (5, False), (6, True)]:
+        device_tracker.record_scan(at(minute),
+                                   [device(MACS[0])] if seen else [])
+    assert runs() == {MACS[0]: [(at(0), at(2)), (at(6), at(6))]}
+
+
+def test_split_batches(tracker_db, tolerance):
+    # The streaming scan saves a scan a batch at a time
+    device_tracker.record_scan(at(0), [device(MACS[0])])
+    device_tracker.record_scan(at(0), [device(MACS[1])])
+    device_tracker.record_scan(at(0), [])
+    device_tracker.record_scan(at(1), [device(MACS[1])])
+    device_tracker.record_scan(at(1), [device(MACS[0]), device(MACS[1])])
+    assert runs() == {
+        MACS[0]: [(at(0), at(1))],
+        MACS[1]: [(at(0), at(1))],
+    }
+
+
+def test_out_of_order_scan(tracker_db, tolerance):
+    for minute in (0, 1, 3, 5):
+        device_tracker.record_scan(at(minute),
+                                   [device(MACS[0]), device(MACS[1])])
+    # Seen A but not B, so B's run is split around it
+    device_tracker.record_scan(at(2), [device(MACS[0])])
+    # Seen B but not A, in between B's runs
+    device_tracker.record_scan(at(4), [device(MACS[1])])
+    assert runs() == {
+        MACS[0]: [(at(0), at(3)), (at(5), at(5))],
+        MACS[1]: [(at(0), at(1)), (at(3), at(5))],
+    }
+    assert [present for _, present in device_tracker.
+            get_device_history_mac_string('00:11:22:00:00:01')] == [
+        True, True, True, True, False, True,
+    ]
+
+
+def test_discard_scan(tracker_db, tolerance):
+    for minute in range(4):
+        device_tracker.record_scan(
+            at(minute), [device(MACS[0])] if minute != 1 else []
+        )
+    device_tracker.record_scan(at(4), [device(MACS[1])])
+    device_tracker.discard_scan(at(1))
+    device_tracker.discard_scan(at(4))
+    assert runs() == {MACS[0]: [(at(0), at(3))]}
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('tolerance', [
+    datetime.timedelta(0), datetime.timedelta(minutes=2, seconds=30),
+], indirect=True)
+def test_matches_model(tracker_db, tolerance, seed):
+    r = random.Random(seed)
+    minutes = r.sample(range(20), 12)
+    if r.random() < 0.5:
+        # Mostly in order, with a few late arrivals
+        minutes.sort()
+        late = minutes.pop(r.randrange(len(minutes)))
+        minutes.insert(r.randrange(len(minutes) + 1), late)
+    scans = {}
+    for minute in minutes:
+        seen = {mac_int for mac_int in MACS if r.random() < 0.6}
+        scans[at(minute)] = seen
+        devices = [device(mac_int) for mac_int in seen]
+        split = r.randrange(len(devices) + 1)
+        device_tracker.record_scan(at(minute), devices[:split])
+        if split < len(devices) or r.random() < 0.3:
+            device_tracker.record_scan(at(minute), devices[split:])
+    assert runs() == model_runs(scans, tolerance)
+
+    if not tolerance:
+        # With a tolerance a run cut back by a discard can end on a scan
+        # the device wasn't seen in, which the model can't know about
+        for minute in r.sample(minutes, 4):
+            device_tracker.discard_scan(at(minute))
+            del scans[at(minute)]
+        assert runs() == model_runs(scans, tolerance)
+
+
+def test_migrate_time_line(tracker_db, tolerance):
+    seen = {
+        MACS[0]: [0, 1, 2, 4],
+        MACS[1]: [2, 3],
+    }
+    with mac_db.get_connection(settings.MAC_DB_FNAME) as conn:
+        c = conn.cursor()
+        c.executemany('''
+        INSERT INTO time_stamp (time_stamp_datetime) VALUES (?)
+        ''', [(at(minute),) for minute in range(5)])
+        for mac_int, minutes in seen.items():
+            c.execute('''
+            INSERT INTO device (device_mac_addr) VALUES (?)
+            ''', (mac_int,))
+            c.executemany('''
+            INSERT INTO time_line
+                (time_line_device_id, time_line_time_stamp_id)
+            SELECT device_id, time_stamp_id FROM device, time_stamp
+            WHERE device_mac_addr = ? AND time_stamp_datetime = ?
+            ''', [(mac_int, at(minute)) for minute in minutes])
+    assert device_tracker.migrate_time_line() == (6, 3)
+    assert runs() == {
+        MACS[0]: [(at(0), at(2)), (at(4), at(4))],
+        MACS[1]: [(at(2), at(3))],
+    }
+    c = mac_db.get_connection(settings.MAC_DB_FNAME).cursor()
+    c.execute('SELECT COUNT(*) FROM time_line')
+    assert c.fetchone() == (0,)
@@ -0,0 +1,53 @@
+import datetime
+
+import numpy as np
+
+import device_tracker
+import graph_drawing
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+
+
+def read_png(fname):
+    import matplotlib.image
+    return matplotlib.image.imread(fname)
+
+
+def test_draw_presence(tracker_db, tmp_path, monkeypatch):
+    for minute in range(0, 60, 5):
+        device_tracker.record_scan(
+            T0 + datetime.timedelta(minutes=minute),
+            [{'mac_int': 0x001122334455, 'hostname': 'phone'}]
+            if minute < 30 else []
+        )
+    fname = str(tmp_path / 'presence.png')
+    cache_fname = str(tmp_path / 'graph_cache.pickle')
+    until = T0 + datetime.timedelta(hours=1)
+
+    assert graph_drawing.draw_presence(fname, T0, until, width=60,
+                                       cache_fname=cache_fname)
+    image = read_png(fname)
+    assert image.shape[2] == 3
+    # Present in the first half only
+    row = image[image.shape[0] // 3, :, 0]
+    assert (row == 0).any() and (row == 1).any()
+    assert not graph_drawing.draw_presence(fname, T0, until, width=60,
+                                           cache_fname=cache_fname)
+
+    # Moving the window on only paints the strips into the cached frame
+    def no_frame(*args):
+        raise AssertionError('frame drawn again')
+    monkeypatch.setattr(graph_drawing, '_draw_frame', no_frame)
+    later = datetime.timedelta(minutes=5)
+    assert graph_drawing.draw_presence(fname, T0 + later, until + later,
+                                       width=60, cache_fname=cache_fname)
+    assert np.array_equal(read_png(fname).shape, image.shape)
+
+
+def test_write_png(tmp_path):
+    rgb = np.zeros((3, 5, 3), dtype=np.uint8)
+    rgb[1, 2] = (255, 128, 0)
+    fname = str(tmp_path / 'tiny.png')
+    with open(fname, 'wb') as f:
+        graph_drawing._write_png(f, rgb)
+    assert np.array_equal((read_png(fname) * 255).round(), rgb)
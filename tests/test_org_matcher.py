@@ -0,0 +1,98 @@
+"""
+update_db() against a local HTTP stand-in for the IEEE registry, serving
+fixtures/oui.csv as MA-L and empty MA-M and MA-S registries
+"""
+
+import http.server
+import threading
+
+import pytest
+
+from conftest import fixture_path
+from config import settings
+import org_matcher
+
+HEADER = b'Registry,Assignment,Organization Name,Organization Address\n'
+
+
+class _RegistryHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/oui/oui.csv':
+            with open(fixture_path('oui.csv'), 'rb') as f:
+                body = f.read()
+        elif self.path in ('/oui28/mam.csv', '/oui36/oui36.csv'):
+            body = HEADER
+        else:
+            self.send_error(404)
+            return
+        etag = '"{}"'.format(len(body))
+        self.server.requests.append((self.path,
+                                     self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def registry():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             _RegistryHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def mac_db_fname(tmp_path, monkeypatch):
+    # Registries are downloaded into the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'MAC_DB_FNAME', str(tmp_path / 'mac.db'))
+    org_matcher.invalidate_index()
+    yield settings.MAC_DB_FNAME
+    org_matcher.invalidate_index()
+
+
+def test_update_db(registry, mac_db_fname):
+    url_prefix = 'http://127.0.0.1:{}/'.format(registry.server_port)
+    assert org_matcher.update_db(url_prefix) == (2, 0)
+    assert org_matcher.search_by_mac_address_str('00:16:3e:12:34:56') == [
+        {'org_name': 'Xensource Inc', 'org_addr': 'Palo Alto'},
+    ]
+    assert org_matcher.search_by_mac_address_int(0x001122334455) == [
+        {'org_name': 'Acme Inc', 'org_addr': '1 Road, Somewhere'},
+    ]
+
+    # Nothing has changed, so the second time everything's a 304
+    registry.requests.clear()
+    assert org_matcher.update_db(url_prefix) == (0, 0)
+    assert all(etag for _, etag in registry.requests)
+    assert len(registry.requests) == len(org_matcher.ASSIGNMENT_URL_SUFFIXES)
+
+
+def test_search_by_mac_addresses(registry, mac_db_fname):
+    org_matcher.update_db(
+        'http://127.0.0.1:{}/'.format(registry.server_port)
+    )
+    results = list(org_matcher.search_by_mac_addresses([
+        '00:16:3e:00:00:01', 0x00163e000002, '02:16:3e:00:00:01',
+        '00:aa:bb:00:00:01',
+    ]))
+    assert [len(organisations) for _, organisations in results] == [
+        1, 1, 0, 0,
+    ]
+    assert results[1][0] == 0x00163e000002
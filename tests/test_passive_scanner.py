@@ -0,0 +1,105 @@
+"""
+capture.pcap is little endian with microsecond timestamps, an ARP request,
+a DHCP request with a hostname, an ARP probe inside a VLAN tag, then a TCP
+packet and an ARP from a multicast address that shouldn't be picked up.
+capture_be_ns.pcap is the first of those, big endian with nanosecond
+timestamps. capture.pcapng has a radiotap interface with nanosecond
+timestamps and an ethernet one with the default microseconds, and a probe
+request in an enhanced packet block, an ARP request in another and a probe
+request in a simple packet block.
+"""
+
+import datetime
+import io
+
+import pytest
+
+from conftest import fixture_path
+import device_tracker
+import passive_scanner
+
+ARP_SIGHTING = (1500000000.25, 0x001122334455, '192.168.1.10', None)
+
+
+def sightings(fname, chunk_size=None):
+    with open(fixture_path(fname), 'rb') as f:
+        data = f.read()
+    f = io.BytesIO(data)
+    if chunk_size is not None:
+        # A pipe hands over whatever it has, not whole packets
+        f.read1 = lambda n=-1: io.BytesIO.read(f, min(n, chunk_size))
+    return list(passive_scanner.iter_capture_sightings(f))
+
+
+def test_pcap():
+    assert sightings('capture.pcap') == [
+        ARP_SIGHTING,
+        (1500000001.5, 0x001122334466, '192.168.1.20', 'laptop'),
+        (1500000002.0, 0x001122334477, None, None),
+    ]
+
+
+def test_pcap_big_endian_nanoseconds():
+    assert sightings('capture_be_ns.pcap') == [ARP_SIGHTING]
+
+
+def test_pcapng():
+    assert sightings('capture.pcapng') == [
+        (1500000010.5, 0x001122334488, None, None),
+        (1500000011.0, 0x001122334455, '192.168.1.10', None),
+        # Simple packet blocks have no timestamp of their own
+        (1500000011.0, 0x0011223344aa, None, None),
+    ]
+
+
+@pytest.mark.parametrize('fname', ['capture.pcap', 'capture.pcapng'])
+def test_read_a_few_bytes_at_a_time(fname):
+    assert sightings(fname, chunk_size=7) == sightings(fname)
+
+
+def test_truncated_pcap():
+    with open(fixture_path('capture.pcap'), 'rb') as f:
+        data = f.read()
+    # Cut off part way through the second packet
+    f = io.BytesIO(data[:24 + 16 + 42 + 30])
+    assert list(passive_scanner.iter_capture_sightings(f)) == [ARP_SIGHTING]
+
+
+def test_not_a_capture():
+    with pytest.raises(ValueError):
+        list(passive_scanner.iter_capture_sightings(io.BytesIO(b'x' * 64)))
+
+
+def test_empty_capture():
+    assert list(passive_scanner.iter_capture_sightings(io.BytesIO())) == []
+
+
+def test_iter_scans():
+    scans = list(passive_scanner.iter_scans([
+        (120.5, 0x001122334455, None, None),
+        (130.0, 0x001122334455, '192.168.1.10', 'phone'),
+        # A little out of order, so it's counted in the window it turns up in
+        (110.0, 0x001122334466, None, None),
+        (185.0, 0x001122334466, '192.168.1.20', None),
+    ], window=60))
+    assert [len(devices) for _, devices in scans] == [2, 1]
+    assert scans[0][1][0]['ip'] == '192.168.1.10'
+    assert scans[0][1][0]['hostname'] == 'phone'
+    assert scans[0][0] < scans[1][0]
+
+
+def test_unknown_random_macs_need_a_hostname(tracker_db):
+    known = 0x02aabb000001
+    device_tracker.record_scan(datetime.datetime(2017, 7, 14),
+                               [{'mac_int': known, 'hostname': 'phone'}])
+    assert passive_scanner.record_scans([
+        (1500000000.0, 0x02aabb000002, None, None),
+        (1500000001.0, known, None, None),
+        (1500000002.0, 0x02aabb000003, None, 'tablet'),
+        (1500000003.0, 0x001122334455, None, None),
+        # A window of nothing but rotating macs isn't saved
+        (1500000070.0, 0x02aabb000004, None, None),
+    ], window=60) == 1
+    assert sorted(device[1] for device in device_tracker.all_devices()) == [
+        0x001122334455, known, 0x02aabb000003,
+    ]
@@ -0,0 +1,136 @@
+import datetime
+import json
+import socket
+
+import passive_scanner
+import presence_events
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+
+
+def record(sightings_by_scan, on_scan=None, start=0):
+    """
+    sightings_by_scan is a list of [(mac_int, hostname)] one per scan, a
+    minute apart from start minutes after T0
+    """
+    sightings = [
+        ((T0 + datetime.timedelta(minutes=start + i)).timestamp(), mac_int,
+         None, hostname)
+        for i, scan in enumerate(sightings_by_scan)
+        for mac_int, hostname in scan
+    ]
+    passive_scanner.record_scans(sightings, 60, on_scan)
+
+
+def test_rotating_mac_stays_present(tracker_db):
+    record([[(0x02aabbccdd01, 'phone')]] * 2)
+    detector = presence_events.ChangeDetector.from_db()
+    assert len(detector.present) == 1
+
+    events = []
+    record([[(0x06aabbccdd02, 'phone')]] * 3,
+           lambda devices, timings: events.extend(
+               detector.update(devices, timings['timestamp'])), start=2)
+    assert events == []
+    device = detector.devices[next(iter(detector.present))]
+    assert device['mac_int'] == 0x06aabbccdd02
+
+
+def device(device_id, mac_int=None):
+    return {'device_id': device_id, 'mac_int': mac_int or device_id,
+            'hostname': 'host{}'.format(device_id)}
+
+
+def events_by_scan(detector, scans):
+    return [
+        [(event['event'], event['mac_address'])
+         for event in detector.update(devices, T0)]
+        for devices in scans
+    ]
+
+
+def test_join_and_leave():
+    detector = presence_events.ChangeDetector([device(1)])
+    assert events_by_scan(detector, [
+        [device(1), device(2)],
+        [device(2)],
+        [],
+    ]) == [
+        [('join', '00:00:00:00:00:02')],
+        [('leave', '00:00:00:00:00:01')],
+        [('leave', '00:00:00:00:00:02')],
+    ]
+
+
+def test_debounce():
+    detector = presence_events.ChangeDetector(join_after=2, leave_after=2)
+    assert events_by_scan(detector, [
+        [device(1)],
+        # Gone again before it counted as joining
+        [],
+        [device(1)],
+        [device(1)],
+        [],
+        # Back before it counted as leaving
+        [device(1)],
+        [],
+        [],
+    ]) == [[], [], [], [('join', '00:00:00:00:00:01')], [], [], [],
+           [('leave', '00:00:00:00:00:01')]]
+
+
+def test_event_fields():
+    detector = presence_events.ChangeDetector()
+    event, = detector.update([dict(device(1), ip='192.168.1.10')], T0)
+    assert event == {
+        'event': 'join',
+        'mac_address': '00:00:00:00:00:01',
+        'hostname': 'host1',
+        'name': None,
+        'ip': '192.168.1.10',
+        'timestamp': T0.isoformat(),
+    }
+
+
+def test_from_db(tracker_db):
+    record([
+        [(0x001122000001, 'a'), (0x001122000002, 'b')],
+        [(0x001122000001, 'a'), (0x001122000002, 'b')],
+        [(0x001122000001, 'a'), (0x001122000003, 'c')],
+    ])
+    detector = presence_events.ChangeDetector.from_db(join_after=2,
+                                                      leave_after=2)
+    # b has missed one scan, c has only been seen in one
+    assert len(detector.present) == 2
+    events = []
+    record([[(0x001122000001, 'a'), (0x001122000003, 'c')]],
+           lambda devices, timings: events.extend(
+               detector.update(devices, timings['timestamp'])), start=3)
+    assert sorted((event['event'], event['hostname'])
+                  for event in events) == [('join', 'c'), ('leave', 'b')]
+
+
+def test_publish_to_file(tmp_path):
+    fname = str(tmp_path / 'events.jsonl')
+    publisher = presence_events.JsonLinesPublisher(fname)
+    try:
+        publisher.publish([{'event': 'join'}, {'event': 'leave'}])
+    finally:
+        publisher.close()
+    with open(fname) as f:
+        assert [json.loads(line) for line in f] == [
+            {'event': 'join'}, {'event': 'leave'},
+        ]
+
+
+def test_publish_to_unix_socket(tmp_path):
+    path = str(tmp_path / 'events.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen(1)
+        publisher = presence_events.JsonLinesPublisher('unix:' + path)
+        connection, _ = listener.accept()
+        with connection:
+            publisher.publish([{'event': 'join'}])
+            publisher.close()
+            assert connection.makefile().read() == '{"event": "join"}\n'
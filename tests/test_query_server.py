@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import http.client
+import json
+import threading
+
+import pytest
+
+import device_tracker
+import org_matcher
+import query_server
+
+T0 = datetime.datetime(2026, 1, 1, 12, 0)
+PHONE = 0x00163e000001
+
+
+@pytest.fixture
+def server(tracker_db):
+    org_matcher.init_tables(tracker_db)
+    org_matcher.dump_into_db(
+        [(0x00163e000000, 0x00163effffff, 'Xensource Inc', 'Palo Alto')],
+        tracker_db,
+    )
+    org_matcher.invalidate_index()
+    device_tracker.record_scan(T0, [{'mac_int': PHONE, 'hostname': 'phone'}])
+    device_tracker.record_scan(T0 + datetime.timedelta(minutes=1), [])
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    async def serve():
+        cache = query_server.QueryCache()
+        await cache.run(cache.refresh)
+        server = await asyncio.start_server(
+            lambda reader, writer: query_server._handle_connection(
+                cache, reader, writer),
+            '127.0.0.1', 0,
+        )
+        loop.server = server
+        started.set()
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        cache._executor.shutdown()
+
+    thread = threading.Thread(target=loop.run_until_complete,
+                              args=(serve(),), daemon=True)
+    thread.start()
+    started.wait(5)
+    try:
+        yield loop.server.sockets[0].getsockname()[1]
+    finally:
+        loop.call_soon_threadsafe(loop.server.close)
+        thread.join(5)
+        org_matcher.invalidate_index()
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        return (response.status, dict(response.getheaders()),
+                json.loads(data) if data else None)
+    finally:
+        conn.close()
+
+
+def test_devices(server):
+    status, headers, devices = request(server, 'GET', '/devices')
+    assert status == 200
+    assert devices == [{
+        'mac_address': '00:16:3e:00:00:01',
+        'last_hostname': 'phone',
+        'name': None,
+        'organisation': [{'org_name': 'Xensource Inc',
+                          'org_addr': 'Palo Alto'}],
+    }]
+
+
+def test_etag(server):
+    _, headers, _ = request(server, 'GET', '/devices')
+    etag = headers['ETag']
+    status, _, body = request(server, 'GET', '/devices',
+                              headers={'If-None-Match': etag})
+    assert (status, body) == (304, None)
+
+    # A new scan changes it
+    device_tracker.record_scan(T0 + datetime.timedelta(minutes=2), [])
+    status, headers, _ = request(server, 'GET', '/devices',
+                                 headers={'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+
+
+def test_history(server):
+    status, _, history = request(server, 'GET',
+                                 '/devices/00-16-3E-00-00-01/history')
+    assert status == 200
+    assert history == [
+        {'timestamp': '2026-01-01T12:00:00', 'present': True},
+        {'timestamp': '2026-01-01T12:01:00', 'present': False},
+    ]
+    status, headers, history = request(
+        server, 'GET',
+        '/devices/00:16:3e:00:00:01/history?since=2026-01-01%2012:01'
+    )
+    assert status == 200
+    assert headers['Cache-Control'] == 'no-cache'
+    assert history == [{'timestamp': '2026-01-01T12:01:00',
+                        'present': False}]
+
+
+def test_history_of_alias(server):
+    # A phone's randomised mac rotates, the second becomes an alias
+    for minutes, mac_int in ((2, 0x02aabb000001), (3, 0x02aabb000002)):
+        device_tracker.record_scan(
+            T0 + datetime.timedelta(minutes=minutes),
+            [{'mac_int': mac_int, 'hostname': 'tablet'}],
+        )
+    status, _, history = request(server, 'GET',
+                                 '/devices/02:aa:bb:00:00:02/history')
+    assert status == 200
+    assert [entry['present'] for entry in history] == [
+        False, False, True, True,
+    ]
+
+
+@pytest.mark.parametrize('method, path, status', [
+    ('GET', '/devices/00:16:3e:00:00:02/history', 404),
+    ('GET', '/devices/not-a-mac/history', 400),
+    ('GET', '/devices/00:16:3e:00:00:01/history?since=whenever', 400),
+    ('GET', '/nowhere', 404),
+    ('POST', '/devices', 405),
+    ('GET', '/oui', 405),
+])
+def test_errors(server, method, path, status):
+    response_status, _, body = request(server, method, path, body=b'')
+    assert response_status == status
+    assert 'error' in body
+
+
+def test_oui(server):
+    status, _, orgs = request(server, 'GET', '/oui/00163e123456')
+    assert status == 200
+    assert orgs == [{'org_name': 'Xensource Inc', 'org_addr': 'Palo Alto'}]
+
+
+def test_post_oui(server):
+    status, _, results = request(
+        server, 'POST', '/oui',
+        json.dumps(['00:16:3e:00:00:09', '00:aa:bb:00:00:01']).encode(),
+        {'Content-Type': 'application/json'},
+    )
+    assert status == 200
+    assert [(result['mac_address'], len(result['organisation']))
+            for result in results] == [
+        ('00:16:3e:00:00:09', 1), ('00:aa:bb:00:00:01', 0),
+    ]
+
+
+@pytest.mark.parametrize('body', [b'not json', b'{"a": 1}', b'["nope"]'])
+def test_post_oui_bad_body(server, body):
+    status, _, _ = request(server, 'POST', '/oui', body)
+    assert status == 400
@@ -0,0 +1,100 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+import device_tracker
+import mac_db
+import retention
+from config import settings
+
+T0 = datetime.datetime(2026, 1, 1)
+A = {'mac_int': 0x001122000001, 'hostname': 'a'}
+B = {'mac_int': 0x001122000002, 'hostname': 'b'}
+C = {'mac_int': 0x001122000003, 'hostname': 'c'}
+
+
+def at(minutes):
+    return T0 + datetime.timedelta(minutes=minutes)
+
+
+def runs():
+    c = mac_db.get_connection(settings.MAC_DB_FNAME).cursor()
+    c.execute('''
+    SELECT device_last_hostname, presence_first_seen, presence_last_seen
+    FROM presence JOIN device ON presence_device_id = device_id
+    ORDER BY 1, 2
+    ''')
+    return c.fetchall()
+
+
+def scans():
+    c = mac_db.get_connection(settings.MAC_DB_FNAME).cursor()
+    c.execute('SELECT time_stamp_datetime FROM time_stamp ORDER BY 1')
+    return [time_stamp for time_stamp, in c.fetchall()]
+
+
+@pytest.fixture
+def three_hours(tracker_db):
+    # A is always there, B visits between the kept scans of the first hour
+    # and twice more in the second, C only turns up for the last two scans
+    for minute in range(0, 180, 10):
+        devices = [A]
+        if minute in (20, 30, 70, 90):
+            devices.append(B)
+        if minute >= 160:
+            devices.append(C)
+        device_tracker.record_scan(at(minute), devices)
+
+
+def test_rollup_keeps_short_visits(three_hours):
+    result = retention.prune(now=T0 + datetime.timedelta(days=8),
+                             batch_size=1)
+    assert result == {'rolled_up': 15, 'expired': 0, 'expired_presence': 0}
+    assert scans() == [at(0), at(60), at(120)]
+    assert runs() == [
+        ('a', at(0), at(120)),
+        ('b', at(0), at(0)),
+        # Both visits in the second hour end up as the one scan
+        ('b', at(60), at(60)),
+        ('c', at(120), at(120)),
+    ]
+    # Running it again changes nothing
+    assert retention.prune(now=T0 + datetime.timedelta(days=8)) == {
+        'rolled_up': 0, 'expired': 0, 'expired_presence': 0,
+    }
+
+
+def test_raw_scans_left_alone(three_hours):
+    before = runs()
+    assert retention.prune(now=at(180))['rolled_up'] == 0
+    assert runs() == before
+    assert len(scans()) == 18
+
+
+def test_expire(three_hours):
+    result = retention.prune(now=T0 + datetime.timedelta(days=365,
+                                                         minutes=100))
+    assert result['expired'] == 10
+    # Only B's runs had ended by then
+    assert result['expired_presence'] == 3
+    assert [hostname for hostname, _, _ in runs()] == ['a', 'c']
+
+
+def test_scan_during_rollup_isnt_undone(three_hours, monkeypatch):
+    rolled_up_runs = retention._rolled_up_runs
+    scanner = threading.Thread(
+        target=device_tracker.record_scan, args=(at(180), [A])
+    )
+
+    def scan_meanwhile(*args):
+        # Has to wait for the rollup's transaction to finish
+        scanner.start()
+        time.sleep(0.2)
+        return rolled_up_runs(*args)
+    monkeypatch.setattr(retention, '_rolled_up_runs', scan_meanwhile)
+    # Everything before the last hour is rolled up
+    retention.prune(now=at(120) + settings.RAW_RETENTION)
+    scanner.join()
+    assert runs()[0] == ('a', at(0), at(180))